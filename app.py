@@ -1,45 +1,81 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, Response, g
 from flask_cors import CORS
 import logging
 import uuid
 import time
+from graph_registry import GraphRegistry
+from graph_preloader import GraphPreloader
+from route_cache import RouteCache
+from route_scheduler import RouteScheduler, RouteJob, QueueFullError
+from route_executor import ProcessRouteExecutor
+from route_encoding import format_route
+from safety_layer import SafetyLayer
 from osm_processor import OSMProcessor
-from threading import Thread, Lock
+from metrics import MetricsRegistry
 import traceback
 import os
+import hashlib
 import json
+import gzip
 from pathlib import Path
-import networkx as nx
 
 DATA_DIR = Path("data")
 CACHE_DIR = Path("cache")
-GRAPH_FILE = DATA_DIR / "map_graph.json"
-CACHE_FILE = CACHE_DIR / "route_cache.json"
+GRAPHS_DIR = DATA_DIR / "graphs"  # un directorio binario por región
+CACHE_FILE = CACHE_DIR / "route_cache.sqlite3"
+SAFETY_LAYER_FILE = DATA_DIR / "safety_layer.sqlite3"  # zonas de seguridad del servidor, versionadas
+
+# Usar los nodos ajustados (y no las coordenadas crudas) como clave de caché de rutas
+SNAPPED_CACHE_KEYS = os.environ.get("SNAPPED_CACHE_KEYS", "false").lower() in ("1", "true", "yes")
+
+# Corredor de búsqueda por defecto para las rutas ("ellipse", "bbox" o vacío para todo el grafo)
+ROUTE_CORRIDOR = os.environ.get("ROUTE_CORRIDOR", "").lower() or None
+
+# Memoria máxima para grafos residentes (varias regiones a la vez)
+GRAPH_MEMORY_BUDGET = int(os.environ.get("GRAPH_MEMORY_BUDGET", 2 * 1024 ** 3))
+
+# Landmarks por grafo para la heurística ALT (0 los desactiva)
+LANDMARK_COUNT = int(os.environ.get("LANDMARK_COUNT", 8))
+
+# Regiones guardadas que se cargan en segundo plano al arrancar: ids separados por comas o "all"
+PRELOAD_REGIONS = os.environ.get("PRELOAD_REGIONS", "")
+
+# Preprocesar jerarquías de contracción para shortest/fastest al cargar cada grafo
+CONTRACTION_HIERARCHIES = os.environ.get("CONTRACTION_HIERARCHIES", "false").lower() in ("1", "true", "yes")
+
+# Ejecución de rutas: "thread" (en este proceso) o "process" (pool de procesos, todos los núcleos)
+ROUTE_EXECUTOR = os.environ.get("ROUTE_EXECUTOR", "thread").lower()
+ROUTE_PROCESSES = int(os.environ.get("ROUTE_PROCESSES", os.cpu_count() or 1))
+
+# Hilos de cálculo de rutas y tamaño máximo de la cola de espera
+ROUTE_WORKERS = int(os.environ.get("ROUTE_WORKERS", ROUTE_PROCESSES if ROUTE_EXECUTOR == "process" else 4))
+ROUTE_QUEUE_SIZE = int(os.environ.get("ROUTE_QUEUE_SIZE", 100))
+
+# Máximo de pares origen/destino y de puntos por petición a /route-matrix
+MAX_MATRIX_PAIRS = int(os.environ.get("MAX_MATRIX_PAIRS", 10000))
+MAX_MATRIX_POINTS = int(os.environ.get("MAX_MATRIX_POINTS", 1000))
+
+# Máximo de cortes por petición a /isochrone
+MAX_ISOCHRONE_CUTOFFS = int(os.environ.get("MAX_ISOCHRONE_CUTOFFS", 10))
+
+# Límites de la caché de rutas
+ROUTE_CACHE_MAX_ENTRIES = int(os.environ.get("ROUTE_CACHE_MAX_ENTRIES", 1000))
+ROUTE_CACHE_MAX_BYTES = int(os.environ.get("ROUTE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+ROUTE_CACHE_TTL = float(os.environ.get("ROUTE_CACHE_TTL", 24 * 3600))
+ROUTE_CACHE_MAX_DISK_ENTRIES = int(os.environ.get("ROUTE_CACHE_MAX_DISK_ENTRIES", 10000))
+
+# Entrega de resultados: espera máxima de un long-poll y duración de un stream SSE
+LONG_POLL_TIMEOUT = float(os.environ.get("LONG_POLL_TIMEOUT", 30))
+SSE_STREAM_TIMEOUT = float(os.environ.get("SSE_STREAM_TIMEOUT", 120))
+SSE_KEEPALIVE = 15  # segundos entre comentarios para mantener viva la conexión
+
+# Respuestas JSON a partir de este tamaño se comprimen con gzip
+GZIP_MIN_BYTES = int(os.environ.get("GZIP_MIN_BYTES", 1024))
 
 # Crear directorios si no existen
 DATA_DIR.mkdir(exist_ok=True)
 CACHE_DIR.mkdir(exist_ok=True)
 
-# Cargar cache al inicio si existe
-if CACHE_FILE.exists():
-    with open(CACHE_FILE, 'r') as f:
-        route_cache = json.load(f)
-else:
-    route_cache = {}
-    
-# Función para guardar el cache periodicamente
-def save_cache():
-    while True:
-        time.sleep(60)  # Guardar cada 60 segundos
-        with cache_lock:
-            with open(CACHE_FILE, 'w') as f:
-                json.dump(route_cache, f)
-        logger.info("Cache guardado en disco")
-
-# Iniciar hilo para guardar cache
-cache_saver = Thread(target=save_cache, daemon=True)
-cache_saver.start()    
-
 # Configuración de logging
 logging.basicConfig(
     level=logging.INFO,
@@ -54,12 +90,40 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)
 
-# Inicializar procesador OSM
-processor = OSMProcessor()
+# Registro de grafos por región; cada región tiene su propio procesador OSM
+registry = GraphRegistry(GRAPHS_DIR, max_bytes=GRAPH_MEMORY_BUDGET, landmark_count=LANDMARK_COUNT,
+                         contraction_hierarchies=CONTRACTION_HIERARCHIES)
 
-# Cache compartido con bloqueo para thread safety
-route_cache = {}
-cache_lock = Lock()
+# Caché de rutas acotada; los resultados se leen de disco bajo demanda
+route_cache = RouteCache(
+    CACHE_FILE,
+    max_entries=ROUTE_CACHE_MAX_ENTRIES,
+    max_bytes=ROUTE_CACHE_MAX_BYTES,
+    ttl=ROUTE_CACHE_TTL,
+    max_disk_entries=ROUTE_CACHE_MAX_DISK_ENTRIES
+)
+
+# Capa de zonas de seguridad administrada en el servidor (/safety-zones)
+safety_layer = SafetyLayer(SAFETY_LAYER_FILE)
+
+# Métricas del servicio en formato Prometheus (/metrics)
+metrics = MetricsRegistry()
+http_latency = metrics.histogram(
+    "http_request_duration_seconds", "Latencia de las peticiones HTTP", ("endpoint", "method")
+)
+http_requests = metrics.counter(
+    "http_requests_total", "Peticiones HTTP atendidas", ("endpoint", "method", "status")
+)
+task_latency = metrics.histogram(
+    "route_task_duration_seconds", "Duración de los cálculos de rutas y matrices", ("task", "optimization", "search")
+)
+phase_latency = metrics.histogram(
+    "route_phase_duration_seconds", "Duración de cada fase del cálculo de una ruta", ("phase",)
+)
+task_outcomes = metrics.counter("route_tasks_total", "Cálculos terminados por estado", ("task", "status"))
+search_work = metrics.counter(
+    "route_search_work_total", "Nodos expandidos y aristas relajadas por las búsquedas", ("kind",)
+)
 
 class PlaceRequest:
     def __init__(self, place_name: str, simplify: bool = True, network_type: str = "drive"):
@@ -79,39 +143,249 @@ class RouteRequest:
     def __init__(self, start_lat: float, start_lon: float, end_lat: float, end_lon: float, 
                  safety_points: list[SafetyPoint] = [], optimization: str = "balanced",
                  heuristic: str = "euclidean", distance_weight: float = 0.4, 
-                 time_weight: float = 0.3, safety_weight: float = 0.3):
+                 time_weight: float = 0.3, safety_weight: float = 0.3, engine: str = "compiled",
+                 region_id: str = None, search: str = "auto", safety_layer: int = None,
+                 corridor: str = None):
         self.start_lat = start_lat
         self.start_lon = start_lon
         self.end_lat = end_lat
         self.end_lon = end_lon
         self.safety_points = safety_points
-        self.optimization = optimization
-        self.heuristic = heuristic
+        # Normalizados una vez: la clave de caché y el procesador ven los mismos valores
+        self.optimization = optimization.lower()
+        self.heuristic = heuristic.lower()
         self.distance_weight = distance_weight
         self.time_weight = time_weight
         self.safety_weight = safety_weight
+        self.engine = engine
+        self.region_id = region_id
+        self.search = search
+        self.safety_layer = safety_layer
+        self.corridor = corridor
+
+def corridor_shape(value):
+    """Forma del corredor que restringe la búsqueda: "ellipse", "bbox" o None (todo el grafo)"""
+    if not value:
+        return None
+    if value not in ("ellipse", "bbox"):
+        raise ValueError("'corridor' debe ser \"ellipse\", \"bbox\" o null")
+    return value
+
+def layer_version(value):
+    """Versión de la capa de seguridad que pide una ruta: un número, "latest" o None (sin capa)"""
+    if value is None:
+        return None
+    if value == "latest":
+        return safety_layer.version
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError("'safety_layer' debe ser un número de versión o \"latest\"")
+    if not 0 <= value <= safety_layer.version:
+        raise ValueError(f"Versión de la capa de seguridad desconocida: {value} (actual: {safety_layer.version})")
+    return value
+
+def raw_cache_key(req: RouteRequest) -> str:
+    """Clave de caché a partir de las coordenadas tal como llegan en la petición"""
+    safety_points_key = "_".join(
+        f"{sp.lat:.6f}_{sp.lon:.6f}_{sp.radius:.2f}_{sp.safety_index}_{sp.weight:.2f}"
+        for sp in req.safety_points
+    )
+    
+    return (
+        f"{req.region_id}_"
+        f"{req.start_lat:.6f}_{req.start_lon:.6f}_"
+        f"{req.end_lat:.6f}_{req.end_lon:.6f}_"
+        f"{safety_points_key}_"
+        f"{req.optimization}_{req.heuristic}_"
+        f"{req.distance_weight:.2f}_{req.time_weight:.2f}_{req.safety_weight:.2f}_"
+        f"{req.engine}_{req.search}"
+        + (f"_layer{req.safety_layer}" if req.safety_layer is not None else "")
+        + (f"_corridor{req.corridor}" if req.corridor is not None else "")
+    )
+
+def snapped_cache_key(req: RouteRequest, processor) -> str:
+    """
+    Clave de caché a partir de los nodos ajustados: dos clics que caen en el mismo
+    nodo comparten la ruta. Sólo se incluyen los parámetros que afectan la ruta
+    o las columnas de seguridad del resultado.
+    """
+    start_node, end_node = processor.snap_coordinates(
+        [req.start_lat, req.end_lat], [req.start_lon, req.end_lon]
+    )
+    key = (f"snap_{req.region_id}_{start_node}_{end_node}_{req.optimization}_{req.heuristic}_"
+           f"{req.engine}_{req.search}")
+    
+    if req.optimization == "balanced":
+        total_weight = req.distance_weight + req.time_weight + req.safety_weight
+        if total_weight <= 0:
+            total_weight = 1.0
+        key += (
+            f"_{req.distance_weight / total_weight:.4f}"
+            f"_{req.time_weight / total_weight:.4f}"
+            f"_{req.safety_weight / total_weight:.4f}"
+        )
+    
+    if req.safety_points:
+        # Huella de las zonas por sus coordenadas redondeadas (~1 m) y no por el nodo
+        # ajustado; va en toda optimización porque todas reportan la seguridad de la ruta
+        zones = sorted(
+            (round(sp.lat, 5), round(sp.lon, 5), round(sp.radius, 2), sp.safety_index, round(sp.weight, 2))
+            for sp in req.safety_points
+        )
+        key += "_" + hashlib.sha1(repr(zones).encode()).hexdigest()[:16]
+    
+    if req.safety_layer is not None:
+        key += f"_layer{req.safety_layer}"
+    
+    if req.corridor is not None:
+        key += f"_corridor{req.corridor}"
+    
+    return key
+
+def observe_task(request_dict: dict, result: dict):
+    """Registra en las métricas la duración y el trabajo de un cálculo terminado"""
+    task = request_dict.get('task', 'route')
+    status = result.get('status', 'failed')
+    task_outcomes.inc(task=task, status=status)
+    if status != 'completed':
+        return
+    
+    metadata = result.get('metadata', {})
+    task_latency.observe(
+        result['summary']['processing_time'],
+        task=task,
+        optimization=request_dict.get('optimization'),
+        search=metadata.get('search', 'astar' if task == 'route' else 'dijkstra')
+    )
+    for phase, seconds in metadata.get('timings', {}).items():
+        phase_latency.observe(seconds, phase=phase)
+    for kind in ('nodes_expanded', 'edges_relaxed'):
+        if metadata.get(kind) is not None:
+            search_work.inc(metadata[kind], kind=kind)
 
-def background_task(processor, request_dict, task_id, cache_key):
+def background_task(job: RouteJob) -> dict:
+    """Calcula una ruta (o matriz) en un hilo del pool y guarda el resultado en caché"""
+    logger.info(f"Iniciando cálculo para: {job.cache_key}")
+    
+    region_id = job.request_dict['region_id']
+    # Las rutas que llegan durante el arranque esperan a que su región termine de cargar
+    preloader.wait(region_id)
+    if process_executor is not None:
+        result = process_executor.calculate(region_id, job.request_dict)
+    else:
+        result = registry.get(region_id).run_task(job.request_dict, safety_layer)
+    
+    observe_task(job.request_dict, result)
+    if result.get('status') == 'failed':
+        return {"status": "failed", "error": result.get('error')}
+    
+    # El resultado se guarda una sola vez, bajo su cache_key
+    route_cache.put_result(job.cache_key, result)
+    logger.info(f"Cálculo completado para: {job.cache_key}")
+    return {"status": "completed"}
+
+def finish_task(job: RouteJob, outcome: dict):
+    """Marca como terminadas todas las tareas adjuntas al cálculo, también las de otros workers"""
+    route_cache.finish_tasks(job.cache_key, outcome['status'], outcome.get('error'))
+
+def serialize_safety_points(safety_points) -> list:
+    """Puntos de seguridad (SafetyPoint o dicts de la petición) en el formato de request_dict"""
+    points = [vars(sp) if isinstance(sp, SafetyPoint) else sp for sp in safety_points]
+    return [{
+        'lat': sp['lat'],
+        'lon': sp['lon'],
+        'radius': sp['radius'],
+        'safety_index': sp['safety_index'],
+        'weight': sp.get('weight', 1.0)
+    } for sp in points]
+
+def cached_task_response(task_id: str, cache_key: str, **task_fields):
+    """Registra una tarea ya completada con un resultado en caché y la respuesta que la anuncia"""
+    route_cache.set_task(task_id, 'completed', cache_key, **task_fields)
+    return jsonify({
+        "status": "completed",
+        "task_id": task_id,
+        "message": "Resultado obtenido de caché"
+    })
+
+def queue_full_response(e: QueueFullError):
+    """429 con Retry-After y el estado de la cola cuando el planificador rechaza una tarea"""
+    response = jsonify({"error": str(e), **scheduler.stats()})
+    response.headers['Retry-After'] = '5'
+    return response, 429
+
+def submit_task(task_id: str, cache_key: str, request_dict: dict, **task_fields):
+    """
+    Registra la tarea (con `task_fields` propios de la petición) y encola su cálculo si
+    ningún worker lo está haciendo ya. Devuelve la posición en la cola, o None si la
+    tarea quedó adjunta a un cálculo en curso. Lanza QueueFullError (con las tareas ya
+    marcadas como fallidas).
+    """
+    if not route_cache.start_task(task_id, cache_key, **task_fields):
+        logger.info(f"Tarea {task_id} adjunta al cálculo en curso de {cache_key}")
+        return None
     try:
-        logger.info(f"Iniciando cálculo de ruta para task_id: {task_id}")
-        
-        # Procesar la ruta - ahora pasamos solo el request_dict
-        result = processor.calculate_route_task(request_dict)
-        
-        # Guardar en caché con bloqueo
-        with cache_lock:
-            route_cache[task_id] = result
-            route_cache[cache_key] = result
-            
-        logger.info(f"Cálculo completado para task_id: {task_id}")
-        
-    except Exception as e:
-        logger.error(f"Error en cálculo de ruta (task {task_id}): {str(e)}\n{traceback.format_exc()}")
-        with cache_lock:
-            route_cache[task_id] = {
-                "error": str(e),
-                "status": "failed"
-            }
+        return scheduler.submit(cache_key, request_dict, task_id)
+    except QueueFullError as e:
+        route_cache.finish_tasks(cache_key, 'failed', str(e))
+        raise
+
+# Regiones a precargar; la carga empieza después de crear el pool de procesos
+preloader = GraphPreloader.from_config(registry, PRELOAD_REGIONS)
+
+# Pool de procesos (opcional); se crea antes que los hilos del planificador
+process_executor = None
+if ROUTE_EXECUTOR == "process":
+    process_executor = ProcessRouteExecutor(GRAPHS_DIR, ROUTE_PROCESSES, GRAPH_MEMORY_BUDGET, LANDMARK_COUNT,
+                                             CONTRACTION_HIERARCHIES, SAFETY_LAYER_FILE, preloader.region_ids)
+
+# Pool de cálculo de rutas con cola acotada; las peticiones idénticas se adjuntan antes,
+# al reclamar su cache_key en route_cache
+scheduler = RouteScheduler(
+    background_task,
+    finish_task,
+    workers=ROUTE_WORKERS,
+    max_queue=ROUTE_QUEUE_SIZE
+)
+
+preloader.start()
+
+def _cache_counter(name: str):
+    return lambda: [({}, route_cache.stats()[name])]
+
+metrics.counter_callback("route_cache_hits_total", "Consultas a la caché de rutas con resultado", _cache_counter('hits'))
+metrics.counter_callback("route_cache_misses_total", "Consultas a la caché de rutas sin resultado", _cache_counter('misses'))
+metrics.counter_callback("route_cache_evictions_total", "Resultados desalojados de la caché de rutas", _cache_counter('evictions'))
+metrics.gauge_callback("route_cache_entries", "Resultados en memoria", _cache_counter('entries'))
+metrics.gauge_callback("route_cache_bytes", "Bytes de resultados en memoria", _cache_counter('bytes'))
+metrics.gauge_callback(
+    "route_tasks_in_flight", "Cálculos en cola o en ejecución",
+    lambda: [({"state": state}, scheduler.stats()[state]) for state in ("queued", "running")]
+)
+metrics.gauge_callback(
+    "graph_memory_bytes", "Memoria de los grafos residentes y sus índices",
+    lambda: [({"region": region_id}, info["bytes"]) for region_id, info in registry.stats().items()]
+)
+metrics.gauge_callback(
+    "graph_preload_progress", "Fracción de las regiones configuradas ya precargadas",
+    lambda: [({}, preloader.status()["progress"])]
+)
+metrics.gauge_callback(
+    "graph_nodes", "Nodos de los grafos residentes",
+    lambda: [({"region": region_id}, info["nodes"]) for region_id, info in registry.stats().items()]
+)
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    """Latencia y conteo por ruta (la plantilla de la URL, no la URL con ids)"""
+    if 'request_start' in g:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        http_latency.observe(time.perf_counter() - g.request_start, endpoint=endpoint, method=request.method)
+        http_requests.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    return response
 
 
 # Modificar el endpoint /load-map
@@ -125,43 +399,34 @@ def load_map():
             network_type=data.get('network_type', 'drive')
         )
         
-        # Verificar si ya tenemos el grafo guardado
-        cache_key = f"{req.place_name}_{req.network_type}_{req.simplify}"
-        if GRAPH_FILE.exists():
-            try:
-                with open(GRAPH_FILE, 'r') as f:
-                    graph_data = json.load(f)
-                processor.graph = nx.node_link_graph(graph_data)
-                logger.info(f"Grafo cargado desde archivo para: {req.place_name}")
-                return jsonify({
-                    "status": "success",
-                    "nodes": len(processor.graph.nodes),
-                    "edges": len(processor.graph.edges),
-                    "message": f"Mapa de {req.place_name} cargado desde archivo"
-                })
-            except Exception as e:
-                logger.warning(f"No se pudo cargar el grafo desde archivo: {str(e)}")
-        
-        # Si no existe, descargarlo
-        logger.info(f"Descargando mapa para: {req.place_name}")
-        result = processor.download_map(
-            req.place_name, 
-            req.simplify, 
-            req.network_type
-        )
-        processor.save_graph(GRAPH_FILE)
+        # Cada lugar/tipo de red/simplificación tiene su propio grafo
+        region_id, processor, source = registry.load(req.place_name, req.network_type, req.simplify)
+        if source == "download":
+            message = f"Mapa de {req.place_name} descargado y guardado correctamente"
+        else:
+            message = f"Mapa de {req.place_name} cargado desde {'memoria' if source == 'memory' else 'archivo'}"
+        logger.info(message)
         
         return jsonify({
             "status": "success",
-            "nodes": result["nodes"],
-            "edges": result["edges"],
-            "message": f"Mapa de {req.place_name} descargado y guardado correctamente"
+            "region_id": region_id,
+            "nodes": processor.compiled.num_nodes,
+            "edges": processor.compiled.num_edges,
+            "message": message
         })
         
     except Exception as e:
         logger.error(f"Error al cargar mapa: {str(e)}\n{traceback.format_exc()}")
         return jsonify({"error": str(e)}), 400
 
+@app.route('/regions', methods=['GET'])
+def list_regions():
+    return jsonify({
+        "default": registry.default_region,
+        "resident": registry.stats(),
+        "available": registry.available()
+    })
+
 @app.route('/calculate-route', methods=['POST'])
 def calculate_route():
     try:
@@ -190,65 +455,76 @@ def calculate_route():
             heuristic=data.get('heuristic', 'euclidean'),
             distance_weight=data.get('distance_weight', 0.4),
             time_weight=data.get('time_weight', 0.3),
-            safety_weight=data.get('safety_weight', 0.3)
+            safety_weight=data.get('safety_weight', 0.3),
+            engine=data.get('engine', 'compiled'),
+            region_id=data.get('region_id') or registry.default_region,
+            search=data.get('search', 'auto'),
+            safety_layer=layer_version(data.get('safety_layer')),
+            corridor=corridor_shape(data.get('corridor', ROUTE_CORRIDOR))
         )
+        OSMProcessor.validate_search(req.engine, req.search)
+        
+        # Durante la precarga la región todavía no está en memoria: la ruta se encola
+        # sin esperar y se usa la clave de caché por coordenadas
+        warming = preloader.warming(req.region_id)
+        processor = None
+        if not warming:
+            try:
+                processor = registry.get(req.region_id)
+            except KeyError as e:
+                return jsonify({"error": str(e.args[0])}), 400
         
         task_id = str(uuid.uuid4())
         
         # Generar cache_key consistente
-        safety_points_key = "_".join(
-            f"{sp.lat:.6f}_{sp.lon:.6f}_{sp.radius:.2f}_{sp.safety_index}_{sp.weight:.2f}"
-            for sp in req.safety_points
-        )
+        use_snapped_key = data.get('snap_cache', SNAPPED_CACHE_KEYS) and processor is not None
+        cache_key = snapped_cache_key(req, processor) if use_snapped_key else raw_cache_key(req)
         
-        cache_key = (
-            f"{req.start_lat:.6f}_{req.start_lon:.6f}_"
-            f"{req.end_lat:.6f}_{req.end_lon:.6f}_"
-            f"{safety_points_key}_"
-            f"{req.optimization}_{req.heuristic}_"
-            f"{req.distance_weight:.2f}_{req.time_weight:.2f}_{req.safety_weight:.2f}"
-        )
+        # Con la clave por nodos la ruta se comparte, pero los tramos de conexión son
+        # de cada petición: se guardan en su tarea tanto en un acierto de caché como
+        # al adjuntarse a un cálculo en curso
+        task_fields = {}
+        if use_snapped_key:
+            task_fields['connectors'] = processor.route_connectors(
+                req.start_lat, req.start_lon, req.end_lat, req.end_lon
+            )
         
         # Verificar caché
-        with cache_lock:
-            if cache_key in route_cache:
-                logger.info(f"Resultado obtenido de caché para clave: {cache_key}")
-                return jsonify({
-                    "status": "completed",
-                    "task_id": cache_key,
-                    "message": "Resultado obtenido de caché"
-                })
+        if route_cache.has_result(cache_key):
+            logger.info(f"Resultado obtenido de caché para clave: {cache_key}")
+            return cached_task_response(task_id, cache_key, **task_fields)
         
         request_dict = {
             'start_lat': req.start_lat,
             'start_lon': req.start_lon,
             'end_lat': req.end_lat,
             'end_lon': req.end_lon,
-            'safety_points': [{
-                'lat': sp.lat,
-                'lon': sp.lon,
-                'radius': sp.radius,
-                'safety_index': sp.safety_index,
-                'weight': sp.weight
-            } for sp in req.safety_points],
+            'safety_points': serialize_safety_points(req.safety_points),
             'optimization': req.optimization,
             'heuristic': req.heuristic,
             'distance_weight': req.distance_weight,
             'time_weight': req.time_weight,
-            'safety_weight': req.safety_weight
+            'safety_weight': req.safety_weight,
+            'engine': req.engine,
+            'region_id': req.region_id,
+            'search': req.search,
+            'safety_layer': req.safety_layer,
+            'corridor': req.corridor
         }
         
-        # Iniciar hilo con el cálculo
-        thread = Thread(
-            target=background_task,
-            args=(processor, request_dict, task_id, cache_key)
-        )
-        thread.start()
+        # Encolar el cálculo (o adjuntarlo a uno idéntico en curso)
+        try:
+            position = submit_task(task_id, cache_key, request_dict, **task_fields)
+        except QueueFullError as e:
+            return queue_full_response(e)
         
         return jsonify({
             "status": "processing",
             "task_id": task_id,
-            "message": "El cálculo de la ruta está en progreso"
+            "queue_position": position,
+            "warming": warming,
+            "message": ("La región se está cargando; la ruta se calculará en cuanto esté lista" if warming
+                        else "El cálculo de la ruta está en progreso")
         })
         
     except Exception as e:
@@ -256,31 +532,319 @@ def calculate_route():
         return jsonify({"error": str(e)}), 400
     
 
+@app.route('/route-matrix', methods=['POST'])
+def route_matrix():
+    """
+    Rutas para muchos pares origen/destino en una sola tarea. Con "pairs" ([[i, j], ...])
+    se calculan esos pares; sin él, la matriz completa origins x destinations.
+    El resultado se consulta igual que una ruta, en /route-result/<task_id>.
+    """
+    try:
+        data = request.get_json()
+        
+        origins = [{'lat': float(p['lat']), 'lon': float(p['lon'])} for p in data['origins']]
+        destinations = [{'lat': float(p['lat']), 'lon': float(p['lon'])} for p in data['destinations']]
+        if not origins or not destinations:
+            return jsonify({"error": "'origins' y 'destinations' deben traer al menos un punto"}), 400
+        if len(origins) + len(destinations) > MAX_MATRIX_POINTS:
+            return jsonify({"error": f"Demasiados puntos ({len(origins) + len(destinations)}); "
+                                     f"el máximo es {MAX_MATRIX_POINTS}"}), 400
+        pairs = data.get('pairs')
+        if pairs is not None:
+            pairs = [[int(i), int(j)] for i, j in pairs]
+            if not pairs:
+                return jsonify({"error": "'pairs' debe traer al menos un par"}), 400
+            if any(not (0 <= i < len(origins) and 0 <= j < len(destinations)) for i, j in pairs):
+                return jsonify({"error": "Índice de origen o destino fuera de rango en 'pairs'"}), 400
+        pair_count = len(pairs) if pairs is not None else len(origins) * len(destinations)
+        if pair_count > MAX_MATRIX_PAIRS:
+            return jsonify({"error": f"Demasiados pares ({pair_count}); el máximo es {MAX_MATRIX_PAIRS}"}), 400
+        
+        region_id = data.get('region_id') or registry.default_region
+        if not preloader.warming(region_id):
+            try:
+                registry.get(region_id)
+            except KeyError as e:
+                return jsonify({"error": str(e.args[0])}), 400
+        
+        request_dict = {
+            'task': 'matrix',
+            'origins': origins,
+            'destinations': destinations,
+            'pairs': pairs,
+            'safety_points': serialize_safety_points(data.get('safety_points', [])),
+            'optimization': data.get('optimization', 'balanced'),
+            'distance_weight': data.get('distance_weight', 0.4),
+            'time_weight': data.get('time_weight', 0.3),
+            'safety_weight': data.get('safety_weight', 0.3),
+            'geometry': bool(data.get('geometry', False)),
+            'region_id': region_id,
+            'safety_layer': layer_version(data.get('safety_layer'))
+        }
+        cache_key = "matrix_" + hashlib.sha1(json.dumps(request_dict, sort_keys=True).encode()).hexdigest()
+        
+        task_id = str(uuid.uuid4())
+        if route_cache.has_result(cache_key):
+            return cached_task_response(task_id, cache_key)
+        
+        try:
+            position = submit_task(task_id, cache_key, request_dict)
+        except QueueFullError as e:
+            return queue_full_response(e)
+        
+        return jsonify({
+            "status": "processing",
+            "task_id": task_id,
+            "queue_position": position,
+            "pairs": pair_count,
+            "message": "El cálculo de la matriz está en progreso"
+        })
+        
+    except Exception as e:
+        logger.error(f"Error al iniciar cálculo de matriz: {str(e)}\n{traceback.format_exc()}")
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/isochrone', methods=['POST'])
+def isochrone():
+    """
+    Zonas alcanzables desde un punto dentro de varios cortes ("cutoffs") de tiempo
+    (minutos) o distancia (metros), con el modelo de costo de la optimización pedida.
+    La caché se indexa por el nodo de origen ajustado y los parámetros.
+    El resultado se consulta igual que una ruta, en /route-result/<task_id>.
+    """
+    try:
+        data = request.get_json()
+        
+        cutoffs = data['cutoffs']
+        if not isinstance(cutoffs, list):
+            cutoffs = [cutoffs]
+        cutoffs = sorted({float(cutoff) for cutoff in cutoffs})
+        if not cutoffs or cutoffs[0] <= 0:
+            return jsonify({"error": "'cutoffs' debe traer al menos un corte positivo"}), 400
+        if len(cutoffs) > MAX_ISOCHRONE_CUTOFFS:
+            return jsonify({"error": f"Demasiados cortes ({len(cutoffs)}); el máximo es {MAX_ISOCHRONE_CUTOFFS}"}), 400
+        
+        optimization = data.get('optimization', 'fastest')
+        metric = data.get('metric', 'distance' if optimization == 'shortest' else 'time')
+        if metric not in ('time', 'distance'):
+            return jsonify({"error": "'metric' debe ser \"time\" (minutos) o \"distance\" (metros)"}), 400
+        output = data.get('output', 'polygon')
+        if output not in ('polygon', 'nodes'):
+            return jsonify({"error": "'output' debe ser \"polygon\" o \"nodes\""}), 400
+        
+        region_id = data.get('region_id') or registry.default_region
+        processor = None
+        if not preloader.warming(region_id):
+            try:
+                processor = registry.get(region_id)
+            except KeyError as e:
+                return jsonify({"error": str(e.args[0])}), 400
+        
+        request_dict = {
+            'task': 'isochrone',
+            'lat': float(data['lat']),
+            'lon': float(data['lon']),
+            'cutoffs': cutoffs,
+            'metric': metric,
+            'output': output,
+            'safety_points': serialize_safety_points(data.get('safety_points', [])),
+            'optimization': optimization,
+            'distance_weight': data.get('distance_weight', 0.4),
+            'time_weight': data.get('time_weight', 0.3),
+            'safety_weight': data.get('safety_weight', 0.3),
+            'region_id': region_id,
+            'safety_layer': layer_version(data.get('safety_layer'))
+        }
+        # Dos puntos que caen en el mismo nodo comparten el resultado; durante la
+        # precarga la región no está en memoria y se usan las coordenadas
+        key_fields = {key: value for key, value in request_dict.items() if key not in ('lat', 'lon')}
+        if processor is not None:
+            key_fields['origin'] = processor.snap_coordinates([request_dict['lat']], [request_dict['lon']])[0]
+        else:
+            key_fields['origin'] = [round(request_dict['lat'], 6), round(request_dict['lon'], 6)]
+        cache_key = "isochrone_" + hashlib.sha1(json.dumps(key_fields, sort_keys=True).encode()).hexdigest()
+        
+        task_id = str(uuid.uuid4())
+        if route_cache.has_result(cache_key):
+            return cached_task_response(task_id, cache_key)
+        
+        try:
+            position = submit_task(task_id, cache_key, request_dict)
+        except QueueFullError as e:
+            return queue_full_response(e)
+        
+        return jsonify({
+            "status": "processing",
+            "task_id": task_id,
+            "queue_position": position,
+            "message": "El cálculo de la isócrona está en progreso"
+        })
+        
+    except Exception as e:
+        logger.error(f"Error al iniciar cálculo de isócrona: {str(e)}\n{traceback.format_exc()}")
+        return jsonify({"error": str(e)}), 400
+
+def zone_response(zone_id: str, zone: dict) -> dict:
+    return {"id": zone_id, **zone}
+
+@app.route('/safety-zones', methods=['GET'])
+def list_safety_zones():
+    """Zonas de la capa de seguridad en la versión actual o en ?version=N"""
+    try:
+        version, zones = safety_layer.zones(request.args.get('version', type=int))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({
+        "version": version,
+        "zones": [zone_response(zone_id, zone) for zone_id, zone in zones.items()]
+    })
+
+@app.route('/safety-zones', methods=['POST'])
+def add_safety_zone():
+    """Agrega una zona (lat, lon, radius, safety_index, weight opcional, id opcional)"""
+    try:
+        version, zone_id = safety_layer.add(request.get_json())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"status": "success", "version": version, "id": zone_id})
+
+@app.route('/safety-zones/<zone_id>', methods=['PUT', 'PATCH'])
+def update_safety_zone(zone_id: str):
+    """Modifica los campos enviados de una zona existente"""
+    try:
+        version = safety_layer.update(zone_id, request.get_json())
+    except KeyError:
+        return jsonify({"error": f"Zona de seguridad desconocida: {zone_id}"}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"status": "success", "version": version, "id": zone_id})
+
+@app.route('/safety-zones/<zone_id>', methods=['DELETE'])
+def remove_safety_zone(zone_id: str):
+    try:
+        version = safety_layer.remove(zone_id)
+    except KeyError:
+        return jsonify({"error": f"Zona de seguridad desconocida: {zone_id}"}), 404
+    return jsonify({"status": "success", "version": version, "id": zone_id})
+
+@app.route('/safety-zones/import', methods=['POST'])
+def import_safety_zones():
+    """
+    Importa muchas zonas en una sola versión: {"zones": [...], "replace": false}.
+    Con "replace" la capa queda exactamente con las zonas enviadas.
+    """
+    try:
+        data = request.get_json()
+        version, ids = safety_layer.import_zones(data['zones'], replace=bool(data.get('replace', False)))
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"status": "success", "version": version, "imported": len(ids)})
+
+@app.route('/safety-zones/versions', methods=['GET'])
+def safety_layer_history():
+    return jsonify({"version": safety_layer.version, "versions": safety_layer.history()})
+
+def task_result(task, args):
+    """
+    Cuerpo y código HTTP del resultado de una tarea (404 si sigue en proceso o expiró).
+    Con ?segments=1 se incluye el detalle por segmento y con ?format=full el formato expandido.
+    """
+    if task is not None:
+        if task['status'] == 'failed':
+            return {"error": task['error']}, 400
+        if task['status'] == 'completed':
+            # Entregar un resultado ya calculado no es una consulta de caché
+            result = route_cache.get_result(task['cache_key'], record=False)
+            if result is not None:
+                if 'connectors' in task:
+                    result = dict(result, connectors=task['connectors'])
+                return format_route(
+                    result,
+                    segments=args.get('segments', '').lower() in ('1', 'true', 'yes'),
+                    full=args.get('format') == 'full'
+                ), 200
+    
+    return {
+        "error": "Resultado no encontrado. La tarea puede estar todavía en procesamiento o haber expirado."
+    }, 404
+
 @app.route('/route-result/<task_id>', methods=['GET'])
 def get_route_result(task_id: str):
-    with cache_lock:
-        if task_id in route_cache:
-            result = route_cache[task_id]
-            if "error" in result:
-                return jsonify({"error": result["error"]}), 400
-            return jsonify(result)
+    """Resultado de una tarea. Con ?wait=<segundos> espera a que termine (long-poll)"""
+    wait = min(request.args.get('wait', 0, type=float), LONG_POLL_TIMEOUT)
+    if wait > 0:
+        task = route_cache.wait_task(task_id, wait)
+    else:
+        task = route_cache.get_task(task_id)
     
-    return jsonify({
-        "error": "Resultado no encontrado. La tarea puede estar todavía en procesamiento o haber expirado."
-    }), 404
+    body, status = task_result(task, request.args)
+    return jsonify(body), status
+
+@app.route('/route-events/<task_id>', methods=['GET'])
+def route_events(task_id: str):
+    """
+    Stream SSE de una tarea: envía un evento "completed" o "failed" con el resultado
+    en cuanto termina. Si la tarea no existe o se agota el tiempo se cierra el stream
+    y el cliente vuelve a consultar /route-result.
+    """
+    args = request.args.copy()
+    
+    def stream():
+        deadline = time.time() + SSE_STREAM_TIMEOUT
+        while time.time() < deadline:
+            task = route_cache.wait_task(task_id, min(SSE_KEEPALIVE, max(0, deadline - time.time())))
+            if task is None:
+                yield "event: missing\ndata: {}\n\n"
+                return
+            if task['status'] in RouteCache.FINAL_STATUSES:
+                body, status = task_result(task, args)
+                event = "completed" if status == 200 else "failed"
+                yield f"event: {event}\ndata: {json.dumps(body)}\n\n"
+                return
+            yield ": processing\n\n"
+    
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/health', methods=['GET'])
+def health():
+    """El proceso responde (no implica que las regiones estén cargadas)"""
+    return jsonify({"status": "ok", "uptime": time.time() - preloader.started})
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Listo para calcular rutas: 503 mientras se precargan las regiones configuradas"""
+    status = preloader.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/metrics', methods=['GET'])
+def export_metrics():
+    """Métricas en el formato de texto de Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.after_request
+def compress_response(response):
+    """Comprime con gzip las respuestas JSON grandes si el cliente lo acepta"""
+    if (response.direct_passthrough or response.is_streamed
+            or response.mimetype != 'application/json'
+            or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.headers.get('Accept-Encoding', '').lower()):
+        return response
+    
+    data = response.get_data()
+    if len(data) < GZIP_MIN_BYTES:
+        return response
+    
+    response.set_data(gzip.compress(data, compresslevel=5))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
 
 @app.route('/')
 def root():
     return render_template('index.html')
 
-# Añadir al final del archivo
-@app.teardown_appcontext
-def shutdown_handler(exception=None):
-    """Guardar cache al cerrar la aplicación"""
-    with cache_lock:
-        with open(CACHE_FILE, 'w') as f:
-            json.dump(route_cache, f)
-    logger.info("Aplicación cerrada - Cache guardado")
-
 if __name__ == '__main__':
     app.run(debug=True, threaded=True)
\ No newline at end of file
@@ -0,0 +1,379 @@
+"""
+Benchmarks reproducibles sin acceso a red: construyen grafos sintéticos con los
+atributos que produce osmnx (x, y, length, maxspeed, highway) y miden el cálculo
+de rutas, el ajuste de coordenadas, guardar/cargar grafos y la caché de la API.
+
+    python benchmark.py --sizes 30 60 --routes 20 --output resultados.json
+
+El resultado es JSON para poder comparar entre versiones.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import networkx as nx
+import numpy as np
+
+from osm_processor import OSMProcessor
+
+logger = logging.getLogger(__name__)
+
+ORIGIN = (19.948, -99.539)  # esquina suroeste de los grafos sintéticos
+METERS_PER_DEGREE_LAT = 111000
+OPTIMIZATIONS = ("shortest", "fastest", "safest", "balanced")
+HEURISTICS = ("euclidean", "manhattan", "landmarks")
+SEARCHES = ("astar", "bidirectional", "ch")  # "ch" usa A* si el grafo no tiene jerarquías
+HIGHWAYS = ("residential", "residential", "tertiary", "secondary", "primary")
+MAXSPEEDS = ("30", "40", "50", "60", "80", "30 mph", "50;40", None)
+
+
+# --- Grafos sintéticos --------------------------------------------------------
+
+def _edge_length(graph: nx.MultiDiGraph, u: int, v: int) -> float:
+    """Distancia en metros entre dos nodos, ligeramente mayor que la línea recta como en una calle real"""
+    lat_u, lon_u = graph.nodes[u]['y'], graph.nodes[u]['x']
+    lat_v, lon_v = graph.nodes[v]['y'], graph.nodes[v]['x']
+    dx = (lon_v - lon_u) * 111320 * math.cos(math.radians(lat_u))
+    dy = (lat_v - lat_u) * METERS_PER_DEGREE_LAT
+    return math.hypot(dx, dy) * 1.05
+
+
+def _add_street(graph: nx.MultiDiGraph, rnd: random.Random, u: int, v: int, oneway_fraction: float):
+    highway = rnd.choice(HIGHWAYS)
+    maxspeed = rnd.choice(MAXSPEEDS)
+    attributes = {'highway': highway}
+    if maxspeed is not None:
+        attributes['maxspeed'] = maxspeed
+    graph.add_edge(u, v, 0, length=_edge_length(graph, u, v), **attributes)
+    if rnd.random() >= oneway_fraction:
+        graph.add_edge(v, u, 0, length=_edge_length(graph, v, u), **attributes)
+
+
+def grid_graph(side: int, seed: int = 0, oneway_fraction: float = 0.15) -> nx.MultiDiGraph:
+    """Cuadrícula side x side con cuadras de ~110 m, coordenadas perturbadas y calles de un sentido"""
+    rnd = random.Random(seed)
+    graph = nx.MultiDiGraph(crs="epsg:4326")
+    for i in range(side):
+        for j in range(side):
+            graph.add_node(
+                i * side + j,
+                y=ORIGIN[0] + i * 0.001 + rnd.uniform(-2e-4, 2e-4),
+                x=ORIGIN[1] + j * 0.001 + rnd.uniform(-2e-4, 2e-4)
+            )
+    for i in range(side):
+        for j in range(side):
+            if j + 1 < side:
+                _add_street(graph, rnd, i * side + j, i * side + j + 1, oneway_fraction)
+            if i + 1 < side:
+                _add_street(graph, rnd, i * side + j, (i + 1) * side + j, oneway_fraction)
+    return graph
+
+
+def random_planar_graph(num_nodes: int, seed: int = 0, oneway_fraction: float = 0.15) -> nx.MultiDiGraph:
+    """Triangulación de Delaunay sobre puntos aleatorios: una red irregular y plana"""
+    from scipy.spatial import Delaunay
+
+    rnd = random.Random(seed)
+    side = math.sqrt(num_nodes) * 0.001
+    points = np.array([(rnd.uniform(0, side), rnd.uniform(0, side)) for _ in range(num_nodes)])
+    graph = nx.MultiDiGraph(crs="epsg:4326")
+    for i, (dy, dx) in enumerate(points.tolist()):
+        graph.add_node(i, y=ORIGIN[0] + dy, x=ORIGIN[1] + dx)
+
+    edges = set()
+    for simplex in Delaunay(points).simplices.tolist():
+        for a, b in ((simplex[0], simplex[1]), (simplex[1], simplex[2]), (simplex[0], simplex[2])):
+            edges.add((min(a, b), max(a, b)))
+    for u, v in sorted(edges):
+        _add_street(graph, rnd, u, v, oneway_fraction)
+    return graph
+
+
+GRAPH_BUILDERS = {'grid': lambda size, seed: grid_graph(size, seed),
+                  'planar': lambda size, seed: random_planar_graph(size * size, seed)}
+
+
+def install_graph(processor: OSMProcessor, graph: nx.MultiDiGraph):
+    """Instala una copia del grafo con maxspeed normalizado, como download_map antes de compilar"""
+    graph = graph.copy()
+    processor._normalize_speeds(graph)
+    processor.graph = graph
+
+
+# --- Medición -----------------------------------------------------------------
+
+def timed(func: Callable, repeat: int = 1) -> List[float]:
+    """Tiempos en segundos de `repeat` ejecuciones de func"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def summarize(times: List[float]) -> Dict:
+    ordered = sorted(times)
+    return {
+        'runs': len(ordered),
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'p50_ms': ordered[len(ordered) // 2] * 1000,
+        'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        'max_ms': ordered[-1] * 1000
+    }
+
+
+def random_points(processor: OSMProcessor, count: int, rnd: random.Random) -> List[tuple]:
+    """Coordenadas aleatorias dentro de la caja del grafo"""
+    compiled = processor.compiled
+    lat_min, lat_max = float(compiled.lat.min()), float(compiled.lat.max())
+    lon_min, lon_max = float(compiled.lon.min()), float(compiled.lon.max())
+    return [(rnd.uniform(lat_min, lat_max), rnd.uniform(lon_min, lon_max)) for _ in range(count)]
+
+
+def safety_points(processor: OSMProcessor, rnd: random.Random, count: int = 3) -> List[Dict]:
+    return [
+        {'lat': lat, 'lon': lon, 'radius': rnd.choice([200, 400, 600]),
+         'safety_index': rnd.randint(1, 5), 'weight': 1.0}
+        for lat, lon in random_points(processor, count, rnd)
+    ]
+
+
+def route_request(start, end, optimization: str, heuristic: str, points: List[Dict],
+                  search: str = 'astar') -> Dict:
+    return {
+        'start_lat': start[0], 'start_lon': start[1],
+        'end_lat': end[0], 'end_lon': end[1],
+        'optimization': optimization,
+        'heuristic': heuristic,
+        'distance_weight': 0.4, 'time_weight': 0.3, 'safety_weight': 0.3,
+        'safety_points': points,
+        'search': search
+    }
+
+
+def bench_routes(processor: OSMProcessor, routes: int, seed: int) -> List[Dict]:
+    """
+    calculate_route_task para cada algoritmo x optimización x heurística, con y sin
+    puntos de seguridad. "ch" sólo se mide en las optimizaciones que tienen jerarquía.
+    """
+    results = []
+    for with_safety in (False, True):
+        rnd = random.Random(seed)
+        pairs = list(zip(random_points(processor, routes, rnd), random_points(processor, routes, rnd)))
+        points = safety_points(processor, rnd) if with_safety else []
+        for search in SEARCHES:
+            for optimization in OPTIMIZATIONS:
+                if search == "ch" and optimization not in OSMProcessor.HIERARCHY_METRICS:
+                    continue
+                for heuristic in HEURISTICS:
+                    times, expanded, failed = [], [], 0
+                    for start, end in pairs:
+                        request = route_request(start, end, optimization, heuristic, points, search)
+                        begin = time.perf_counter()
+                        result = processor.calculate_route_task(request)
+                        times.append(time.perf_counter() - begin)
+                        if result['status'] != 'completed':
+                            failed += 1
+                        elif result['metadata'].get('nodes_expanded') is not None:
+                            expanded.append(result['metadata']['nodes_expanded'])
+                    results.append({
+                        'benchmark': 'calculate_route_task',
+                        'params': {'search': search, 'optimization': optimization, 'heuristic': heuristic,
+                                   'safety_points': len(points)},
+                        'failed': failed,
+                        'nodes_expanded_mean': statistics.fmean(expanded) if expanded else None,
+                        **summarize(times)
+                    })
+    return results
+
+
+def route_cost(summary: Dict, optimization: str) -> float:
+    """Costo de una ruta según su optimización, a partir del resumen (pesos de route_request)"""
+    if optimization == "shortest":
+        return summary['total_distance']
+    if optimization == "fastest":
+        return summary['total_time']
+    if optimization == "safest":
+        return summary['total_safety']
+    return summary['total_distance'] / 1000 * 0.4 + summary['total_time'] * 3600 * 0.3 + summary['total_safety'] * 0.3
+
+
+def check_searches(processor: OSMProcessor, routes: int, seed: int) -> Dict:
+    """
+    Compara el costo de la ruta de cada algoritmo contra A* en los mismos pares,
+    incluido un par cuyo origen y destino caen en el mismo nodo (ruta vacía). A*
+    usa landmarks, cota admisible en toda optimización (la euclidiana no lo es en safest).
+    """
+    rnd = random.Random(seed)
+    pairs = list(zip(random_points(processor, routes, rnd), random_points(processor, routes, rnd)))
+    pairs.append((pairs[0][0], pairs[0][0]))
+    points = safety_points(processor, rnd)
+    mismatches = []
+    for optimization in OPTIMIZATIONS:
+        for start, end in pairs:
+            request = route_request(start, end, optimization, 'landmarks', points)
+            reference = processor.calculate_route_task(request)
+            for search in SEARCHES[1:]:
+                result = processor.calculate_route_task(dict(request, search=search))
+                if result['status'] != reference['status'] or (
+                        result['status'] == 'completed' and
+                        not math.isclose(route_cost(result['summary'], optimization),
+                                         route_cost(reference['summary'], optimization),
+                                         rel_tol=1e-6, abs_tol=1e-6)):
+                    mismatches.append({'optimization': optimization, 'search': search, 'start': start, 'end': end})
+    if mismatches:
+        logger.warning(f"{len(mismatches)} rutas difieren de A*")
+    return {'benchmark': 'search_consistency', 'pairs': len(pairs), 'mismatches': mismatches}
+
+
+def bench_snapping(processor: OSMProcessor, seed: int) -> List[Dict]:
+    rnd = random.Random(seed)
+    points = random_points(processor, 1000, rnd)
+    lats, lons = [p[0] for p in points], [p[1] for p in points]
+    single = timed(lambda: [processor.snap_coordinates([lat], [lon]) for lat, lon in points[:200]], repeat=3)
+    batch = timed(lambda: processor.snap_coordinates(lats, lons), repeat=5)
+    return [
+        {'benchmark': 'snap_single', 'params': {'points': 200}, **summarize(single)},
+        {'benchmark': 'snap_batch', 'params': {'points': len(points)}, **summarize(batch)}
+    ]
+
+
+def bench_save_load(processor: OSMProcessor, workdir: Path, landmark_count: int) -> List[Dict]:
+    results = []
+    path = workdir / "save_load"
+    results.append({'benchmark': 'save_graph', **summarize(timed(lambda: processor.save_graph(path), repeat=3))})
+    results.append({'benchmark': 'load_graph', **summarize(
+        timed(lambda: OSMProcessor(landmark_count).load_graph(path), repeat=3)
+    )})
+
+    legacy = workdir / "legacy.json"
+    with open(legacy, 'w') as f:
+        json.dump(nx.node_link_data(processor.graph), f)
+    results.append({'benchmark': 'load_graph_json', **summarize(
+        timed(lambda: OSMProcessor(landmark_count).load_graph(legacy), repeat=1)
+    )})
+    return results
+
+
+def bench_api_cache(graph: nx.MultiDiGraph, workdir: Path, requests: int, seed: int) -> List[Dict]:
+    """Aciertos de caché de /calculate-route a través del cliente de prueba de Flask"""
+    from graph_registry import GraphRegistry
+
+    # La aplicación usa rutas relativas (data/, cache/, api.log): se ejecuta en un directorio temporal
+    api_dir = workdir / "api"
+    api_dir.mkdir()
+    os.chdir(api_dir)
+    place = "benchmark"
+    processor = OSMProcessor()
+    install_graph(processor, graph)
+    processor.save_graph(Path("data/graphs") / GraphRegistry.region_id(place))
+
+    import app as api
+    client = api.app.test_client()
+    client.post('/load-map', json={'place_name': place})
+
+    rnd = random.Random(seed)
+    start, end = random_points(processor, 2, rnd)
+    body = route_request(start, end, 'balanced', 'euclidean', safety_points(processor, rnd))
+    task_id = client.post('/calculate-route', json=body).get_json()['task_id']
+    client.get(f'/route-result/{task_id}?wait=60')
+
+    hits = timed(lambda: client.post('/calculate-route', json=body), repeat=requests)
+    results = timed(lambda: client.get(f'/route-result/{task_id}?segments=1'), repeat=requests)
+    return [
+        {'benchmark': 'api_calculate_route_cache_hit', **summarize(hits)},
+        {'benchmark': 'api_route_result', 'params': {'segments': True}, **summarize(results)}
+    ]
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=Path(__file__).parent, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(sizes: List[int], kinds: List[str], routes: int, seed: int, landmark_count: int) -> Dict:
+    report = {
+        'revision': git_revision(),
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'networkx': nx.__version__,
+        'machine': platform.machine(),
+        'graphs': []
+    }
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind in kinds:
+            for size in sizes:
+                graph = GRAPH_BUILDERS[kind](size, seed)
+                processor = OSMProcessor(landmark_count, contraction_hierarchies=True)
+                install = timed(lambda: install_graph(processor, graph))
+                hierarchies = timed(processor.build_hierarchies)
+                compiled = processor.compiled
+                logger.info(f"Benchmark {kind} {size}: {compiled.num_nodes} nodos, {compiled.num_edges} aristas")
+
+                workdir = Path(tmp) / f"{kind}_{size}"
+                workdir.mkdir()
+                results = [{'benchmark': 'install_graph', **summarize(install)},
+                           {'benchmark': 'build_hierarchies', **summarize(hierarchies)}]
+                results += bench_save_load(processor, workdir, landmark_count)
+                results += bench_snapping(processor, seed)
+                results += bench_routes(processor, routes, seed)
+                results.append(check_searches(processor, routes, seed))
+                report['graphs'].append({
+                    'kind': kind,
+                    'size': size,
+                    'nodes': compiled.num_nodes,
+                    'edges': compiled.num_edges,
+                    'results': results
+                })
+
+        # La API se mide una sola vez, sobre el grafo más grande
+        api_graph = GRAPH_BUILDERS[kinds[0]](max(sizes), seed)
+        try:
+            report['api'] = bench_api_cache(api_graph, Path(tmp), requests=200, seed=seed)
+        finally:
+            os.chdir(cwd)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks de rutas con grafos sintéticos")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 50],
+                        help="lado de la cuadrícula (el grafo plano usa lado² nodos)")
+    parser.add_argument("--kinds", nargs="+", choices=sorted(GRAPH_BUILDERS), default=["grid", "planar"])
+    parser.add_argument("--routes", type=int, default=10, help="pares origen/destino por combinación")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--landmarks", type=int, default=8, help="landmarks por grafo (0 los desactiva)")
+    parser.add_argument("--output", help="archivo JSON de salida (por defecto stdout)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    # El directorio del proyecto debe estar en el path aunque la API cambie de directorio
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+    report = run(args.sizes, args.kinds, args.routes, args.seed, args.landmarks)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
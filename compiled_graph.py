@@ -0,0 +1,508 @@
+import fcntl
+import heapq
+import json
+import logging
+import math
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from itertools import count
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import networkx as nx
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Cerrojo exclusivo entre procesos (flock) sobre `path`. Lo usan los derivados que se
+    guardan junto al grafo para que un solo proceso los calcule y los demás los carguen.
+    """
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class CompiledGraph:
+    """Representación compacta (CSR) de un grafo de carreteras sobre arreglos NumPy"""
+
+    FORMAT_VERSION = 1
+    ARRAYS = ('node_ids', 'node_order', 'lat', 'lon', 'offsets', 'targets', 'edge_length', 'edge_speed')
+
+    def __init__(self, node_ids: np.ndarray, lat: np.ndarray, lon: np.ndarray,
+                 offsets: np.ndarray, targets: np.ndarray,
+                 edge_length: np.ndarray, edge_speed: np.ndarray,
+                 node_order: Optional[np.ndarray] = None):
+        self.node_ids = node_ids        # índice interno -> id OSM
+        self.lat = lat                  # latitud de cada nodo (float64)
+        self.lon = lon                  # longitud de cada nodo (float64)
+        self.offsets = offsets          # aristas de u: offsets[u]:offsets[u + 1]
+        self.targets = targets          # nodo destino de cada arista (int32)
+        self.edge_length = edge_length  # metros
+        self.edge_speed = edge_speed    # km/h
+        # Permutación que ordena node_ids: id OSM -> índice interno con searchsorted
+        self.node_order = node_order if node_order is not None else np.argsort(node_ids).astype(np.int32)
+        self._node_index = None
+        self._edge_sources = None
+        self._reverse = None
+
+    @property
+    def node_index(self) -> dict:
+        """
+        Diccionario id OSM -> índice interno, para lecturas nodo a nodo del motor
+        networkx (se construye sólo si se usa). El resto usa index(), sin diccionario.
+        """
+        if self._node_index is None:
+            self._node_index = {node: i for i, node in enumerate(self.node_ids.tolist())}
+        return self._node_index
+
+    def index(self, node: int) -> int:
+        """Índice interno de un id OSM: búsqueda binaria sobre node_order, guardado con el grafo"""
+        position = int(np.searchsorted(self.node_ids, node, sorter=self.node_order))
+        if position < len(self.node_order):
+            index = int(self.node_order[position])
+            if self.node_ids[index] == node:
+                return index
+        raise KeyError(node)
+
+    def index_of(self, node_ids) -> np.ndarray:
+        """Índices internos de un arreglo de ids OSM"""
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        positions = np.searchsorted(self.node_ids, node_ids, sorter=self.node_order)
+        positions = np.minimum(positions, len(self.node_order) - 1)
+        indices = self.node_order[positions]
+        if not np.array_equal(self.node_ids[indices], node_ids):
+            raise KeyError("Nodo inexistente en el grafo compilado")
+        return indices
+
+    @property
+    def nbytes(self) -> int:
+        """Memoria ocupada por los arreglos del grafo"""
+        return sum(getattr(self, name).nbytes for name in self.ARRAYS)
+
+    @property
+    def num_nodes(self) -> int:
+        return len(self.node_ids)
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.targets)
+
+    @classmethod
+    def from_networkx(cls, graph: nx.MultiDiGraph, default_speed: float = 50) -> "CompiledGraph":
+        """Congela un MultiDiGraph de osmnx en arreglos contiguos"""
+        start = time.time()
+        nodes = list(graph.nodes)
+        node_index = {node: i for i, node in enumerate(nodes)}
+
+        lat = np.fromiter((graph.nodes[n]['y'] for n in nodes), dtype=np.float64, count=len(nodes))
+        lon = np.fromiter((graph.nodes[n]['x'] for n in nodes), dtype=np.float64, count=len(nodes))
+
+        offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+        targets = []
+        lengths = []
+        speeds = []
+        # Una arista por par (u, v), igual que calculate_edge_weight (clave 0)
+        for i, u in enumerate(nodes):
+            for v, keydict in graph.succ[u].items():
+                data = keydict[0] if 0 in keydict else next(iter(keydict.values()))
+                targets.append(node_index[v])
+                lengths.append(data.get('length', 1))
+                try:
+                    speeds.append(float(data.get('maxspeed', default_speed)))
+                except (TypeError, ValueError):
+                    speeds.append(default_speed)
+            offsets[i + 1] = len(targets)
+
+        compiled = cls(
+            node_ids=np.asarray(nodes, dtype=np.int64),
+            lat=lat,
+            lon=lon,
+            offsets=offsets,
+            targets=np.asarray(targets, dtype=np.int32),
+            edge_length=np.asarray(lengths, dtype=np.float64),
+            edge_speed=np.asarray(speeds, dtype=np.float64)
+        )
+        logger.info(f"Grafo compilado: {compiled.num_nodes} nodos, {compiled.num_edges} aristas "
+                    f"en {time.time() - start:.2f} segundos")
+        return compiled
+
+    def save(self, directory) -> None:
+        """
+        Guarda el grafo como arreglos .npy crudos más un encabezado meta.json.
+        Se escribe en un directorio temporal y se renombra al final, bajo un cerrojo
+        junto al directorio para que dos procesos no borren los archivos del otro.
+        """
+        directory = Path(directory)
+        directory.parent.mkdir(parents=True, exist_ok=True)
+        with file_lock(directory.with_name(f".{directory.name}.save.lock")):
+            tmp_dir = directory.with_name(directory.name + ".tmp")
+            if tmp_dir.exists():
+                shutil.rmtree(tmp_dir)
+            tmp_dir.mkdir()
+
+            for name in self.ARRAYS:
+                np.save(tmp_dir / f"{name}.npy", np.ascontiguousarray(getattr(self, name)))
+            with open(tmp_dir / "meta.json", 'w') as f:
+                json.dump({
+                    "format_version": self.FORMAT_VERSION,
+                    "nodes": self.num_nodes,
+                    "edges": self.num_edges,
+                    "arrays": list(self.ARRAYS)
+                }, f)
+
+            if directory.exists():
+                shutil.rmtree(directory)
+            os.replace(tmp_dir, directory)
+
+    @classmethod
+    def load(cls, directory, mmap: bool = True) -> "CompiledGraph":
+        """
+        Carga un grafo guardado con save(). Con mmap=True los arreglos se mapean en
+        memoria de sólo lectura, así varios procesos comparten las mismas páginas.
+        """
+        directory = Path(directory)
+        with open(directory / "meta.json", 'r') as f:
+            meta = json.load(f)
+        if meta.get("format_version") != cls.FORMAT_VERSION:
+            raise ValueError(f"Versión de formato no soportada: {meta.get('format_version')}")
+
+        mmap_mode = 'r' if mmap else None
+        arrays = {name: np.load(directory / f"{name}.npy", mmap_mode=mmap_mode) for name in cls.ARRAYS}
+        return cls(**arrays)
+
+    def to_networkx(self) -> nx.MultiDiGraph:
+        """Reconstruye un MultiDiGraph equivalente (para el motor networkx)"""
+        graph = nx.MultiDiGraph(crs="epsg:4326")
+        node_ids = self.node_ids.tolist()
+        graph.add_nodes_from(
+            (node, {'y': y, 'x': x}) for node, y, x in zip(node_ids, self.lat.tolist(), self.lon.tolist())
+        )
+        sources = self.edge_sources().tolist()
+        graph.add_edges_from(
+            (node_ids[u], node_ids[v], 0, {'length': length, 'maxspeed': speed})
+            for u, v, length, speed in zip(sources, self.targets.tolist(),
+                                           self.edge_length.tolist(), self.edge_speed.tolist())
+        )
+        return graph
+
+    def edge_time(self) -> np.ndarray:
+        """Tiempo de recorrido de cada arista en segundos"""
+        return self.edge_length / np.maximum(0.1, self.edge_speed) * 3.6
+
+    def edge_sources(self) -> np.ndarray:
+        """Nodo origen de cada arista (inverso de offsets, se calcula una vez)"""
+        if self._edge_sources is None:
+            self._edge_sources = np.repeat(np.arange(self.num_nodes, dtype=np.int32), np.diff(self.offsets))
+        return self._edge_sources
+
+    def reverse_adjacency(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Aristas entrantes en formato CSR (se calcula una vez): para el nodo v,
+        `edges[offsets[v]:offsets[v + 1]]` son los índices de las aristas u -> v.
+        """
+        if self._reverse is None:
+            edges = np.argsort(self.targets, kind='stable').astype(np.int64)
+            offsets = np.zeros(self.num_nodes + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.targets, minlength=self.num_nodes), out=offsets[1:])
+            self._reverse = (offsets, edges)
+        return self._reverse
+
+    def edge_index(self, u: int, v: int) -> int:
+        """Índice de la arista u -> v (índices internos)"""
+        first = int(self.offsets[u])
+        position = np.flatnonzero(self.targets[first:self.offsets[u + 1]] == v)
+        if len(position) == 0:
+            raise KeyError(f"No existe la arista {u} -> {v}")
+        return first + int(position[0])
+
+    def corridor_mask(self, source: int, target: int, shape: str, margin: float) -> np.ndarray:
+        """
+        Máscara booleana de los nodos dentro de un corredor entre dos índices internos,
+        calculada sobre los arreglos de coordenadas (proyección plana local, en metros):
+        - "ellipse": elipse con focos en los extremos, suma de distancias <= d + 2 * margin
+        - "bbox":    rectángulo que contiene a ambos extremos ampliado `margin` metros
+        """
+        lat0 = (self.lat[source] + self.lat[target]) / 2
+        scale_x = 111320 * math.cos(math.radians(lat0))
+        x = (self.lon - self.lon[source]) * scale_x
+        y = (self.lat - self.lat[source]) * 111000
+        tx = (self.lon[target] - self.lon[source]) * scale_x
+        ty = (self.lat[target] - self.lat[source]) * 111000
+        if shape == "ellipse":
+            return np.hypot(x, y) + np.hypot(x - tx, y - ty) <= math.hypot(tx, ty) + 2 * margin
+        if shape == "bbox":
+            return ((x >= min(0.0, tx) - margin) & (x <= max(0.0, tx) + margin)
+                    & (y >= min(0.0, ty) - margin) & (y <= max(0.0, ty) + margin))
+        raise ValueError(f"Forma de corredor desconocida: {shape}")
+
+    def astar(self, source: int, target: int, weights, heuristic: Callable[[int], float],
+              stats: Optional[Dict] = None, allowed: Optional[np.ndarray] = None) -> List[int]:
+        """
+        A* sobre índices internos. Reproduce el orden de exploración y desempate
+        de nx.astar_path para devolver la misma ruta. `weights[e]` es el costo de
+        la arista e y `heuristic(i)` la estimación desde el nodo i hasta `target`.
+        Si se pasa `stats` se anotan en él los nodos expandidos y las aristas relajadas.
+        Con `allowed` (máscara booleana por nodo) la búsqueda no sale de esos nodos.
+        """
+        offsets = self.offsets
+        targets = self.targets
+        weights = np.asarray(weights, dtype=np.float64)
+        push = heapq.heappush
+        pop = heapq.heappop
+        c = count()
+
+        queue = [(0, next(c), source, 0, -1)]
+        enqueued = {}  # nodo -> (costo en cola, heurística)
+        explored = {}  # nodo -> padre
+
+        while queue:
+            _, __, curnode, dist, parent = pop(queue)
+
+            if curnode == target:
+                if stats is not None:
+                    stats['nodes_expanded'] = len(explored)
+                    stats['edges_relaxed'] = self._degree_sum(offsets, explored)
+                path = [curnode]
+                node = parent
+                while node != -1:
+                    path.append(node)
+                    node = explored[node]
+                path.reverse()
+                return path
+
+            if curnode in explored:
+                # El origen nunca se vuelve a expandir
+                if explored[curnode] == -1:
+                    continue
+                qcost, h = enqueued[curnode]
+                if qcost < dist:
+                    continue
+
+            explored[curnode] = parent
+
+            first = offsets[curnode]
+            last = offsets[curnode + 1]
+            neighbors = targets[first:last]
+            costs = weights[first:last]
+            if allowed is not None:
+                inside = allowed[neighbors]
+                neighbors, costs = neighbors[inside], costs[inside]
+            for neighbor, cost in zip(neighbors.tolist(), costs.tolist()):
+                ncost = dist + cost
+                if neighbor in enqueued:
+                    qcost, h = enqueued[neighbor]
+                    if qcost <= ncost:
+                        continue
+                else:
+                    h = heuristic(neighbor)
+                enqueued[neighbor] = ncost, h
+                push(queue, (ncost + h, next(c), neighbor, ncost, curnode))
+
+        if stats is not None:
+            stats['nodes_expanded'] = len(explored)
+            stats['edges_relaxed'] = self._degree_sum(offsets, explored)
+        raise nx.NetworkXNoPath(f"Node {self.node_ids[target]} not reachable from {self.node_ids[source]}")
+
+    def bidirectional_search(self, source: int, target: int, weights, potential,
+                             stats: Optional[Dict] = None, allowed: Optional[np.ndarray] = None) -> List[int]:
+        """
+        A* bidireccional sobre índices internos con potenciales promediados: el
+        avance usa `potential[v]` y el retroceso `-potential[v]`, donde
+        potential = (h_destino - h_origen) / 2 con ambas cotas consistentes.
+        Con esos potenciales los costos reducidos de ambas búsquedas coinciden y
+        la búsqueda puede detenerse en cuanto la suma de los mínimos de ambas
+        colas alcanza el mejor camino encontrado. El retroceso recorre las
+        aristas entrantes, así que respeta los sentidos únicos. Con `allowed`
+        ninguna de las dos búsquedas sale de esos nodos.
+        """
+        offsets = self.offsets
+        targets = self.targets
+        sources = self.edge_sources()
+        reverse_offsets, reverse_edges = self.reverse_adjacency()
+        weights = np.asarray(weights, dtype=np.float64)
+        potential = np.asarray(potential, dtype=np.float64).tolist()
+        push = heapq.heappush
+        pop = heapq.heappop
+
+        # Índice 0: búsqueda desde el origen; 1: búsqueda hacia atrás desde el destino
+        dist = ({source: 0.0}, {target: 0.0})
+        parent_edge = ({source: -1}, {target: -1})
+        settled = (set(), set())
+        queues = ([(potential[source], source)], [(-potential[target], target)])
+        sign = (1.0, -1.0)
+        # Origen y destino iguales: el camino vacío ya es óptimo y la búsqueda para en seguida
+        best = 0.0 if source == target else math.inf
+        meeting = source if source == target else -1
+
+        while queues[0] and queues[1]:
+            if queues[0][0][0] + queues[1][0][0] >= best:
+                break
+            # Se avanza por el lado con la frontera más pequeña
+            side = 0 if len(queues[0]) <= len(queues[1]) else 1
+            _, node = pop(queues[side])
+            if node in settled[side]:
+                continue
+            settled[side].add(node)
+            d = dist[side][node]
+            other = dist[1 - side]
+
+            if side == 0:
+                first, last = int(offsets[node]), int(offsets[node + 1])
+                edges = np.arange(first, last)
+                neighbors = targets[first:last]
+                costs = weights[first:last]
+            else:
+                edges = reverse_edges[reverse_offsets[node]:reverse_offsets[node + 1]]
+                neighbors = sources[edges]
+                costs = weights[edges]
+            if allowed is not None:
+                inside = allowed[neighbors]
+                edges, neighbors, costs = edges[inside], neighbors[inside], costs[inside]
+
+            for e, neighbor, cost in zip(edges.tolist(), neighbors.tolist(), costs.tolist()):
+                nd = d + cost
+                if nd < dist[side].get(neighbor, math.inf):
+                    dist[side][neighbor] = nd
+                    parent_edge[side][neighbor] = e
+                    push(queues[side], (nd + sign[side] * potential[neighbor], neighbor))
+                    if neighbor in other and nd + other[neighbor] < best:
+                        best = nd + other[neighbor]
+                        meeting = neighbor
+
+        if stats is not None:
+            stats['nodes_expanded_forward'] = len(settled[0])
+            stats['nodes_expanded_backward'] = len(settled[1])
+            stats['nodes_expanded'] = len(settled[0]) + len(settled[1])
+            stats['edges_relaxed'] = (self._degree_sum(offsets, settled[0])
+                                      + self._degree_sum(reverse_offsets, settled[1]))
+        if meeting < 0:
+            raise nx.NetworkXNoPath(f"Node {self.node_ids[target]} not reachable from {self.node_ids[source]}")
+
+        path = [meeting]
+        while parent_edge[0][path[-1]] != -1:
+            path.append(int(sources[parent_edge[0][path[-1]]]))
+        path.reverse()
+        node = meeting
+        while parent_edge[1][node] != -1:
+            node = int(targets[parent_edge[1][node]])
+            path.append(node)
+        return path
+
+    @staticmethod
+    def _degree_sum(offsets: np.ndarray, nodes) -> int:
+        """Aristas recorridas al expandir `nodes` en un CSR con esos offsets"""
+        nodes = np.fromiter(nodes, dtype=np.int64, count=len(nodes))
+        return int((offsets[nodes + 1] - offsets[nodes]).sum())
+
+    def shortest_path_tree(self, source: int, weights, targets=None,
+                           cutoff: Optional[float] = None) -> Tuple[Dict[int, float], Dict[int, int]]:
+        """
+        Dijkstra uno-a-muchos desde `source`. Se detiene al asentar todos los `targets`
+        (si se indican) o al superar `cutoff`. Devuelve el costo de cada nodo asentado
+        y la arista por la que se llegó a cada nodo alcanzado (-1 para el origen).
+        """
+        offsets = self.offsets
+        targets_array = self.targets
+        weights = np.asarray(weights, dtype=np.float64)
+        push = heapq.heappush
+        pop = heapq.heappop
+
+        settled = {}
+        best = {source: 0.0}
+        parent_edge = {source: -1}
+        remaining = set(targets) if targets is not None else None
+        queue = [(0.0, source)]
+
+        while queue:
+            dist, curnode = pop(queue)
+            if curnode in settled:
+                continue
+            if cutoff is not None and dist > cutoff:
+                break
+            settled[curnode] = dist
+
+            if remaining is not None:
+                remaining.discard(curnode)
+                if not remaining:
+                    break
+
+            first = offsets[curnode]
+            last = offsets[curnode + 1]
+            for e, (neighbor, cost) in enumerate(zip(targets_array[first:last].tolist(),
+                                                     weights[first:last].tolist()), first):
+                ncost = dist + cost
+                if ncost < best.get(neighbor, math.inf):
+                    best[neighbor] = ncost
+                    parent_edge[neighbor] = e
+                    push(queue, (ncost, neighbor))
+
+        return settled, parent_edge
+
+    def reachable_within(self, source: int, weights, measure, limit: float,
+                         stats: Optional[Dict] = None) -> Dict[int, float]:
+        """
+        Dijkstra uno-a-todos desde `source` por `weights` que acumula además `measure`
+        (metros, minutos...) a lo largo del camino de menor costo. Devuelve ese acumulado
+        para cada nodo en que no supera `limit`. Como `measure` no decrece a lo largo de
+        un camino, la búsqueda termina cuando en la cola no queda ninguna entrada dentro
+        del límite; con measure igual a weights es un Dijkstra con corte ordinario.
+        """
+        offsets = self.offsets
+        targets = self.targets
+        weights = np.asarray(weights, dtype=np.float64)
+        measure = np.asarray(measure, dtype=np.float64)
+        push = heapq.heappush
+        pop = heapq.heappop
+
+        best = {source: 0.0}
+        settled = set()
+        reached = {}
+        queue = [(0.0, 0.0, source)]
+        inside = 1  # entradas de la cola con acumulado dentro del límite
+
+        while queue and inside:
+            dist, amount, curnode = pop(queue)
+            if amount <= limit:
+                inside -= 1
+            if curnode in settled:
+                continue
+            settled.add(curnode)
+            if amount <= limit:
+                reached[curnode] = amount
+
+            first = offsets[curnode]
+            last = offsets[curnode + 1]
+            for neighbor, cost, step in zip(targets[first:last].tolist(), weights[first:last].tolist(),
+                                            measure[first:last].tolist()):
+                ncost = dist + cost
+                if ncost < best.get(neighbor, math.inf):
+                    best[neighbor] = ncost
+                    namount = amount + step
+                    if namount <= limit:
+                        inside += 1
+                    push(queue, (ncost, namount, neighbor))
+
+        if stats is not None:
+            stats['nodes_expanded'] = len(settled)
+            stats['edges_relaxed'] = self._degree_sum(offsets, settled)
+        return reached
+
+    def tree_path_edges(self, parent_edge: Dict[int, int], target: int) -> List[int]:
+        """Aristas (en orden) del camino hasta `target` dentro de un árbol de shortest_path_tree"""
+        sources = self.edge_sources()
+        edges = []
+        e = parent_edge[target]
+        while e != -1:
+            edges.append(int(e))
+            e = parent_edge[int(sources[e])]
+        edges.reverse()
+        return edges
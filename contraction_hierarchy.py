@@ -0,0 +1,294 @@
+import heapq
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import networkx as nx
+import numpy as np
+
+from compiled_graph import CompiledGraph
+
+logger = logging.getLogger(__name__)
+
+
+class ContractionHierarchy:
+    """
+    Jerarquía de contracción para una métrica estática (longitud o tiempo de viaje).
+    Los nodos se contraen en orden de importancia agregando atajos que preservan
+    las distancias; una consulta es un Dijkstra bidireccional que sólo sube de rango.
+
+    Las aristas se guardan en dos grafos CSR "hacia arriba":
+    - up:   aristas u -> v con rank[v] > rank[u], indexadas por u (búsqueda desde el origen)
+    - down: aristas u -> v con rank[u] > rank[v], indexadas por v (búsqueda desde el destino)
+    `middle` es el nodo contraído que representa un atajo, o -1 para una arista original.
+    """
+
+    ARRAYS = ('rank', 'up_offsets', 'up_targets', 'up_weights', 'up_middle',
+              'down_offsets', 'down_targets', 'down_weights', 'down_middle')
+    WITNESS_SETTLE_LIMIT = 64  # nodos por búsqueda de testigos; más allá se agrega el atajo
+
+    def __init__(self, metric: str, arrays: Dict[str, np.ndarray]):
+        self.metric = metric
+        self.rank = arrays['rank']
+        self.up = (arrays['up_offsets'], arrays['up_targets'], arrays['up_weights'], arrays['up_middle'])
+        self.down = (arrays['down_offsets'], arrays['down_targets'], arrays['down_weights'], arrays['down_middle'])
+        self.arrays = arrays
+
+    @classmethod
+    def build(cls, compiled: CompiledGraph, metric: str) -> "ContractionHierarchy":
+        """Contrae todos los nodos del grafo con los pesos de `metric` ('length' o 'time')"""
+        start = time.time()
+        weights = compiled.edge_length if metric == 'length' else compiled.edge_time()
+        n = compiled.num_nodes
+
+        # Grafo de trabajo mutable: out[u][v] / inn[v][u] = (peso, nodo intermedio)
+        out = [dict() for _ in range(n)]
+        inn = [dict() for _ in range(n)]
+        for u, v, w in zip(compiled.edge_sources().tolist(), compiled.targets.tolist(), weights.tolist()):
+            if u != v and (v not in out[u] or w < out[u][v][0]):
+                out[u][v] = (w, -1)
+                inn[v][u] = (w, -1)
+
+        contracted = [False] * n
+        deleted_neighbors = [0] * n
+        level = [0] * n  # profundidad en la jerarquía: 1 + la mayor de los vecinos ya contraídos
+        rank = np.zeros(n, dtype=np.int32)
+        # Aristas definitivas (u, v, peso, intermedio) de cada nodo al contraerlo
+        final_edges = []
+
+        def priority(v: int, shortcuts: list) -> int:
+            # Diferencia de aristas, vecinos ya contraídos y profundidad: reparte la
+            # contracción por todo el grafo y mantiene baja la jerarquía
+            return 2 * (len(shortcuts) - len(out[v]) - len(inn[v])) + deleted_neighbors[v] + level[v]
+
+        # Atajos calculados por nodo; sólo cambian al contraer uno de sus vecinos
+        pending = {v: cls._shortcuts(v, out, inn) for v in range(n)}
+        queue = [(priority(v, shortcuts), v) for v, shortcuts in pending.items()]
+        heapq.heapify(queue)
+        next_rank = 0
+        while queue:
+            _, v = heapq.heappop(queue)
+            if contracted[v]:
+                continue
+            # Actualización perezosa: si la prioridad empeoró se reinserta
+            shortcuts = pending.get(v)
+            if shortcuts is None:
+                shortcuts = pending[v] = cls._shortcuts(v, out, inn)
+            current = priority(v, shortcuts)
+            if queue and current > queue[0][0]:
+                heapq.heappush(queue, (current, v))
+                continue
+
+            for u, x, w in shortcuts:
+                if x not in out[u] or w < out[u][x][0]:
+                    out[u][x] = (w, v)
+                    inn[x][u] = (w, v)
+
+            for x, (w, mid) in out[v].items():
+                final_edges.append((v, x, w, mid))
+                del inn[x][v]
+                deleted_neighbors[x] += 1
+                level[x] = max(level[x], level[v] + 1)
+                pending.pop(x, None)
+            for u, (w, mid) in inn[v].items():
+                final_edges.append((u, v, w, mid))
+                del out[u][v]
+                deleted_neighbors[u] += 1
+                level[u] = max(level[u], level[v] + 1)
+                pending.pop(u, None)
+            del pending[v]
+            out[v] = {}
+            inn[v] = {}
+
+            contracted[v] = True
+            rank[v] = next_rank
+            next_rank += 1
+
+        arrays = {'rank': rank}
+        edges = np.array([(u, v) for u, v, _, _ in final_edges], dtype=np.int64).reshape(-1, 2)
+        edge_weights = np.array([w for _, _, w, _ in final_edges], dtype=np.float64)
+        edge_middle = np.array([m for _, _, _, m in final_edges], dtype=np.int32)
+        upward = rank[edges[:, 1]] > rank[edges[:, 0]]
+        for name, mask, key, other in (('up', upward, 0, 1), ('down', ~upward, 1, 0)):
+            order = np.argsort(edges[mask, key], kind='stable')
+            arrays[f'{name}_offsets'] = np.concatenate(
+                [[0], np.cumsum(np.bincount(edges[mask, key], minlength=n))]
+            ).astype(np.int64)
+            arrays[f'{name}_targets'] = edges[mask, other][order].astype(np.int32)
+            arrays[f'{name}_weights'] = edge_weights[mask][order]
+            arrays[f'{name}_middle'] = edge_middle[mask][order]
+
+        logger.info(f"Jerarquía de contracción ({metric}) construida: {len(final_edges)} aristas, "
+                    f"{len(final_edges) - compiled.num_edges} atajos en {time.time() - start:.2f} segundos")
+        return cls(metric, arrays)
+
+    @classmethod
+    def _shortcuts(cls, v: int, out: List[dict], inn: List[dict]) -> List[Tuple[int, int, float]]:
+        """Atajos (u, x, peso) necesarios al contraer v: los pares sin camino testigo más corto"""
+        shortcuts = []
+        if not out[v]:
+            return shortcuts
+        for u, (w_uv, _) in inn[v].items():
+            targets = {x: w_uv + w_vx for x, (w_vx, _) in out[v].items() if x != u}
+            if not targets:
+                continue
+            witness = cls._witness_search(u, v, targets, max(targets.values()), out)
+            for x, via in targets.items():
+                if witness.get(x, float('inf')) > via:
+                    shortcuts.append((u, x, via))
+        return shortcuts
+
+    @classmethod
+    def _witness_search(cls, source: int, skip: int, targets: Dict[int, float], cutoff: float,
+                        out: List[dict]) -> Dict[int, float]:
+        """
+        Dijkstra local desde `source` sin pasar por `skip`, acotado en costo y en nodos
+        asentados. Sólo recorre nodos sin contraer: sus aristas ya se quitaron del grafo.
+        """
+        dist = {source: 0.0}
+        settled = set()
+        queue = [(0.0, source)]
+        remaining = len(targets)
+        while queue and len(settled) < cls.WITNESS_SETTLE_LIMIT:
+            d, node = heapq.heappop(queue)
+            if node in settled:
+                continue
+            if d > cutoff:
+                break
+            settled.add(node)
+            if node in targets:
+                remaining -= 1
+                if remaining == 0:
+                    break
+            for nxt, (w, _) in out[node].items():
+                if nxt == skip:
+                    continue
+                nd = d + w
+                if nd < dist.get(nxt, float('inf')):
+                    dist[nxt] = nd
+                    heapq.heappush(queue, (nd, nxt))
+        return dist
+
+    def query(self, source: int, target: int, stats: Optional[Dict] = None) -> Tuple[float, List[int]]:
+        """
+        Camino más corto entre índices internos. Devuelve (costo, nodos del camino
+        original ya desempaquetado). Lanza nx.NetworkXNoPath si no hay camino.
+        """
+        if source == target:
+            if stats is not None:
+                stats['nodes_expanded'] = 0
+                stats['edges_relaxed'] = 0
+            return 0.0, [source]
+
+        dist = ({source: 0.0}, {target: 0.0})
+        parent = ({source: -1}, {target: -1})
+        settled = (set(), set())
+        queues = ([(0.0, source)], [(0.0, target)])
+        graphs = (self.up, self.down)
+        best = float('inf')
+        meeting = -1
+
+        while queues[0] or queues[1]:
+            # Alternar direcciones; cada una se detiene cuando ya no puede mejorar `best`
+            for side in (0, 1):
+                queue = queues[side]
+                if not queue:
+                    continue
+                d, node = heapq.heappop(queue)
+                if node in settled[side]:
+                    continue
+                if d >= best:
+                    queue.clear()
+                    continue
+                settled[side].add(node)
+                other = dist[1 - side].get(node)
+                if other is not None and d + other < best:
+                    best = d + other
+                    meeting = node
+
+                offsets, targets, weights, _ = graphs[side]
+                first, last = offsets[node], offsets[node + 1]
+                for nxt, w in zip(targets[first:last].tolist(), weights[first:last].tolist()):
+                    nd = d + w
+                    if nd < dist[side].get(nxt, float('inf')):
+                        dist[side][nxt] = nd
+                        parent[side][nxt] = node
+                        heapq.heappush(queue, (nd, nxt))
+
+        if stats is not None:
+            stats['nodes_expanded'] = len(settled[0]) + len(settled[1])
+            stats['edges_relaxed'] = (CompiledGraph._degree_sum(self.up[0], settled[0])
+                                      + CompiledGraph._degree_sum(self.down[0], settled[1]))
+        if meeting < 0:
+            raise nx.NetworkXNoPath(f"Node {target} not reachable from {source}")
+
+        # Camino en la jerarquía: origen -> punto de encuentro <- destino
+        forward = [meeting]
+        while parent[0][forward[-1]] != -1:
+            forward.append(parent[0][forward[-1]])
+        forward.reverse()
+        backward = []
+        node = meeting
+        while parent[1][node] != -1:
+            node = parent[1][node]
+            backward.append(node)
+        hierarchy_path = forward + backward
+
+        path = [hierarchy_path[0]]
+        for u, v in zip(hierarchy_path, hierarchy_path[1:]):
+            self._unpack(u, v, path)
+        return best, path
+
+    def _edge(self, u: int, v: int) -> Tuple[float, int]:
+        """(peso, intermedio) de la arista u -> v de la jerarquía"""
+        if self.rank[v] > self.rank[u]:
+            offsets, targets, weights, middle = self.up
+            tail, head = u, v
+        else:
+            offsets, targets, weights, middle = self.down
+            tail, head = v, u
+        first, last = offsets[tail], offsets[tail + 1]
+        candidates = first + np.flatnonzero(targets[first:last] == head)
+        e = candidates[np.argmin(weights[candidates])]
+        return float(weights[e]), int(middle[e])
+
+    def _unpack(self, u: int, v: int, path: List[int]):
+        """Agrega a `path` los nodos originales de la arista u -> v (sin u)"""
+        stack = [(u, v)]
+        while stack:
+            a, b = stack.pop()
+            _, mid = self._edge(a, b)
+            if mid < 0:
+                path.append(b)
+            else:
+                # Primero a -> mid, luego mid -> b
+                stack.append((mid, b))
+                stack.append((a, mid))
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def save(self, directory) -> None:
+        """Guarda la jerarquía junto a los arreglos del grafo; `rank` va al final y marca que está completa"""
+        directory = Path(directory)
+        for name in self.ARRAYS[1:] + self.ARRAYS[:1]:
+            tmp = directory / f".ch_{self.metric}_{name}.{os.getpid()}.npy"
+            np.save(tmp, np.asarray(self.arrays[name]))
+            os.replace(tmp, directory / f"ch_{self.metric}_{name}.npy")
+
+    @classmethod
+    def load(cls, directory, metric: str, mmap: bool = True) -> "ContractionHierarchy":
+        directory = Path(directory)
+        mmap_mode = 'r' if mmap else None
+        arrays = {
+            name: np.load(directory / f"ch_{metric}_{name}.npy", mmap_mode=mmap_mode)
+            for name in cls.ARRAYS
+        }
+        return cls(metric, arrays)
+
+    @staticmethod
+    def exists(directory, metric: str) -> bool:
+        return (Path(directory) / f"ch_{metric}_rank.npy").exists()
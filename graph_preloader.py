@@ -0,0 +1,116 @@
+import logging
+import time
+import traceback
+from threading import Condition, Thread
+from typing import Dict, List, Optional
+
+from graph_registry import GraphRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class GraphPreloader:
+    """
+    Carga en segundo plano, al arrancar, las regiones guardadas en disco y precalienta
+    sus índices. Mientras tanto el servicio responde y las rutas de esas regiones se
+    encolan: el cálculo espera a que la región termine de cargar.
+
+    Estados de cada región: "pending", "loading", "ready" o "failed".
+    """
+
+    def __init__(self, registry: GraphRegistry, region_ids: List[str]):
+        self.registry = registry
+        self.region_ids = list(dict.fromkeys(region_ids))
+        self.started = time.time()
+        self.finished = None
+        self._condition = Condition()
+        self._regions = {region_id: {"status": "pending"} for region_id in self.region_ids}
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, registry: GraphRegistry, config: str) -> "GraphPreloader":
+        """Regiones separadas por comas, o "all" para todas las guardadas en disco"""
+        config = (config or "").strip()
+        if config.lower() == "all":
+            region_ids = registry.available()
+        else:
+            region_ids = [region_id.strip() for region_id in config.split(",") if region_id.strip()]
+        return cls(registry, region_ids)
+
+    def start(self) -> "GraphPreloader":
+        # Las rutas sin region_id usan la primera región precargada desde el arranque
+        available = [region_id for region_id in self.region_ids if (self.registry.path_for(region_id) / "meta.json").exists()]
+        if available and self.registry.default_region is None:
+            self.registry.default_region = available[0]
+        if not self.region_ids:
+            self.finished = time.time()
+            return self
+        self._thread = Thread(target=self._run, name="graph-preloader", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        logger.info(f"Precargando {len(self.region_ids)} regiones: {', '.join(self.region_ids)}")
+        for region_id in self.region_ids:
+            self._set(region_id, status="loading", started=time.time())
+            start = time.time()
+            try:
+                processor = self.registry.get(region_id)
+                processor.warm_up()
+                self._set(region_id, status="ready", seconds=time.time() - start,
+                          nodes=processor.compiled.num_nodes, edges=processor.compiled.num_edges)
+                logger.info(f"Región precargada: {region_id} en {time.time() - start:.2f} segundos")
+            except KeyError as e:
+                logger.warning(f"No se pudo precargar la región {region_id}: {e.args[0]}")
+                self._set(region_id, status="failed", seconds=time.time() - start, error=str(e.args[0]))
+            except Exception as e:
+                logger.error(f"No se pudo precargar la región {region_id}: {str(e)}\n{traceback.format_exc()}")
+                self._set(region_id, status="failed", seconds=time.time() - start, error=str(e))
+
+        with self._condition:
+            self.finished = time.time()
+            self._condition.notify_all()
+        logger.info(f"Precarga terminada en {self.finished - self.started:.2f} segundos")
+
+    def _set(self, region_id: str, **fields):
+        with self._condition:
+            self._regions[region_id].update(fields)
+            self._condition.notify_all()
+
+    @property
+    def ready(self) -> bool:
+        """Verdadero cuando todas las regiones configuradas terminaron (bien o con error)"""
+        with self._condition:
+            return self.finished is not None
+
+    def warming(self, region_id: Optional[str]) -> bool:
+        """Verdadero si la región está en la lista de precarga y todavía no termina de cargar"""
+        with self._condition:
+            region = self._regions.get(region_id)
+            return region is not None and region["status"] in ("pending", "loading")
+
+    def wait(self, region_id: str, timeout: Optional[float] = None) -> bool:
+        """Espera a que una región de la precarga termine; devuelve False si se agota el tiempo"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._regions.get(region_id, {}).get("status") in ("pending", "loading"):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def status(self) -> Dict:
+        with self._condition:
+            regions = {region_id: dict(region) for region_id, region in self._regions.items()}
+            finished = self.finished
+        done = sum(1 for region in regions.values() if region["status"] in ("ready", "failed"))
+        return {
+            "ready": finished is not None,
+            "progress": done / len(regions) if regions else 1.0,
+            "loaded": sum(1 for region in regions.values() if region["status"] == "ready"),
+            "failed": sum(1 for region in regions.values() if region["status"] == "failed"),
+            "total": len(regions),
+            "elapsed": (finished or time.time()) - self.started,
+            "regions": regions
+        }
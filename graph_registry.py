@@ -0,0 +1,153 @@
+import logging
+import os
+import re
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+from compiled_graph import file_lock
+from osm_processor import OSMProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class GraphRegistry:
+    """
+    Registro de grafos por región (lugar / tipo de red / simplificación). Mantiene
+    varios grafos residentes a la vez dentro de un presupuesto de memoria, desaloja
+    el menos usado (LRU) y recupera de disco los grafos guardados en sesiones anteriores.
+    La región por defecto se guarda en graphs_dir, así la comparten todos los workers.
+    """
+
+    DEFAULT_REGION_FILE = "default_region"
+
+    def __init__(self, graphs_dir, max_bytes: int = 2 * 1024 ** 3, landmark_count: int = 8,
+                 contraction_hierarchies: bool = False):
+        self.graphs_dir = Path(graphs_dir)
+        self.graphs_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.landmark_count = landmark_count
+        self.contraction_hierarchies = contraction_hierarchies
+        self._regions = OrderedDict()  # region_id -> OSMProcessor
+        self._lock = Lock()
+        self._load_locks = {}  # region_id -> Lock (evita cargar dos veces la misma región)
+
+    @staticmethod
+    def region_id(place_name: str, network_type: str = "drive", simplify: bool = False) -> str:
+        """Identificador estable de una región, usado también como nombre de directorio"""
+        place = unicodedata.normalize("NFKD", place_name).encode("ascii", "ignore").decode()
+        place = re.sub(r"[^a-z0-9]+", "-", place.lower()).strip("-")
+        return f"{place}__{network_type}__{'simplified' if simplify else 'full'}"
+
+    def path_for(self, region_id: str) -> Path:
+        return self.graphs_dir / region_id
+
+    @property
+    def default_region(self) -> Optional[str]:
+        """Última región cargada por cualquier proceso (None si aún no hay ninguna)"""
+        try:
+            return (self.graphs_dir / self.DEFAULT_REGION_FILE).read_text().strip() or None
+        except FileNotFoundError:
+            return None
+
+    @default_region.setter
+    def default_region(self, region_id: Optional[str]):
+        path = self.graphs_dir / self.DEFAULT_REGION_FILE
+        tmp = path.with_name(f".{path.name}.{os.getpid()}")
+        tmp.write_text(region_id or "")
+        os.replace(tmp, path)
+
+    def load(self, place_name: str, network_type: str = "drive", simplify: bool = False) -> Tuple[str, OSMProcessor, str]:
+        """
+        Deja residente la región pedida: desde memoria, desde disco o descargándola.
+        Devuelve (region_id, procesador, origen) con origen en {"memory", "disk", "download"}.
+        """
+        region_id = self.region_id(place_name, network_type, simplify)
+        with self._region_lock(region_id):
+            processor = self._resident(region_id)
+            source = "memory"
+            if processor is None:
+                processor = OSMProcessor(self.landmark_count, self.contraction_hierarchies)
+                path = self.path_for(region_id)
+                # Entre procesos: si otro worker está descargando la región se espera y se carga de disco
+                with file_lock(self.graphs_dir / f".{region_id}.lock"):
+                    if path.exists():
+                        processor.load_graph(path)
+                        source = "disk"
+                    else:
+                        processor.download_map(place_name, simplify, network_type)
+                        processor.save_graph(path)
+                        source = "download"
+                self._add(region_id, processor)
+
+        self.default_region = region_id
+        return region_id, processor, source
+
+    def get(self, region_id: Optional[str] = None) -> OSMProcessor:
+        """
+        Procesador de una región residente; si no lo está pero existe en disco se carga.
+        Sin region_id se usa la última región cargada.
+        """
+        region_id = region_id or self.default_region
+        if region_id is None:
+            raise KeyError("El grafo no ha sido cargado. Primero llama a /load-map")
+
+        processor = self._resident(region_id)
+        if processor is not None:
+            return processor
+
+        path = self.path_for(region_id)
+        if not path.exists():
+            raise KeyError(f"Región desconocida: {region_id}")
+
+        with self._region_lock(region_id):
+            processor = self._resident(region_id)
+            if processor is None:
+                processor = OSMProcessor(self.landmark_count, self.contraction_hierarchies)
+                processor.load_graph(path)
+                self._add(region_id, processor)
+        return processor
+
+    def resident(self) -> List[str]:
+        with self._lock:
+            return list(self._regions)
+
+    def available(self) -> List[str]:
+        """Regiones guardadas en disco"""
+        return sorted(p.name for p in self.graphs_dir.iterdir() if (p / "meta.json").exists())
+
+    def memory_bytes(self) -> int:
+        with self._lock:
+            return sum(processor.memory_bytes() for processor in self._regions.values())
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                region_id: {"nodes": processor.compiled.num_nodes, "bytes": processor.memory_bytes()}
+                for region_id, processor in self._regions.items()
+            }
+
+    def _resident(self, region_id: str) -> Optional[OSMProcessor]:
+        with self._lock:
+            processor = self._regions.get(region_id)
+            if processor is not None:
+                self._regions.move_to_end(region_id)
+            return processor
+
+    def _region_lock(self, region_id: str) -> Lock:
+        with self._lock:
+            return self._load_locks.setdefault(region_id, Lock())
+
+    def _add(self, region_id: str, processor: OSMProcessor):
+        """Registra una región y desaloja las menos usadas si se excede el presupuesto"""
+        with self._lock:
+            self._regions[region_id] = processor
+            self._regions.move_to_end(region_id)
+            total = sum(p.memory_bytes() for p in self._regions.values())
+            # Siempre queda al menos la región recién agregada
+            while total > self.max_bytes and len(self._regions) > 1:
+                evicted_id, evicted = self._regions.popitem(last=False)
+                total -= evicted.memory_bytes()
+                logger.info(f"Región desalojada de memoria: {evicted_id}")
@@ -0,0 +1,127 @@
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from compiled_graph import CompiledGraph
+
+logger = logging.getLogger(__name__)
+
+
+class Landmarks:
+    """
+    Distancias precalculadas desde y hacia un conjunto de nodos de referencia (ALT).
+    Por la desigualdad triangular dan cotas inferiores admisibles para A*:
+    d(v, t) >= d(L, t) - d(L, v)  y  d(v, t) >= d(v, L) - d(t, L).
+    """
+
+    METRICS = ('length', 'time')  # metros y segundos
+
+    def __init__(self, nodes: np.ndarray, distances: Dict[str, np.ndarray]):
+        self.nodes = nodes          # índices internos de los landmarks
+        self.distances = distances  # f"{metric}_from" / f"{metric}_to" -> arreglo (k, n)
+        self._tolerance = {}        # metric -> error máximo por guardar en float32
+
+    @classmethod
+    def build(cls, compiled: CompiledGraph, count: int = 8) -> "Landmarks":
+        """Elige `count` landmarks alejados entre sí y calcula sus distancias por métrica"""
+        start = time.time()
+        nodes = cls._select(compiled, count)
+        n = compiled.num_nodes
+        metric_weights = {'length': compiled.edge_length, 'time': compiled.edge_time()}
+
+        distances = {}
+        for metric, weights in metric_weights.items():
+            matrix = csr_matrix((weights, compiled.targets, compiled.offsets), shape=(n, n))
+            # d(L, v) sobre el grafo dirigido y d(v, L) sobre el grafo invertido
+            distances[f"{metric}_from"] = dijkstra(matrix, indices=nodes).astype(np.float32)
+            distances[f"{metric}_to"] = dijkstra(matrix.T.tocsr(), indices=nodes).astype(np.float32)
+
+        logger.info(f"{len(nodes)} landmarks calculados en {time.time() - start:.2f} segundos")
+        return cls(nodes, distances)
+
+    @staticmethod
+    def _select(compiled: CompiledGraph, count: int) -> np.ndarray:
+        """Selección por punto más lejano sobre las coordenadas, empezando por el más periférico"""
+        count = min(count, compiled.num_nodes)
+        y = compiled.lat
+        x = compiled.lon * np.cos(np.radians(np.mean(compiled.lat)))
+        center_distance = (y - y.mean()) ** 2 + (x - x.mean()) ** 2
+
+        nodes = [int(np.argmax(center_distance))]
+        min_distance = (y - y[nodes[0]]) ** 2 + (x - x[nodes[0]]) ** 2
+        while len(nodes) < count:
+            node = int(np.argmax(min_distance))
+            nodes.append(node)
+            min_distance = np.minimum(min_distance, (y - y[node]) ** 2 + (x - x[node]) ** 2)
+        return np.asarray(nodes, dtype=np.int32)
+
+    def lower_bounds(self, metric: str, node: int, reverse: bool = False) -> np.ndarray:
+        """
+        Cota inferior de la distancia de cada nodo hasta `node` según `metric`;
+        con `reverse` la de la distancia desde `node` hasta cada nodo.
+        """
+        d_from = self.distances[f"{metric}_from"]
+        d_to = self.distances[f"{metric}_to"]
+
+        with np.errstate(invalid='ignore'):
+            forward = d_from[:, node][:, None] - d_from
+            backward = d_to - d_to[:, node][:, None]
+        if reverse:
+            # d(node, v) >= d(L, v) - d(L, node)  y  d(node, v) >= d(node, L) - d(v, L)
+            forward, backward = -forward, -backward
+        # Términos con nodos inalcanzables (inf) no aportan cota
+        forward[~np.isfinite(forward)] = 0
+        backward[~np.isfinite(backward)] = 0
+
+        bounds = np.maximum(forward, backward).max(axis=0).astype(np.float64)
+        # Restar el error de redondeo mantiene la cota admisible
+        return np.maximum(bounds - self._rounding_tolerance(metric), 0)
+
+    def _rounding_tolerance(self, metric: str) -> float:
+        if metric not in self._tolerance:
+            largest = 0.0
+            for direction in ('from', 'to'):
+                d = self.distances[f"{metric}_{direction}"]
+                finite = d[np.isfinite(d)]
+                if finite.size:
+                    largest = max(largest, float(finite.max()))
+            self._tolerance[metric] = 2 * largest * float(np.finfo(np.float32).eps)
+        return self._tolerance[metric]
+
+    @property
+    def nbytes(self) -> int:
+        return self.nodes.nbytes + sum(array.nbytes for array in self.distances.values())
+
+    def save(self, directory) -> None:
+        """
+        Guarda los landmarks junto a los arreglos del grafo. Cada archivo se escribe
+        aparte y se renombra; el de nodos va al final porque marca que están completos.
+        """
+        directory = Path(directory)
+        arrays = {f"landmarks_{name}": array for name, array in self.distances.items()}
+        arrays["landmarks_nodes"] = self.nodes
+        for name, array in arrays.items():
+            tmp = directory / f".{name}.{os.getpid()}.npy"
+            np.save(tmp, np.asarray(array))
+            os.replace(tmp, directory / f"{name}.npy")
+
+    @classmethod
+    def load(cls, directory, mmap: bool = True) -> "Landmarks":
+        directory = Path(directory)
+        mmap_mode = 'r' if mmap else None
+        nodes = np.load(directory / "landmarks_nodes.npy")
+        distances = {
+            f"{metric}_{direction}": np.load(directory / f"landmarks_{metric}_{direction}.npy", mmap_mode=mmap_mode)
+            for metric in cls.METRICS for direction in ('from', 'to')
+        }
+        return cls(nodes, distances)
+
+    @staticmethod
+    def exists(directory) -> bool:
+        return (Path(directory) / "landmarks_nodes.npy").exists()
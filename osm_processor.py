@@ -1,34 +1,195 @@
 import osmnx as ox
 import networkx as nx
+import shapely
+from shapely.geometry import mapping
 import math
 import numpy as np
 import json
 import logging
-from typing import List, Tuple, Dict, Union, Optional
-from functools import lru_cache
-from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Dict, Union, Optional, NamedTuple
+from pathlib import Path
+from collections import OrderedDict
+from threading import Lock, Thread
 import time
+import traceback
+from compiled_graph import CompiledGraph, file_lock
+from spatial_index import SpatialIndex, EARTH_RADIUS_M
+from landmarks import Landmarks
+from contraction_hierarchy import ContractionHierarchy
+from route_encoding import encode_polyline, POLYLINE_PRECISION
 
 logger = logging.getLogger(__name__)
 
+class SafetyZone(NamedTuple):
+    center: int          # id OSM del nodo más cercano al punto de seguridad
+    radius: float
+    safety_index: int
+    weight: float
+
+class RouteContext(NamedTuple):
+    """Parámetros inmutables de una petición; las búsquedas concurrentes no comparten estado mutable"""
+    start_node: int
+    end_node: int
+    optimization: str
+    heuristic: str
+    distance_weight: float
+    time_weight: float
+    safety_weight: float
+    zones: Tuple[SafetyZone, ...]
+
+class SafetyLayerState(NamedTuple):
+    """Capa de seguridad del servidor materializada sobre un grafo en una versión"""
+    version: int
+    zones: Dict[str, SafetyZone]  # zonas que tocan la red, ordenadas por id
+    node_safety: np.ndarray       # suma de influencias por nodo (sin recortar)
+    edge_safety: np.ndarray       # influencia por arista, recortada a 10
+
+# Velocidad por defecto (km/h) según el tipo de vía cuando OSM no trae maxspeed
+HIGHWAY_DEFAULT_SPEEDS = {
+    'motorway': 100,
+    'motorway_link': 60,
+    'trunk': 80,
+    'trunk_link': 50,
+    'primary': 60,
+    'primary_link': 40,
+    'secondary': 50,
+    'secondary_link': 40,
+    'tertiary': 40,
+    'tertiary_link': 30,
+    'unclassified': 30,
+    'residential': 30,
+    'living_street': 10,
+    'service': 20,
+    'road': 30,
+    'track': 15,
+}
+
 class OSMProcessor:
-    def __init__(self):
-        self.graph = None
-        self.safety_zones = []
+    # Métrica estática de cada optimización que puede resolverse con jerarquía de contracción
+    HIERARCHY_METRICS = {'shortest': 'length', 'fastest': 'time'}
+    # Motores y algoritmos de /calculate-route; bidirectional y ch sólo existen sobre el grafo compilado
+    ENGINES = ('compiled', 'networkx')
+    SEARCHES = ('auto', 'astar', 'bidirectional', 'ch')
+    # Corredor de búsqueda: formas, holgura mínima (metros) y factores sobre la distancia
+    # en línea recta con que se ensancha cuando no encuentra camino
+    CORRIDOR_SHAPES = ('ellipse', 'bbox')
+    CORRIDOR_BUFFER_M = 500.0
+    CORRIDOR_FACTORS = (1.25, 1.5, 2.0, 3.0)
+    # Isócronas: unidad de los cortes por métrica y concavidad del polígono (0 = más ajustado)
+    ISOCHRONE_UNITS = {'distance': 'm', 'time': 'min'}
+    ISOCHRONE_HULL_RATIO = 0.2
+    
+    def __init__(self, landmark_count: int = 8, contraction_hierarchies: bool = False):
         self.default_speed = 50  # km/h
-        self.graph_cache = {}  # Cache para grafos procesados
-        self.heuristic_cache = {}  # Cache para cálculos de heurística
-        self.edge_processing_cache = {}  # Cache para procesamiento de aristas
+        self.safety_cache_size = 32  # arreglos de seguridad por conjunto de zonas
+        self.layer_cache_size = 4  # versiones materializadas de la capa de seguridad
+        self.influence_cache_size = 10000  # influencias por arista y zonas (motor networkx)
+        self.landmark_count = landmark_count  # 0 desactiva la heurística ALT
+        self.contraction_hierarchies = contraction_hierarchies  # preprocesar shortest/fastest
+        self.graph = None
+    
+    @property
+    def graph(self):
+        """Grafo networkx; si sólo se cargó el formato binario se reconstruye bajo demanda"""
+        if self._graph is None and self.compiled is not None:
+            logger.info("Reconstruyendo grafo networkx desde el grafo compilado")
+            self._graph = self.compiled.to_networkx()
+        return self._graph
+    
+    @graph.setter
+    def graph(self, graph):
+        """Instala un grafo y reconstruye su representación compilada (CSR)"""
+        compiled = CompiledGraph.from_networkx(graph, self.default_speed) if graph is not None else None
+        self._install(compiled)
+        self._graph = graph
+    
+    def _install(self, compiled: Optional[CompiledGraph], landmarks: Optional[Landmarks] = None,
+                 hierarchies: Optional[Dict[str, ContractionHierarchy]] = None,
+                 spatial_index: Optional[SpatialIndex] = None):
+        """
+        Instala un grafo compilado junto con los índices derivados de él. El índice
+        espacial y los landmarks que no se reciban (ya cargados) se calculan aquí; las
+        jerarquías que falten las calcula build_hierarchies, mientras tanto las rutas usan A*.
+        """
+        self._graph = None
+        self.compiled = compiled
+        # Índices derivados del grafo: se invalidan al cambiar de grafo
+        if spatial_index is None and compiled is not None:
+            spatial_index = SpatialIndex(compiled.lat, compiled.lon)
+        self.spatial_index = spatial_index
+        if landmarks is None and compiled is not None and self.landmark_count > 0:
+            landmarks = Landmarks.build(compiled, self.landmark_count)
+        self.landmarks = landmarks
+        self.hierarchies = dict(hierarchies or {})
+        self._mid_nodes = None
+        self._mid_node_edges = None
+        self._safety_cache = OrderedDict()  # zonas -> influencia por arista
+        self._layer_states = OrderedDict()  # versión -> SafetyLayerState
+        self._influence_cache = OrderedDict()  # (u, v, zonas) -> influencia de seguridad
+        self._safety_lock = Lock()
+    
+    def memory_bytes(self) -> int:
+        """Memoria aproximada del grafo cargado y sus índices"""
+        if self.compiled is None:
+            return 0
+        landmarks_bytes = self.landmarks.nbytes if self.landmarks is not None else 0
+        hierarchy_bytes = sum(hierarchy.nbytes for hierarchy in self.hierarchies.values())
+        return self.compiled.nbytes + self.spatial_index.nbytes + landmarks_bytes + hierarchy_bytes
+    
+    def warm_up(self):
+        """
+        Construye por adelantado los índices que de otro modo se crean con la primera
+        ruta (puntos medios de aristas, adyacencia inversa) y lee los arreglos mapeados
+        en memoria para traer sus páginas desde disco.
+        """
+        start = time.time()
+        compiled = self.compiled
+        compiled.reverse_adjacency()
+        self._edges_of_mid_nodes(np.empty(0, dtype=np.int64))
+        self.snap_coordinates(compiled.lat[:1], compiled.lon[:1])
+        
+        arrays = [getattr(compiled, name) for name in CompiledGraph.ARRAYS]
+        if self.landmarks is not None:
+            arrays.extend(self.landmarks.distances.values())
+        for hierarchy in self.hierarchies.values():
+            arrays.extend(hierarchy.arrays.values())
+        for array in arrays:
+            np.asarray(array).sum()
+        logger.info(f"Índices del grafo precalentados en {time.time() - start:.2f} segundos")
+    
+    def _node_coords(self, node: int) -> Tuple[float, float]:
+        """(lat, lon) de un nodo a partir de los arreglos del grafo compilado"""
+        i = self.compiled.index(node)
+        return float(self.compiled.lat[i]), float(self.compiled.lon[i])
+    
+    def snap_coordinates(self, lats, lons) -> List[int]:
+        """Ajusta N coordenadas a los ids OSM de sus nodos más cercanos en una sola llamada"""
+        indices, _ = self.spatial_index.query(lats, lons)
+        return self.compiled.node_ids[indices].tolist()
         
     def load_graph(self, filename: str):
-        """Carga un grafo desde un archivo JSON"""
+        """
+        Carga un grafo. Un directorio se interpreta como el formato binario de
+        save_graph (mapeado en memoria); un archivo .json como node-link heredado.
+        """
         try:
-            with open(filename, 'r') as f:
-                graph_data = json.load(f)
+            if Path(filename).is_dir():
+                compiled = CompiledGraph.load(filename, mmap=True)
+                hierarchies = {
+                    metric: ContractionHierarchy.load(filename, metric, mmap=True)
+                    for metric in self.HIERARCHY_METRICS.values()
+                    if ContractionHierarchy.exists(filename, metric)
+                }
+                self._install(compiled, self._load_landmarks(filename, compiled), hierarchies,
+                              self._load_spatial_index(filename, compiled))
+                self._schedule_hierarchies(filename)
+            else:
+                with open(filename, 'r') as f:
+                    graph_data = json.load(f)
+                self.graph = nx.node_link_graph(graph_data)
             
-            self.graph = nx.node_link_graph(graph_data)
             logger.info(f"Grafo cargado desde: {filename}")
-            return {"status": "success", "nodes": len(self.graph.nodes), "edges": len(self.graph.edges)}
+            return {"status": "success", "nodes": self.compiled.num_nodes, "edges": self.compiled.num_edges}
             
         except Exception as e:
             logger.error(f"Error al cargar grafo: {str(e)}", exc_info=True)
@@ -38,32 +199,26 @@ class OSMProcessor:
         """
         Descarga un grafo de OpenStreetMap y lo prepara para análisis.
         """
-        cache_key = f"{place_name}_{network_type}_{simplify}"
-        if cache_key in self.graph_cache:
-            logger.info(f"Usando grafo en caché para {cache_key}")
-            self.graph = self.graph_cache[cache_key]
-            return {"nodes": len(self.graph.nodes), "edges": len(self.graph.edges)}
-        
         try:
             logger.info(f"Descargando mapa para: {place_name} (tipo: {network_type})")
             
             # Descargar grafo
-            self.graph = ox.graph_from_place(
+            graph = ox.graph_from_place(
                 place_name, 
                 network_type=network_type,
                 simplify=False
             )
             
-            # Procesar velocidades en paralelo
-            self._process_speeds_parallel()
-            
             # Simplificar si se requiere
             if simplify:
-                self.graph = ox.simplify_graph(self.graph)
+                graph = ox.simplify_graph(graph)
                 logger.info("Grafo simplificado")
             
-            # Guardar en caché
-            self.graph_cache[cache_key] = self.graph
+            # Normalizar velocidades sobre el grafo final (las aristas fusionadas traen listas)
+            self._normalize_speeds(graph)
+            
+            # Instalar (y compilar) una sola vez el grafo final
+            self.graph = graph
             
             return {"nodes": len(self.graph.nodes), "edges": len(self.graph.edges)}
             
@@ -71,54 +226,53 @@ class OSMProcessor:
             logger.error(f"Error al descargar mapa: {str(e)}", exc_info=True)
             raise Exception(str(e))
     
-    def _process_speeds_parallel(self):
-        """Procesa las velocidades de las aristas en paralelo"""
-        with ThreadPoolExecutor() as executor:
-            futures = []
-            for u, v, k, data in self.graph.edges(data=True, keys=True):
-                futures.append(executor.submit(self._process_single_edge_speed, u, v, k, data))
-            
-            # Esperar a que todos terminen
-            for future in futures:
-                future.result()
-    
-    def _process_single_edge_speed(self, u, v, k, data):
-        """Procesa la velocidad de una sola arista"""
-        cache_key = f"{u}_{v}_{k}"
-        if cache_key in self.edge_processing_cache:
-            data.update(self.edge_processing_cache[cache_key])
-            return
-        
-        processed_data = {}
+    def _normalize_speeds(self, graph) -> Dict:
+        """
+        Convierte maxspeed de todas las aristas a km/h numéricos. Los valores crudos
+        distintos (y sus tipos de vía) son pocos, así que cada combinación se
+        interpreta una sola vez y el resultado se asigna a todas sus aristas.
+        """
+        start_time = time.time()
+        speeds = {}  # (maxspeed, highway) crudos -> km/h
+        defaulted = 0
+        for _, _, data in graph.edges(data=True):
+            raw = data.get('maxspeed')
+            highway = data.get('highway')
+            key = (
+                tuple(raw) if isinstance(raw, list) else raw,
+                tuple(highway) if isinstance(highway, list) else highway
+            )
+            speed = speeds.get(key)
+            if speed is None:
+                speed = speeds[key] = self._normalize_speed(raw, highway)
+            if raw is None:
+                defaulted += 1
+            data['maxspeed'] = speed
         
-        # Asignar velocidad por defecto si no existe
-        if 'maxspeed' not in data:
-            processed_data['maxspeed'] = self.default_speed
-        else:
-            # Manejar casos donde maxspeed es una lista
-            if isinstance(data['maxspeed'], list):
-                try:
-                    speeds = [self._parse_speed(s) for s in data['maxspeed']]
-                    processed_data['maxspeed'] = min(speeds) if speeds else self.default_speed
-                except (ValueError, TypeError):
-                    processed_data['maxspeed'] = self.default_speed
-            # Convertir velocidades de string a float
-            elif isinstance(data['maxspeed'], str):
-                processed_data['maxspeed'] = self._parse_speed(data['maxspeed'])
-            # Asegurar que es numérico
-            elif not isinstance(data['maxspeed'], (int, float)):
-                processed_data['maxspeed'] = self.default_speed
-            
-            # Limitar velocidad mínima
-            if processed_data['maxspeed'] < 5:
-                processed_data['maxspeed'] = 5
-        
-        # Guardar en caché
-        self.edge_processing_cache[cache_key] = processed_data
-        data.update(processed_data)
-                
-    def _parse_speed(self, speed_str: str) -> float:
-        """Parsea un string de velocidad a float"""
+        logger.info(f"Velocidades normalizadas: {len(speeds)} combinaciones distintas, "
+                    f"{defaulted} aristas sin maxspeed, en {time.time() - start_time:.2f} segundos")
+        return {"distinct_values": len(speeds), "defaulted_edges": defaulted}
+    
+    def _normalize_speed(self, raw, highway) -> float:
+        """Velocidad en km/h de un valor crudo de maxspeed (texto, número o lista)"""
+        default = self._highway_default_speed(highway)
+        if raw is None:
+            return default
+        if isinstance(raw, list):
+            # Aristas fusionadas o varios valores: la velocidad más restrictiva
+            return min((self._normalize_speed(value, highway) for value in raw), default=default)
+        if isinstance(raw, (int, float)):
+            return max(5, float(raw))
+        return self._parse_speed(raw, default)
+    
+    def _highway_default_speed(self, highway) -> float:
+        """Velocidad por defecto del tipo de vía; con varios tipos se toma la mayor"""
+        highways = highway if isinstance(highway, list) else [highway]
+        speeds = [HIGHWAY_DEFAULT_SPEEDS[h] for h in highways if h in HIGHWAY_DEFAULT_SPEEDS]
+        return float(max(speeds)) if speeds else float(self.default_speed)
+    
+    def _parse_speed(self, speed_str: str, default: Optional[float] = None) -> float:
+        """Parsea un string de velocidad a float; `default` si no es interpretable"""
         try:
             speed_str = speed_str.lower().split(';')[0].split('@')[0].strip()
             
@@ -127,104 +281,413 @@ class OSMProcessor:
             else:
                 speed_value = float(speed_str.replace('km/h', '').split()[0])
             return max(5, speed_value)
-        except (ValueError, AttributeError):
-            return self.default_speed                
+        except (ValueError, AttributeError, IndexError):
+            return self.default_speed if default is None else default
     
     def save_graph(self, filename: str):
-        """Guarda el grafo en un archivo JSON con formato compatible"""
+        """Guarda el grafo compilado en formato binario (arreglos .npy + meta.json)"""
         try:
-            # Convertir el grafo a un formato serializable
-            graph_data = nx.node_link_data(self.graph)
-            
-            # Función para manejar geometrías
-            def default_serializer(obj):
-                if hasattr(obj, '__geo_interface__'):
-                    return obj.__geo_interface__
-                raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
-            
-            # Guardar el archivo
-            with open(filename, 'w') as f:
-                json.dump(graph_data, f, default=default_serializer, indent=2)
-                
+            self.compiled.save(filename)
+            self._save_derived(filename)
+            self._schedule_hierarchies(filename)
             logger.info(f"Grafo guardado en: {filename}")
-            return {"status": "success", "filename": filename}
+            return {"status": "success", "filename": str(filename)}
             
         except Exception as e:
             logger.error(f"Error al guardar grafo: {str(e)}", exc_info=True)
             raise Exception(str(e))
     
-    def add_safety_zones(self, safety_points: list[tuple[float, float, float, int, float]]):
-        """Agrega zonas de seguridad al grafo"""
-        self.safety_zones = []
-        for lat, lon, radius, safety_idx, weight in safety_points:
+    def _save_derived(self, directory):
+        """Guarda junto al grafo el índice espacial, los landmarks y las jerarquías que aún no estén en disco"""
+        if not SpatialIndex.exists(directory):
+            self.spatial_index.save(directory)
+        if self.landmarks is not None and not Landmarks.exists(directory):
+            with file_lock(Path(directory) / ".landmarks.lock"):
+                if not Landmarks.exists(directory):
+                    self.landmarks.save(directory)
+        for metric, hierarchy in self.hierarchies.items():
+            if not ContractionHierarchy.exists(directory, metric):
+                with file_lock(Path(directory) / ".ch.lock"):
+                    if not ContractionHierarchy.exists(directory, metric):
+                        hierarchy.save(directory)
+    
+    def _missing_hierarchies(self) -> List[str]:
+        if self.compiled is None or not self.contraction_hierarchies:
+            return []
+        return [metric for metric in self.HIERARCHY_METRICS.values() if metric not in self.hierarchies]
+    
+    def build_hierarchies(self, directory=None):
+        """
+        Calcula las jerarquías de contracción que falten. Con `directory` (el del grafo
+        guardado) se hace bajo un cerrojo de archivo: el primer proceso las calcula y
+        guarda, los demás las cargan de disco al obtener el cerrojo.
+        """
+        compiled = self.compiled
+        for metric in self._missing_hierarchies():
+            if directory is None:
+                hierarchy = ContractionHierarchy.build(compiled, metric)
+            else:
+                with file_lock(Path(directory) / ".ch.lock"):
+                    if ContractionHierarchy.exists(directory, metric):
+                        hierarchy = ContractionHierarchy.load(directory, metric, mmap=True)
+                    else:
+                        hierarchy = ContractionHierarchy.build(compiled, metric)
+                        hierarchy.save(directory)
+            if self.compiled is not compiled:
+                return  # se instaló otro grafo mientras tanto
+            # Se publica un diccionario nuevo: las rutas en curso no ven uno a medio modificar
+            self.hierarchies = dict(self.hierarchies, **{metric: hierarchy})
+            logger.info(f"Jerarquía de contracción lista para {metric}")
+    
+    def _schedule_hierarchies(self, directory):
+        """Calcula en segundo plano las jerarquías que falten sin bloquear la carga del grafo"""
+        if not self._missing_hierarchies():
+            return
+        
+        def build():
+            try:
+                self.build_hierarchies(directory)
+            except Exception as e:
+                logger.error(f"Error al calcular jerarquías de contracción: {str(e)}", exc_info=True)
+        
+        Thread(target=build, name="ch-build", daemon=True).start()
+    
+    def _load_spatial_index(self, directory, compiled: CompiledGraph) -> SpatialIndex:
+        """Índice espacial guardado junto al grafo; si falta (o es de otra versión) se construye y guarda"""
+        spatial_index = SpatialIndex.load(directory) if SpatialIndex.exists(directory) else None
+        if spatial_index is None:
+            spatial_index = SpatialIndex(compiled.lat, compiled.lon)
+            spatial_index.save(directory)
+        return spatial_index
+    
+    def _load_landmarks(self, directory, compiled: CompiledGraph) -> Optional[Landmarks]:
+        """
+        Landmarks guardados junto al grafo. Si faltan, el primer proceso que toma el
+        cerrojo los calcula y guarda; los que esperaban lo cargan de disco al entrar.
+        """
+        if Landmarks.exists(directory):
+            return Landmarks.load(directory, mmap=True)
+        if self.landmark_count <= 0:
+            return None
+        with file_lock(Path(directory) / ".landmarks.lock"):
+            if Landmarks.exists(directory):
+                return Landmarks.load(directory, mmap=True)
+            landmarks = Landmarks.build(compiled, self.landmark_count)
+            landmarks.save(directory)
+            return landmarks
+    
+    def route_connectors(self, start_lat: float, start_lon: float, end_lat: float, end_lon: float) -> Dict:
+        """Tramos de conexión entre las coordenadas pedidas y los nodos de la red"""
+        indices, distances = self.spatial_index.query([start_lat, end_lat], [start_lon, end_lon])
+        connectors = {}
+        for name, lat, lon, index, distance in zip(('start', 'end'), (start_lat, end_lat),
+                                                   (start_lon, end_lon), indices, distances):
+            connectors[name] = {
+                'from': (lat, lon),
+                'to': (float(self.compiled.lat[index]), float(self.compiled.lon[index])),
+                'distance': float(distance)
+            }
+        return connectors
+    
+    def build_safety_zones(self, safety_points: list[tuple[float, float, float, int, float]]) -> Tuple[SafetyZone, ...]:
+        """Construye las zonas de seguridad de una petición (sin modificar el procesador)"""
+        valid_points = []
+        for point in safety_points:
             try:
-                center_node = ox.distance.nearest_nodes(self.graph, lon, lat)
-                self.safety_zones.append({
-                    'center': center_node,
-                    'radius': radius,
-                    'safety_index': safety_idx,
-                    'weight': weight
-                })
+                lat, lon, radius, safety_idx, weight = point
+                valid_points.append((float(lat), float(lon), radius, safety_idx, weight))
             except Exception as e:
                 logger.warning(f"No se pudo agregar punto de seguridad: {str(e)}")
-                continue
+        
+        if not valid_points:
+            return ()
+        
+        # Ajustar todos los centros en una sola consulta al índice espacial
+        center_nodes = self.snap_coordinates(
+            [point[0] for point in valid_points],
+            [point[1] for point in valid_points]
+        )
+        return tuple(
+            SafetyZone(center_node, radius, safety_idx, weight)
+            for (lat, lon, radius, safety_idx, weight), center_node in zip(valid_points, center_nodes)
+        )
+    
+    @staticmethod
+    def _safety_tuples(request: dict) -> list[tuple[float, float, float, int, float]]:
+        """Puntos de seguridad de una petición como tuplas (lat, lon, radio, índice, peso)"""
+        return [
+            (sp['lat'], sp['lon'], sp['radius'], sp['safety_index'], sp.get('weight', 1.0))
+            for sp in request['safety_points']
+        ]
+    
+    def build_context(self, request: dict) -> RouteContext:
+        """Ajusta extremos y zonas de seguridad de una petición y los congela en un RouteContext"""
+        start_node, end_node = self.snap_coordinates(
+            [request['start_lat'], request['end_lat']],
+            [request['start_lon'], request['end_lon']]
+        )
+        return RouteContext(
+            start_node=start_node,
+            end_node=end_node,
+            optimization=request['optimization'],
+            heuristic=request['heuristic'],
+            distance_weight=request['distance_weight'],
+            time_weight=request['time_weight'],
+            safety_weight=request['safety_weight'],
+            zones=self.build_safety_zones(self._safety_tuples(request))
+        )
     
     def euclidean_distance(self, node1: int, node2: int) -> float:
         """Distancia euclidiana entre dos nodos en metros"""
-        cache_key = f"euclidean_{node1}_{node2}"
-        if cache_key in self.heuristic_cache:
-            return self.heuristic_cache[cache_key]
-        
-        lat1, lon1 = self.graph.nodes[node1]['y'], self.graph.nodes[node1]['x']
-        lat2, lon2 = self.graph.nodes[node2]['y'], self.graph.nodes[node2]['x']
+        lat1, lon1 = self._node_coords(node1)
+        lat2, lon2 = self._node_coords(node2)
         
         dx = (lon2 - lon1) * 111320 * math.cos(math.radians(lat1))
         dy = (lat2 - lat1) * 111000
-        distance = math.sqrt(dx**2 + dy**2)
-        
-        self.heuristic_cache[cache_key] = distance
-        return distance
+        return math.sqrt(dx**2 + dy**2)
     
     def manhattan_distance(self, node1: int, node2: int) -> float:
         """Distancia Manhattan entre dos nodos en metros"""
-        cache_key = f"manhattan_{node1}_{node2}"
-        if cache_key in self.heuristic_cache:
-            return self.heuristic_cache[cache_key]
-        
-        lat1, lon1 = self.graph.nodes[node1]['y'], self.graph.nodes[node1]['x']
-        lat2, lon2 = self.graph.nodes[node2]['y'], self.graph.nodes[node2]['x']
+        lat1, lon1 = self._node_coords(node1)
+        lat2, lon2 = self._node_coords(node2)
         
         dx = (lon2 - lon1) * 111320 * math.cos(math.radians(lat1))
         dy = (lat2 - lat1) * 111000
-        distance = abs(dx) + abs(dy)
-        
-        self.heuristic_cache[cache_key] = distance
-        return distance
+        return abs(dx) + abs(dy)
     
-    @lru_cache(maxsize=10000)
-    def _calculate_safety_influence(self, u: int, v: int) -> float:
-        """Calcula la influencia de seguridad entre dos nodos (con memoización)"""
-        if not self.safety_zones:
+    def heuristic_array(self, heuristic: str, end_node: int) -> np.ndarray:
+        """
+        euclidean_distance o manhattan_distance de todos los nodos hacia `end_node`
+        en una sola pasada vectorizada. Se calcula por petición y no se guarda.
+        """
+        compiled = self.compiled
+        target = compiled.index(end_node)
+        dx = (compiled.lon[target] - compiled.lon) * 111320 * np.cos(np.radians(compiled.lat))
+        dy = (compiled.lat[target] - compiled.lat) * 111000
+        if heuristic == "manhattan":
+            return np.abs(dx) + np.abs(dy)
+        return np.sqrt(dx**2 + dy**2)
+    
+    def _calculate_safety_influence(self, u: int, v: int, zones: Tuple[SafetyZone, ...]) -> float:
+        """
+        Calcula la influencia de seguridad entre dos nodos, memoizada por zonas en una
+        caché de la instancia (se descarta junto con el procesador o al cambiar de grafo)
+        """
+        if not zones:
             return 0.0
+        
+        key = (u, v, zones)
+        with self._safety_lock:
+            cached = self._influence_cache.get(key)
+            if cached is not None:
+                self._influence_cache.move_to_end(key)
+                return cached
             
-        lat1, lon1 = self.graph.nodes[u]['y'], self.graph.nodes[u]['x']
-        lat2, lon2 = self.graph.nodes[v]['y'], self.graph.nodes[v]['x']
+        lat1, lon1 = self._node_coords(u)
+        lat2, lon2 = self._node_coords(v)
         mid_lat = (lat1 + lat2) / 2
         mid_lon = (lon1 + lon2) / 2
-        mid_node = ox.distance.nearest_nodes(self.graph, mid_lon, mid_lat)
+        mid_node = self.snap_coordinates(mid_lat, mid_lon)[0]
         
         safety_influence = 0.0
-        for zone in self.safety_zones:
-            distance = self.euclidean_distance(mid_node, zone['center'])
-            if distance <= zone['radius']:
-                influence = (1 - (distance / zone['radius'])) * zone['safety_index'] * zone['weight']
+        for zone in zones:
+            distance = self.euclidean_distance(mid_node, zone.center)
+            if distance <= zone.radius:
+                influence = (1 - (distance / zone.radius)) * zone.safety_index * zone.weight
                 safety_influence += influence
+        safety_influence = min(safety_influence, 10.0)
+        
+        with self._safety_lock:
+            self._influence_cache[key] = safety_influence
+            while len(self._influence_cache) > self.influence_cache_size:
+                self._influence_cache.popitem(last=False)
+        return safety_influence
+    
+    def _edge_mid_nodes(self) -> np.ndarray:
+        """Índice del nodo más cercano al punto medio de cada arista (se calcula una vez por grafo)"""
+        if self._mid_nodes is None:
+            compiled = self.compiled
+            sources = compiled.edge_sources()
+            mid_lat = (compiled.lat[sources] + compiled.lat[compiled.targets]) / 2
+            mid_lon = (compiled.lon[sources] + compiled.lon[compiled.targets]) / 2
+            self._mid_nodes, _ = self.spatial_index.query(mid_lat, mid_lon)
+        return self._mid_nodes
+    
+    def compute_edge_safety(self, zones: Tuple[SafetyZone, ...], stats: Optional[Dict] = None,
+                            layer: Optional[SafetyLayerState] = None) -> np.ndarray:
+        """
+        Influencia de seguridad de todas las aristas en una sola pasada vectorizada.
+        Equivale a _calculate_safety_influence aplicado a cada arista. Con `layer` las
+        zonas de la petición se suman a las de la capa del servidor. Los arreglos se
+        guardan por conjunto de zonas y son de sólo lectura.
+        """
+        if layer is not None and not zones:
+            return layer.edge_safety
+        
+        key = zones if layer is None else (zones, layer.version)
+        with self._safety_lock:
+            cached = self._safety_cache.get(key)
+            if cached is not None:
+                self._safety_cache.move_to_end(key)
+            if stats is not None:
+                stats['safety_cache_hit'] = cached is not None
+            if cached is not None:
+                return cached
         
-        return min(safety_influence, 10.0)
+        compiled = self.compiled
+        if not zones:
+            safety = np.zeros(compiled.num_edges)
+        else:
+            # La influencia sólo depende del nodo del punto medio: se evalúa por nodo
+            node_safety = np.zeros(compiled.num_nodes) if layer is None else layer.node_safety.copy()
+            for zone in zones:
+                node_safety += self._zone_influence(zone)
+            safety = np.minimum(node_safety[self._edge_mid_nodes()], 10.0)
+        safety.flags.writeable = False
+        
+        with self._safety_lock:
+            self._safety_cache[key] = safety
+            while len(self._safety_cache) > self.safety_cache_size:
+                self._safety_cache.popitem(last=False)
+        return safety
+    
+    def _zone_influence(self, zone: SafetyZone, nodes: Optional[np.ndarray] = None) -> np.ndarray:
+        """Influencia de una zona sobre los nodos dados (todos por defecto); 0 fuera de su radio"""
+        compiled = self.compiled
+        lat = compiled.lat if nodes is None else compiled.lat[nodes]
+        lon = compiled.lon if nodes is None else compiled.lon[nodes]
+        center = compiled.index(zone.center)
+        dx = (compiled.lon[center] - lon) * 111320 * np.cos(np.radians(lat))
+        dy = (compiled.lat[center] - lat) * 111000
+        distance = np.sqrt(dx**2 + dy**2)
+        return np.where(distance <= zone.radius, (1 - distance / zone.radius) * zone.safety_index * zone.weight, 0.0)
+    
+    def _zone_nodes(self, zone: SafetyZone) -> np.ndarray:
+        """
+        Nodos que una zona puede alcanzar. La consulta usa distancia haversine y la
+        influencia una aproximación plana, por eso el radio lleva un margen.
+        """
+        lat, lon = self._node_coords(zone.center)
+        return self.spatial_index.within(lat, lon, zone.radius * 1.01 + 1)
+    
+    def _edges_of_mid_nodes(self, nodes: np.ndarray) -> np.ndarray:
+        """Aristas cuyo punto medio se ajusta a alguno de los nodos dados (índice inverso de _edge_mid_nodes)"""
+        if self._mid_node_edges is None:
+            mid_nodes = self._edge_mid_nodes()
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(mid_nodes, minlength=self.compiled.num_nodes))])
+            self._mid_node_edges = (offsets, np.argsort(mid_nodes, kind='stable'))
+        offsets, order = self._mid_node_edges
+        starts = offsets[nodes]
+        counts = offsets[nodes + 1] - starts
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return order[positions]
     
-    def calculate_edge_weight(self, u: int, v: int, optimization: str,
-                            distance_weight: float, time_weight: float, 
-                            safety_weight: float) -> float:
+    def _snap_layer_zones(self, zones: Dict[str, Dict]) -> Dict[str, SafetyZone]:
+        """
+        Ajusta las zonas de la capa a la red. Las zonas cuyo centro queda más lejos
+        de la red que su radio pertenecen a otra región y se descartan.
+        """
+        if not zones:
+            return {}
+        indices, distances = self.spatial_index.query(
+            [zone['lat'] for zone in zones.values()], [zone['lon'] for zone in zones.values()]
+        )
+        centers = self.compiled.node_ids[indices].tolist()
+        return {
+            zone_id: SafetyZone(center, zone['radius'], zone['safety_index'], zone['weight'])
+            for (zone_id, zone), center, distance in zip(zones.items(), centers, distances.tolist())
+            if distance <= zone['radius']
+        }
+    
+    def safety_layer_state(self, layer, version: int, stats: Optional[Dict] = None) -> SafetyLayerState:
+        """
+        Capa de seguridad del servidor (SafetyLayer) en una versión. Se parte de la
+        versión materializada más cercana y sólo se recalculan los nodos y aristas
+        dentro del radio de las zonas que cambiaron entre ambas.
+        """
+        with self._safety_lock:
+            state = self._layer_states.get(version)
+            if state is not None:
+                self._layer_states.move_to_end(version)
+            nearest = min(self._layer_states.values(), key=lambda s: abs(s.version - version), default=None)
+        if stats is not None:
+            stats['safety_cache_hit'] = state is not None
+        if state is not None:
+            return state
+        
+        start = time.time()
+        if nearest is None:
+            _, zones = layer.zones(version)
+            state = self._build_layer_state(version, self._snap_layer_zones(zones))
+        else:
+            state = self._update_layer_state(nearest, version, layer.diff(nearest.version, version))
+        logger.info(f"Capa de seguridad v{version} materializada ({len(state.zones)} zonas) "
+                    f"en {time.time() - start:.3f} segundos")
+        
+        with self._safety_lock:
+            self._layer_states[version] = state
+            while len(self._layer_states) > self.layer_cache_size:
+                self._layer_states.popitem(last=False)
+        return state
+    
+    def _build_layer_state(self, version: int, zones: Dict[str, SafetyZone]) -> SafetyLayerState:
+        """Materializa la capa completa: una pasada vectorizada por zona"""
+        node_safety = np.zeros(self.compiled.num_nodes)
+        for zone in zones.values():
+            node_safety += self._zone_influence(zone)
+        edge_safety = np.minimum(node_safety[self._edge_mid_nodes()], 10.0)
+        node_safety.flags.writeable = False
+        edge_safety.flags.writeable = False
+        return SafetyLayerState(version, zones, node_safety, edge_safety)
+    
+    def _update_layer_state(self, base: SafetyLayerState, version: int,
+                            diff: Dict[str, Tuple[Optional[Dict], Optional[Dict]]]) -> SafetyLayerState:
+        """Aplica a `base` los cambios de zonas de `diff` recalculando sólo la zona afectada"""
+        zones = dict(base.zones)
+        added = self._snap_layer_zones({zone_id: after for zone_id, (_, after) in diff.items() if after is not None})
+        touched = []
+        for zone_id in diff:
+            if zone_id in zones:
+                touched.append(zones.pop(zone_id))
+            if zone_id in added:
+                zones[zone_id] = added[zone_id]
+                touched.append(added[zone_id])
+        zones = dict(sorted(zones.items()))
+        
+        if not touched:
+            return SafetyLayerState(version, zones, base.node_safety, base.edge_safety)
+        affected = np.unique(np.concatenate([self._zone_nodes(zone) for zone in touched]))
+        if len(affected) > self.compiled.num_nodes // 4:
+            # Cambios que cubren buena parte de la red: es más barato reconstruir
+            return self._build_layer_state(version, zones)
+        
+        # Zonas que pueden alcanzar algún nodo afectado: sus círculos cortan el de una zona tocada
+        centers = self.compiled.index_of([zone.center for zone in zones.values()])
+        center_lat, center_lon = self.compiled.lat[centers], self.compiled.lon[centers]
+        radius = np.array([zone.radius for zone in zones.values()], dtype=np.float64)
+        reach = np.zeros(len(zones), dtype=bool)
+        for zone in touched:
+            lat, lon = self._node_coords(zone.center)
+            dx = (lon - center_lon) * 111320 * np.cos(np.radians(center_lat))
+            dy = (lat - center_lat) * 111000
+            reach |= np.sqrt(dx**2 + dy**2) <= (radius + zone.radius) * 1.02 + 2
+        
+        # Mismo orden de suma que la reconstrucción completa: el resultado es idéntico
+        affected_safety = np.zeros(len(affected))
+        for zone, reaches in zip(zones.values(), reach.tolist()):
+            if reaches:
+                affected_safety += self._zone_influence(zone, affected)
+        node_safety = base.node_safety.copy()
+        node_safety[affected] = affected_safety
+        
+        edges = self._edges_of_mid_nodes(affected)
+        edge_safety = base.edge_safety.copy()
+        edge_safety[edges] = np.minimum(node_safety[self._edge_mid_nodes()[edges]], 10.0)
+        node_safety.flags.writeable = False
+        edge_safety.flags.writeable = False
+        return SafetyLayerState(version, zones, node_safety, edge_safety)
+    
+    def calculate_edge_weight(self, u: int, v: int, context: RouteContext) -> float:
         """Calcula el peso compuesto de una arista según la estrategia de optimización"""
         edge_data = self.graph.edges[u, v, 0]
         length = edge_data.get('length', 1)
@@ -234,9 +697,14 @@ class OSMProcessor:
         except (TypeError, ValueError):
             speed = self.default_speed
         
+        optimization = context.optimization
+        distance_weight = context.distance_weight
+        time_weight = context.time_weight
+        safety_weight = context.safety_weight
+        
         distance = length
         time = length / max(0.1, speed) * 3.6
-        safety = self._calculate_safety_influence(u, v)
+        safety = self._calculate_safety_influence(u, v, context.zones)
         
         if optimization == "shortest":
             return distance
@@ -255,102 +723,319 @@ class OSMProcessor:
             
             return dist_component + time_component + safety_component
     
-    def calculate_route_task(self, request: dict) -> dict:
-        """Calcula la ruta y devuelve el resultado directamente"""
+    def compiled_edge_weights(self, context: RouteContext, safety: np.ndarray) -> np.ndarray:
+        """Pesos por arista del grafo compilado, equivalentes a calculate_edge_weight"""
+        compiled = self.compiled
+        optimization = context.optimization
+        if optimization == "shortest":
+            return compiled.edge_length
+        if optimization == "fastest":
+            return compiled.edge_time() * 1000
+        if optimization == "safest":
+            return safety * 200
+        
+        # balanced
+        total_weight = context.distance_weight + context.time_weight + context.safety_weight
+        if total_weight <= 0:
+            total_weight = 1.0
+        
+        dist_component = (compiled.edge_length / 1000) * (context.distance_weight / total_weight)
+        time_component = (compiled.edge_time() * 3600) * (context.time_weight / total_weight)
+        safety_component = safety * (context.safety_weight / total_weight)
+        
+        return dist_component + time_component + safety_component
+    
+    def landmark_bounds(self, context: RouteContext, reverse: bool = False) -> Optional[np.ndarray]:
+        """
+        Cota inferior ALT del costo restante desde cada nodo hasta el destino (o, con
+        `reverse`, del costo desde el origen hasta cada nodo), en las mismas unidades
+        que compiled_edge_weights. None si no hay landmarks.
+        """
+        if self.landmarks is None:
+            return None
+        node = self.compiled.index(context.start_node if reverse else context.end_node)
+        optimization = context.optimization
+        if optimization == "shortest":
+            return self.landmarks.lower_bounds('length', node, reverse)
+        if optimization == "fastest":
+            return self.landmarks.lower_bounds('time', node, reverse) * 1000
+        if optimization == "safest":
+            # El costo sólo depende de las zonas de la petición: no hay cota precalculada
+            return np.zeros(self.compiled.num_nodes)
+        
+        # balanced: la seguridad no es negativa, basta con acotar distancia y tiempo
+        total_weight = context.distance_weight + context.time_weight + context.safety_weight
+        if total_weight <= 0:
+            total_weight = 1.0
+        dist_bound = self.landmarks.lower_bounds('length', node, reverse) / 1000 * (context.distance_weight / total_weight)
+        time_bound = self.landmarks.lower_bounds('time', node, reverse) * 3600 * (context.time_weight / total_weight)
+        return dist_bound + time_bound
+    
+    def bidirectional_potential(self, context: RouteContext, weights: np.ndarray) -> np.ndarray:
+        """
+        Potencial promediado (h_destino - h_origen) / 2 para el A* bidireccional. Ambas
+        cotas deben ser consistentes: landmarks si se pidieron, o la distancia geodésica
+        escalada por el menor costo por metro de las aristas.
+        """
+        compiled = self.compiled
+        to_target = self.landmark_bounds(context) if context.heuristic == "landmarks" else None
+        if to_target is not None:
+            from_source = self.landmark_bounds(context, reverse=True)
+            return (to_target - from_source) / 2
+        
+        # Ninguna arista es más corta que la línea recta entre sus extremos; el 1% de
+        # holgura cubre longitudes redondeadas
+        lengths = compiled.edge_length
+        positive = lengths > 0
+        if not positive.any():
+            return np.zeros(compiled.num_nodes)
+        cost_per_meter = float(np.min(weights[positive] / lengths[positive])) * 0.99
+        s = compiled.index(context.start_node)
+        t = compiled.index(context.end_node)
+        to_target = self._great_circle(compiled.lat[t], compiled.lon[t]) * cost_per_meter
+        from_source = self._great_circle(compiled.lat[s], compiled.lon[s]) * cost_per_meter
+        return (to_target - from_source) / 2
+    
+    def _great_circle(self, lat: float, lon: float) -> np.ndarray:
+        """Distancia en metros desde (lat, lon) hasta cada nodo del grafo compilado"""
+        lat1, lon1 = np.radians(lat), np.radians(lon)
+        lat2, lon2 = np.radians(self.compiled.lat), np.radians(self.compiled.lon)
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+    
+    @classmethod
+    def validate_search(cls, engine: str, search: str):
+        """Lanza ValueError si el motor o el algoritmo no existen o no pueden combinarse"""
+        if engine not in cls.ENGINES:
+            raise ValueError(f"'engine' debe ser uno de {', '.join(cls.ENGINES)}")
+        if search not in cls.SEARCHES:
+            raise ValueError(f"'search' debe ser uno de {', '.join(cls.SEARCHES)}")
+        if engine == "networkx" and search in ("bidirectional", "ch"):
+            raise ValueError(f"'search': \"{search}\" sólo está disponible con el motor 'compiled'")
+    
+    def _select_search(self, context: RouteContext, engine: str, search: str) -> str:
+        """
+        Algoritmo a usar: "ch" para shortest/fastest cuando hay jerarquía de contracción
+        (por defecto o si se pide explícitamente), "bidirectional" si se pide, y
+        "astar" en cualquier otro caso. Una combinación inválida lanza ValueError.
+        """
+        self.validate_search(engine, search)
+        if search == "bidirectional":
+            return search
+        if search == "astar":
+            return "astar"
+        metric = self.HIERARCHY_METRICS.get(context.optimization)
+        if engine == "compiled" and metric in self.hierarchies:
+            return "ch"
+        if search == "ch":
+            logger.warning(f"Sin jerarquía de contracción para {context.optimization}, se usa A*")
+        return "astar"
+    
+    def _heuristics(self, context: RouteContext):
+        """
+        Heurística de la petición en dos formas: sobre ids OSM (para networkx) y
+        sobre índices internos (para el grafo compilado). Ambas leen un arreglo con
+        el valor de todos los nodos hacia el destino, calculado una vez por petición.
+        """
+        compiled = self.compiled
+        bounds = self.landmark_bounds(context) if context.heuristic == "landmarks" else None
+        if bounds is None:
+            if context.heuristic == "landmarks":
+                logger.warning("No hay landmarks para este grafo, se usa la heurística euclidiana")
+            bounds = self.heuristic_array(context.heuristic, context.end_node)
+        
+        # Una lista de floats es más rápida que el arreglo para lecturas de a un nodo
+        bounds = bounds.tolist()
+        heuristic_func = lambda n, _: bounds[compiled.node_index[n]]
+        return heuristic_func, bounds.__getitem__
+    
+    def _compiled_astar(self, context: RouteContext, heuristic_func, weights: np.ndarray,
+                        stats: Optional[Dict] = None, allowed: Optional[np.ndarray] = None) -> list:
+        """
+        Ejecuta A* sobre el grafo compilado y devuelve la ruta en índices internos.
+        `heuristic_func` recibe índices internos; `allowed` restringe los nodos visitables.
+        """
+        compiled = self.compiled
+        path = compiled.astar(
+            compiled.index(context.start_node),
+            compiled.index(context.end_node),
+            weights,
+            heuristic_func,
+            stats,
+            allowed
+        )
+        return path
+    
+    def _corridor_search(self, context: RouteContext, shape: Optional[str], search,
+                         stats: Dict) -> Tuple[list, Optional[Dict]]:
+        """
+        Ejecuta `search(allowed)` restringida a un corredor alrededor de origen y destino.
+        Si no hay camino dentro del corredor se ensancha según CORRIDOR_FACTORS y, como
+        último intento, se busca en todo el grafo. Devuelve (ruta, resumen del corredor);
+        sin `shape` la búsqueda usa el grafo completo y el resumen es None.
+        """
+        if shape is None:
+            return search(None), None
+        if shape not in self.CORRIDOR_SHAPES:
+            raise Exception(f"Corredor no válido: {shape}. Opciones: {', '.join(self.CORRIDOR_SHAPES)}")
+        
+        compiled = self.compiled
+        source = compiled.index(context.start_node)
+        target = compiled.index(context.end_node)
+        straight = math.hypot(
+            (compiled.lon[target] - compiled.lon[source]) * 111320 * math.cos(math.radians(compiled.lat[source])),
+            (compiled.lat[target] - compiled.lat[source]) * 111000
+        )
+        # El trabajo de los intentos fallidos también cuenta en las estadísticas
+        spent = {}
+        for attempt, factor in enumerate(self.CORRIDOR_FACTORS + (None,), start=1):
+            if factor is None:
+                allowed = None
+            else:
+                margin = factor * self.CORRIDOR_BUFFER_M + straight * (factor - 1) / 2
+                allowed = compiled.corridor_mask(source, target, shape, margin)
+            try:
+                path = search(allowed)
+            except nx.NetworkXNoPath:
+                if allowed is None:
+                    raise
+                logger.info(f"Sin camino dentro del corredor {shape} (factor {factor}), se ensancha")
+                for key, value in stats.items():
+                    if key.startswith(('nodes_expanded', 'edges_relaxed')):
+                        spent[key] = spent.get(key, 0) + value
+                continue
+            for key, value in spent.items():
+                stats[key] = stats.get(key, 0) + value
+            return path, {
+                'shape': shape,
+                'attempts': attempt,
+                'factor': factor,
+                'nodes': int(allowed.sum()) if allowed is not None else compiled.num_nodes
+            }
+    
+    def calculate_route_task(self, request: dict, safety_layer=None) -> dict:
+        """
+        Calcula la ruta y devuelve el resultado directamente. Si la petición trae
+        'safety_layer' (versión) se usan también las zonas de `safety_layer`.
+        """
         try:
             start_time = time.time()
             
             # Verificar que el grafo esté cargado
-            if self.graph is None:
+            if self.compiled is None:
                 raise Exception("El grafo no ha sido cargado. Primero llama a download_map()")
             
-            # Convertir puntos de seguridad a tuplas
-            safety_tuples = [
-                (sp['lat'], sp['lon'], sp['radius'], sp['safety_index'], sp.get('weight', 1.0)) 
-                for sp in request['safety_points']
-            ]
-            
-            # Añadir zonas de seguridad
-            self.add_safety_zones(safety_tuples)
-            
             # Obtener coordenadas
             start_lon = request['start_lon']
             start_lat = request['start_lat']
             end_lon = request['end_lon']
             end_lat = request['end_lat']
             
-            # Encontrar nodos más cercanos
-            start_node = ox.distance.nearest_nodes(self.graph, start_lon, start_lat)
-            end_node = ox.distance.nearest_nodes(self.graph, end_lon, end_lat)
+            # Tiempo por fase y contadores de la búsqueda y de las cachés
+            timings = {}
+            search_stats = {}
+            phase_start = time.perf_counter()
+            
+            # Contexto inmutable de la petición: extremos y zonas ajustados a la red
+            context = self.build_context(request)
+            start_node, end_node = context.start_node, context.end_node
+            timings['snapping'] = time.perf_counter() - phase_start
+            
+            # Influencia de seguridad de todas las aristas en una sola pasada
+            phase_start = time.perf_counter()
+            layer_state = self._request_layer(request, safety_layer, search_stats)
+            edge_safety = self.compute_edge_safety(context.zones, search_stats, layer_state)
+            timings['safety_influence'] = time.perf_counter() - phase_start
             
             logger.info(f"Calculando ruta desde {start_lat},{start_lon} hasta {end_lat},{end_lon}")
             
-            # Configurar heurística
-            if request['heuristic'] == "manhattan":
-                heuristic_func = lambda n, _: self.manhattan_distance(n, end_node)
-            else:
-                heuristic_func = lambda n, _: self.euclidean_distance(n, end_node)
-            
-            # Configurar función de peso
-            weight_func = lambda u, v, d: self.calculate_edge_weight(
-                u, v, 
-                request['optimization'], 
-                request['distance_weight'], 
-                request['time_weight'], 
-                request['safety_weight']
-            )
+            compiled = self.compiled
+            engine = request.get('engine', 'compiled')
+            search = self._select_search(context, engine, request.get('search', 'auto'))
+            # Sólo A* y A* bidireccional sobre el grafo compilado se restringen a un corredor
+            corridor = None
+            phase_start = time.perf_counter()
             
-            # Calcular ruta con A*
-            logger.info("Iniciando cálculo de ruta con algoritmo A*")
-            path = nx.astar_path(
-                self.graph,
-                start_node,
-                end_node,
-                heuristic=heuristic_func,
-                weight=weight_func
-            )
+            if search == "ch":
+                # Costo estático: consulta bidireccional sobre la jerarquía precalculada
+                logger.info("Iniciando cálculo de ruta con jerarquía de contracción")
+                hierarchy = self.hierarchies[self.HIERARCHY_METRICS[context.optimization]]
+                _, path = hierarchy.query(
+                    compiled.index(start_node), compiled.index(end_node), search_stats
+                )
+            elif search == "bidirectional":
+                # Pesos dependientes de la petición: búsqueda desde ambos extremos
+                logger.info("Iniciando cálculo de ruta con A* bidireccional")
+                weights = self.compiled_edge_weights(context, edge_safety)
+                potential = self.bidirectional_potential(context, weights)
+                path, corridor = self._corridor_search(
+                    context, request.get('corridor'),
+                    lambda allowed: compiled.bidirectional_search(
+                        compiled.index(start_node),
+                        compiled.index(end_node),
+                        weights,
+                        potential,
+                        search_stats,
+                        allowed
+                    ),
+                    search_stats
+                )
+            elif engine == "networkx":
+                if layer_state is not None:
+                    raise Exception("La capa de seguridad del servidor requiere el motor 'compiled'")
+                logger.info("Iniciando cálculo de ruta con algoritmo A* (motor: networkx)")
+                heuristic_func, _ = self._heuristics(context)
+                # Configurar función de peso
+                weight_func = lambda u, v, d: self.calculate_edge_weight(u, v, context)
+                
+                path = nx.astar_path(
+                    self.graph,
+                    start_node,
+                    end_node,
+                    heuristic=heuristic_func,
+                    weight=weight_func
+                )
+                path = self.compiled.index_of(path).tolist()
+            else:
+                logger.info("Iniciando cálculo de ruta con algoritmo A* (motor: compiled)")
+                _, index_heuristic = self._heuristics(context)
+                weights = self.compiled_edge_weights(context, edge_safety)
+                path, corridor = self._corridor_search(
+                    context, request.get('corridor'),
+                    lambda allowed: self._compiled_astar(context, index_heuristic, weights, search_stats, allowed),
+                    search_stats
+                )
             logger.info(f"Ruta calculada con {len(path)} segmentos")
             
-            # Calcular métricas detalladas
-            total_distance = 0.0
-            total_time_sec = 0.0
-            total_safety = 0.0
-            segments = []
+            timings['search'] = time.perf_counter() - phase_start
             
-            for i in range(len(path)-1):
-                u = path[i]
-                v = path[i+1]
-                edge_data = self.graph.edges[u, v, 0]
-                
-                length = edge_data.get('length', 0)
-                speed = edge_data.get('maxspeed', self.default_speed)
-                segment_time = length / max(0.1, speed) * 3.6
-                safety = self._calculate_safety_influence(u, v)
-                
-                total_distance += length
-                total_time_sec += segment_time
-                total_safety += safety
-                
-                segments.append({
-                    'start': (self.graph.nodes[u]['y'], self.graph.nodes[u]['x']),
-                    'end': (self.graph.nodes[v]['y'], self.graph.nodes[v]['x']),
-                    'distance': length,
-                    'time': segment_time,
-                    'speed': speed,
-                    'safety': safety,
-                    'safety_level': self._get_safety_level(safety)
-                })
+            # Calcular métricas detalladas por segmento en forma columnar
+            phase_start = time.perf_counter()
+            edges = np.asarray([compiled.edge_index(u, v) for u, v in zip(path, path[1:])], dtype=np.int64)
+            lengths = compiled.edge_length[edges]
+            speeds = compiled.edge_speed[edges]
+            times = lengths / np.maximum(0.1, speeds) * 3.6
+            safeties = edge_safety[edges]
             
-            avg_speed = total_distance / total_time_sec * 3.6 if total_time_sec > 0 else 0
-            avg_safety = total_safety / len(segments) if segments else 0
+            total_distance = float(lengths.sum())
+            total_time_sec = float(times.sum())
+            total_safety = float(safeties.sum())
             
-            # Preparar respuesta
-            path_coords = [(self.graph.nodes[node]['y'], self.graph.nodes[node]['x']) 
-                        for node in path]
+            avg_speed = total_distance / total_time_sec * 3.6 if total_time_sec > 0 else 0
+            avg_safety = total_safety / len(edges) if len(edges) else 0
             
+            # Preparar respuesta: geometría como polilínea codificada
             result = {
-                'path': path_coords,
-                'segments': segments,
+                'geometry': encode_polyline(compiled.lat[path], compiled.lon[path]),
+                'geometry_precision': POLYLINE_PRECISION,
+                'segments': {
+                    'distance': lengths.tolist(),
+                    'time': times.tolist(),
+                    'speed': speeds.tolist(),
+                    'safety': safeties.tolist(),
+                    'safety_level': [self._get_safety_level(safety) for safety in safeties.tolist()]
+                },
+                'connectors': self.route_connectors(start_lat, start_lon, end_lat, end_lon),
                 'summary': {
                     'total_distance': total_distance,
                     'total_distance_km': total_distance / 1000,
@@ -371,10 +1056,22 @@ class OSMProcessor:
                         'time': request['time_weight'],
                         'safety': request['safety_weight']
                     },
-                    'safety_points_count': len(request['safety_points'])
+                    'safety_points_count': len(request['safety_points']),
+                    'safety_layer': request.get('safety_layer'),
+                    'engine': engine,
+                    'search': search,
+                    'corridor': corridor,
+                    'region_id': request.get('region_id'),
+                    'nodes_expanded': search_stats.get('nodes_expanded'),
+                    'nodes_expanded_forward': search_stats.get('nodes_expanded_forward'),
+                    'nodes_expanded_backward': search_stats.get('nodes_expanded_backward'),
+                    'edges_relaxed': search_stats.get('edges_relaxed'),
+                    'cache': {'safety_hit': search_stats.get('safety_cache_hit')},
+                    'timings': timings
                 },
                 'status': 'completed'
             }
+            timings['assembly'] = time.perf_counter() - phase_start
             
             logger.info(f"Cálculo de ruta completado en {result['summary']['processing_time']:.2f} segundos")
             return result
@@ -387,6 +1084,232 @@ class OSMProcessor:
                 "traceback": traceback.format_exc()
             }
     
+    def _request_layer(self, request: dict, safety_layer, stats: Optional[Dict] = None) -> Optional[SafetyLayerState]:
+        """Capa de seguridad materializada en la versión que pide la tarea (None si no pide ninguna)"""
+        version = request.get('safety_layer')
+        if version is None:
+            return None
+        if safety_layer is None:
+            raise Exception("La capa de seguridad del servidor no está disponible")
+        return self.safety_layer_state(safety_layer, version, stats)
+    
+    def calculate_matrix_task(self, request: dict, safety_layer=None) -> dict:
+        """
+        Calcula rutas para muchos pares origen/destino. Los pares se agrupan por
+        origen y un solo árbol de Dijkstra sirve a todos sus destinos. Sin 'pairs'
+        se calcula la matriz completa origins x destinations.
+        """
+        try:
+            start_time = time.time()
+            
+            if self.compiled is None:
+                raise Exception("El grafo no ha sido cargado. Primero llama a download_map()")
+            compiled = self.compiled
+            
+            origins = request['origins']
+            destinations = request['destinations']
+            pairs = request.get('pairs')
+            if pairs is None:
+                pairs = [(i, j) for i in range(len(origins)) for j in range(len(destinations))]
+            
+            # Ajustar todos los puntos en una sola consulta
+            points = origins + destinations
+            snapped, _ = self.spatial_index.query([p['lat'] for p in points], [p['lon'] for p in points])
+            origin_nodes = snapped[:len(origins)].tolist()
+            destination_nodes = snapped[len(origins):].tolist()
+            
+            context = RouteContext(
+                start_node=None,
+                end_node=None,
+                optimization=request['optimization'],
+                heuristic=None,
+                distance_weight=request['distance_weight'],
+                time_weight=request['time_weight'],
+                safety_weight=request['safety_weight'],
+                zones=self.build_safety_zones(self._safety_tuples(request))
+            )
+            edge_safety = self.compute_edge_safety(context.zones, layer=self._request_layer(request, safety_layer))
+            weights = self.compiled_edge_weights(context, edge_safety)
+            edge_time = compiled.edge_time()
+            
+            # Agrupar por nodo de origen: un árbol por origen
+            by_origin = OrderedDict()
+            for k, (i, j) in enumerate(pairs):
+                by_origin.setdefault(origin_nodes[i], []).append((k, destination_nodes[j]))
+            
+            include_geometry = request.get('geometry', False)
+            cost = [None] * len(pairs)
+            distance = [None] * len(pairs)
+            travel_time = [None] * len(pairs)
+            safety = [None] * len(pairs)
+            paths = [None] * len(pairs) if include_geometry else None
+            
+            for origin, items in by_origin.items():
+                settled, parent_edge = compiled.shortest_path_tree(
+                    origin, weights, targets={target for _, target in items}
+                )
+                for k, target in items:
+                    if target not in settled:
+                        continue  # destino inalcanzable
+                    edges = compiled.tree_path_edges(parent_edge, target)
+                    cost[k] = settled[target]
+                    distance[k] = float(compiled.edge_length[edges].sum())
+                    travel_time[k] = float(edge_time[edges].sum())
+                    safety[k] = float(edge_safety[edges].sum())
+                    if include_geometry:
+                        nodes = [origin] + compiled.targets[edges].tolist()
+                        paths[k] = list(zip(compiled.lat[nodes].tolist(), compiled.lon[nodes].tolist()))
+            
+            result = {
+                'pairs': [list(pair) for pair in pairs],
+                'cost': cost,
+                'distance': distance,
+                'time': travel_time,
+                'safety': safety,
+                'summary': {
+                    'pairs': len(pairs),
+                    'unreachable': sum(1 for c in cost if c is None),
+                    'searches': len(by_origin),
+                    'optimization': request['optimization'],
+                    'safety_layer': request.get('safety_layer'),
+                    'processing_time': time.time() - start_time
+                },
+                'status': 'completed'
+            }
+            if include_geometry:
+                result['paths'] = paths
+            
+            logger.info(f"Matriz de {len(pairs)} pares calculada con {len(by_origin)} búsquedas "
+                        f"en {result['summary']['processing_time']:.2f} segundos")
+            return result
+            
+        except Exception as e:
+            logger.error(f"Error en cálculo de matriz: {str(e)}\n{traceback.format_exc()}")
+            return {
+                "error": str(e),
+                "status": "failed",
+                "traceback": traceback.format_exc()
+            }
+    
+    def calculate_isochrone_task(self, request: dict, safety_layer=None) -> dict:
+        """
+        Nodos alcanzables desde un punto dentro de varios cortes de distancia (metros) o
+        de tiempo (minutos). Las rutas siguen el modelo de costo de la optimización pedida
+        y un solo Dijkstra acotado por el corte mayor sirve a todos los cortes. Cada corte
+        devuelve el polígono que envuelve sus nodos (GeoJSON) o la lista de nodos.
+        """
+        try:
+            start_time = time.time()
+            
+            if self.compiled is None:
+                raise Exception("El grafo no ha sido cargado. Primero llama a download_map()")
+            compiled = self.compiled
+            
+            timings = {}
+            search_stats = {}
+            phase_start = time.perf_counter()
+            
+            metric = request['metric']
+            if metric not in self.ISOCHRONE_UNITS:
+                raise Exception(f"Métrica no válida: {metric}. Opciones: {', '.join(self.ISOCHRONE_UNITS)}")
+            cutoffs = sorted(float(cutoff) for cutoff in request['cutoffs'])
+            
+            snapped, _ = self.spatial_index.query([request['lat']], [request['lon']])
+            origin = int(snapped[0])
+            context = RouteContext(
+                start_node=int(compiled.node_ids[origin]),
+                end_node=None,
+                optimization=request['optimization'],
+                heuristic=None,
+                distance_weight=request['distance_weight'],
+                time_weight=request['time_weight'],
+                safety_weight=request['safety_weight'],
+                zones=self.build_safety_zones(self._safety_tuples(request))
+            )
+            timings['snapping'] = time.perf_counter() - phase_start
+            
+            phase_start = time.perf_counter()
+            layer_state = self._request_layer(request, safety_layer, search_stats)
+            edge_safety = self.compute_edge_safety(context.zones, search_stats, layer_state)
+            timings['safety_influence'] = time.perf_counter() - phase_start
+            
+            phase_start = time.perf_counter()
+            weights = self.compiled_edge_weights(context, edge_safety)
+            measure = compiled.edge_length if metric == 'distance' else compiled.edge_time() / 60
+            reached = compiled.reachable_within(origin, weights, measure, cutoffs[-1], search_stats)
+            timings['search'] = time.perf_counter() - phase_start
+            
+            phase_start = time.perf_counter()
+            nodes = np.fromiter(reached.keys(), dtype=np.int64, count=len(reached))
+            amounts = np.fromiter(reached.values(), dtype=np.float64, count=len(reached))
+            output = request.get('output', 'polygon')
+            isochrones = []
+            for cutoff in cutoffs:
+                inside = nodes[amounts <= cutoff]
+                isochrone = {'cutoff': cutoff, 'nodes_count': len(inside)}
+                if output == 'nodes':
+                    isochrone['nodes'] = compiled.node_ids[inside].tolist()
+                else:
+                    isochrone['polygon'] = self._reachability_polygon(inside)
+                isochrones.append(isochrone)
+            timings['assembly'] = time.perf_counter() - phase_start
+            
+            result = {
+                'origin': {
+                    'lat': float(compiled.lat[origin]),
+                    'lon': float(compiled.lon[origin]),
+                    'node': int(compiled.node_ids[origin])
+                },
+                'metric': metric,
+                'unit': self.ISOCHRONE_UNITS[metric],
+                'isochrones': isochrones,
+                'summary': {
+                    'reachable_nodes': len(reached),
+                    'cutoffs': cutoffs,
+                    'optimization': request['optimization'],
+                    'safety_layer': request.get('safety_layer'),
+                    'processing_time': time.time() - start_time
+                },
+                'metadata': {
+                    'search': 'dijkstra',
+                    'region_id': request.get('region_id'),
+                    'nodes_expanded': search_stats.get('nodes_expanded'),
+                    'edges_relaxed': search_stats.get('edges_relaxed'),
+                    'cache': {'safety_hit': search_stats.get('safety_cache_hit')},
+                    'timings': timings
+                },
+                'status': 'completed'
+            }
+            
+            logger.info(f"Isócrona con {len(cutoffs)} cortes ({len(reached)} nodos alcanzables) calculada "
+                        f"en {result['summary']['processing_time']:.2f} segundos")
+            return result
+            
+        except Exception as e:
+            logger.error(f"Error en cálculo de isócrona: {str(e)}\n{traceback.format_exc()}")
+            return {
+                "error": str(e),
+                "status": "failed",
+                "traceback": traceback.format_exc()
+            }
+    
+    def _reachability_polygon(self, nodes: np.ndarray) -> Optional[Dict]:
+        """Envolvente cóncava (GeoJSON, lon/lat) de un conjunto de nodos; None si está vacío"""
+        if len(nodes) == 0:
+            return None
+        points = shapely.MultiPoint(np.column_stack((self.compiled.lon[nodes], self.compiled.lat[nodes])))
+        hull = shapely.concave_hull(points, ratio=self.ISOCHRONE_HULL_RATIO)
+        # Misma precisión que las geometrías de las rutas
+        return mapping(shapely.set_precision(hull, 10 ** -POLYLINE_PRECISION))
+    
+    def run_task(self, request: dict, safety_layer=None) -> dict:
+        """Despacha una tarea de cálculo según su tipo ('route', 'matrix' o 'isochrone')"""
+        if request.get('task') == 'matrix':
+            return self.calculate_matrix_task(request, safety_layer)
+        if request.get('task') == 'isochrone':
+            return self.calculate_isochrone_task(request, safety_layer)
+        return self.calculate_route_task(request, safety_layer)
+    
     def _get_safety_level(self, safety_score: float) -> str:
         """Convierte un puntaje de seguridad a nivel descriptivo"""
         if safety_score < 1:
@@ -398,4 +1321,5 @@ class OSMProcessor:
         elif safety_score < 4:
             return "Inseguro"
         else:
-            return "Muy inseguro"
\ No newline at end of file
+            return "Muy inseguro"
+
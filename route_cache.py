@@ -0,0 +1,341 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Event, Lock
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class RouteCache:
+    """
+    Caché de rutas acotada (LRU por entradas y bytes, con TTL) y persistida de forma
+    incremental en SQLite, donde también se acota el número de resultados guardados. Los estados de las tareas se guardan aparte de los resultados:
+    un resultado se almacena una sola vez bajo su cache_key y las tareas lo referencian.
+
+    La base (en modo WAL) es compartida por todos los procesos de la aplicación: cada
+    uno ve las tareas y resultados de los demás, y un cálculo en curso se reclama por
+    cache_key para que dos procesos no calculen la misma ruta a la vez.
+    """
+
+    FINAL_STATUSES = ('completed', 'failed')
+
+    def __init__(self, db_path, max_entries: int = 1000, max_bytes: int = 256 * 1024 * 1024,
+                 ttl: float = 24 * 3600, max_tasks: int = 10000,
+                 poll_interval: float = 1.0, max_disk_entries: int = 10000):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries  # resultados en disco; se borran los más antiguos
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_tasks = max_tasks
+        self.poll_interval = poll_interval  # espera entre consultas de tareas calculadas en otros procesos
+
+        self._lock = Lock()
+        self._results = OrderedDict()  # cache_key -> (resultado, bytes, creado)
+        self._task_events = {}         # task_id -> Events de finalización, uno por cada espera en curso
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Persistencia: una fila por resultado, escrita al momento de guardarlo. Sin
+        # transacciones implícitas; las escrituras usan _transaction
+        self._db_lock = Lock()
+        self._db = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "cache_key TEXT PRIMARY KEY, payload TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_created ON results (created)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "task_id TEXT PRIMARY KEY, status TEXT NOT NULL, cache_key TEXT, error TEXT, "
+            "fields TEXT NOT NULL, created REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS tasks_cache_key ON tasks (cache_key, status)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tasks_created ON tasks (created)")
+        # Cálculos en curso: qué proceso calcula cada cache_key. El pid solo no basta (se
+        # reutiliza tras un reinicio o en otro contenedor): va junto a su instante de arranque
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS claims (cache_key TEXT PRIMARY KEY, owner INTEGER NOT NULL, claimed REAL NOT NULL, "
+            "token TEXT NOT NULL DEFAULT '')"
+        )
+        if 'token' not in [row[1] for row in self._db.execute("PRAGMA table_info(claims)")]:
+            self._db.execute("ALTER TABLE claims ADD COLUMN token TEXT NOT NULL DEFAULT ''")
+        self._token = _process_token(os.getpid())
+        self._writes = 0
+        with self._db_lock:
+            self._purge()
+
+    # --- Resultados -----------------------------------------------------------
+
+    def get_result(self, cache_key: str, record: bool = True) -> Optional[Dict]:
+        """
+        Devuelve un resultado desde memoria o, si no está, desde disco (carga perezosa).
+        Con `record` en falso la consulta no cuenta como acierto o fallo de la caché.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._results.get(cache_key)
+            if entry is not None:
+                result, size, created = entry
+                if now - created <= self.ttl:
+                    self._results.move_to_end(cache_key)
+                    self.hits += record
+                    return result
+                self._remove(cache_key)
+
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT payload, created FROM results WHERE cache_key = ?", (cache_key,)
+            ).fetchone()
+
+        if row is None or now - row[1] > self.ttl:
+            with self._lock:
+                self.misses += record
+            return None
+
+        result = json.loads(row[0])
+        with self._lock:
+            self.hits += record
+            self._insert(cache_key, result, len(row[0]), row[1])
+        return result
+
+    def has_result(self, cache_key: str) -> bool:
+        return self.get_result(cache_key) is not None
+
+    def put_result(self, cache_key: str, result: Dict):
+        """Guarda un resultado en memoria y lo añade a disco sin reescribir el resto"""
+        payload = json.dumps(result)
+        created = time.time()
+        with self._lock:
+            self._insert(cache_key, result, len(payload), created)
+
+        with self._transaction() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO results (cache_key, payload, created) VALUES (?, ?, ?)",
+                (cache_key, payload, created)
+            )
+
+    def _purge(self):
+        """Elimina de disco los resultados vencidos o que exceden el límite y las tareas más antiguas (requiere _db_lock)"""
+        self._db.execute("DELETE FROM results WHERE created < ?", (time.time() - self.ttl,))
+        self._db.execute(
+            "DELETE FROM results WHERE created < ("
+            "SELECT created FROM results ORDER BY created DESC LIMIT 1 OFFSET ?)",
+            (self.max_disk_entries,)
+        )
+        self._db.execute(
+            "DELETE FROM tasks WHERE status IN ('completed', 'failed') AND created < ("
+            "SELECT created FROM tasks ORDER BY created DESC LIMIT 1 OFFSET ?)",
+            (self.max_tasks,)
+        )
+
+    def _insert(self, cache_key: str, result: Dict, size: int, created: float):
+        """Inserta en el LRU en memoria y desaloja lo más antiguo (requiere _lock)"""
+        if cache_key in self._results:
+            self._remove(cache_key)
+        self._results[cache_key] = (result, size, created)
+        self._bytes += size
+
+        while self._results and (len(self._results) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._results))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, cache_key: str):
+        _, size, _ = self._results.pop(cache_key)
+        self._bytes -= size
+
+    # --- Tareas ---------------------------------------------------------------
+    # Las tareas viven sólo en SQLite: todos los procesos de gunicorn ven las mismas.
+    # Cada cambio de estado es una transacción (BEGIN IMMEDIATE) y una tarea terminada
+    # no vuelve a cambiar de estado.
+
+    def set_task(self, task_id: str, status: str, cache_key: Optional[str] = None,
+                 error: Optional[str] = None, **fields):
+        """Crea o actualiza el registro de estado de una tarea"""
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT status, cache_key, error, fields, created FROM tasks WHERE task_id = ?", (task_id,)
+            ).fetchone()
+            if row is not None and row[0] in self.FINAL_STATUSES:
+                return
+            previous = json.loads(row[3]) if row is not None else {}
+            db.execute(
+                "INSERT OR REPLACE INTO tasks (task_id, status, cache_key, error, fields, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (task_id, status, cache_key if cache_key is not None else (row[1] if row else None),
+                 error, json.dumps({**previous, **fields}), row[4] if row else now, now)
+            )
+        if status in self.FINAL_STATUSES:
+            self._notify([task_id])
+
+    def start_task(self, task_id: str, cache_key: str, **fields) -> bool:
+        """
+        Registra una tarea en proceso (con sus `fields`) y reclama su cálculo. Devuelve True si este
+        proceso debe calcularlo; False si otro (o este mismo) ya lo está calculando
+        y la tarea quedó adjunta: se completará cuando termine ese cálculo.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO tasks (task_id, status, cache_key, error, fields, created, updated) "
+                "VALUES (?, 'processing', ?, NULL, ?, ?, ?)",
+                (task_id, cache_key, json.dumps(fields), now, now)
+            )
+            claim = db.execute(
+                "SELECT owner, token FROM claims WHERE cache_key = ?", (cache_key,)
+            ).fetchone()
+            if claim is not None and not self._stale_claim(*claim):
+                return False
+            db.execute(
+                "INSERT OR REPLACE INTO claims (cache_key, owner, claimed, token) VALUES (?, ?, ?, ?)",
+                (cache_key, os.getpid(), now, self._token)
+            )
+        return True
+
+    def finish_tasks(self, cache_key: str, status: str, error: Optional[str] = None):
+        """Termina todas las tareas en proceso de un cálculo, de cualquier proceso, y libera su reclamo"""
+        with self._transaction() as db:
+            task_ids = [row[0] for row in db.execute(
+                "SELECT task_id FROM tasks WHERE cache_key = ? AND status = 'processing'", (cache_key,)
+            )]
+            db.execute(
+                "UPDATE tasks SET status = ?, error = ?, updated = ? WHERE cache_key = ? AND status = 'processing'",
+                (status, error, time.time(), cache_key)
+            )
+            db.execute("DELETE FROM claims WHERE cache_key = ?", (cache_key,))
+        self._notify(task_ids)
+
+    def get_task(self, task_id: str) -> Optional[Dict]:
+        return self._load_task(task_id)[0]
+
+    def _load_task(self, task_id: str) -> Tuple[Optional[Dict], bool]:
+        """(registro de la tarea, True si su cálculo lo reclamó este proceso)"""
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT t.status, t.cache_key, t.error, t.fields, t.created, c.owner, c.token "
+                "FROM tasks t LEFT JOIN claims c ON c.cache_key = t.cache_key WHERE t.task_id = ?",
+                (task_id,)
+            ).fetchone()
+        if row is None:
+            return None, False
+
+        status, cache_key, error, fields, created, owner, token = row
+        if status == 'processing' and (owner is None or self._stale_claim(owner, token)):
+            # El proceso que calculaba la ruta terminó sin marcarla (p. ej. reinicio del worker)
+            logger.warning(f"Cálculo interrumpido para {cache_key}; se marcan sus tareas como fallidas")
+            self.finish_tasks(cache_key, 'failed', "El cálculo se interrumpió; vuelve a solicitar la ruta")
+            return self._load_task(task_id)
+
+        task = dict(json.loads(fields), status=status, cache_key=cache_key, created=created)
+        if error is not None:
+            task['error'] = error
+        return task, owner == os.getpid() and token == self._token
+
+    def wait_task(self, task_id: str, timeout: float) -> Optional[Dict]:
+        """
+        Espera hasta `timeout` segundos a que la tarea termine y devuelve su registro
+        (todavía en proceso si se agotó el tiempo, None si no existe). Si el cálculo es
+        de este proceso se espera su aviso sin consultar la base; las tareas calculadas
+        en otros procesos se consultan cada poll_interval.
+        """
+        deadline = time.time() + timeout
+        # Cada espera tiene su propio Event: la que termina primero (o agota su tiempo)
+        # no deja sin aviso a las demás
+        event = Event()
+        with self._lock:
+            self._task_events.setdefault(task_id, set()).add(event)
+        try:
+            while True:
+                task, local = self._load_task(task_id)
+                remaining = deadline - time.time()
+                if task is None or task['status'] in self.FINAL_STATUSES or remaining <= 0:
+                    return task
+                event.wait(remaining if local else min(remaining, self.poll_interval))
+        finally:
+            with self._lock:
+                waiters = self._task_events.get(task_id)
+                if waiters is not None:
+                    waiters.discard(event)
+                    if not waiters:
+                        del self._task_events[task_id]
+
+    def _notify(self, task_ids: List[str]):
+        """Despierta a quienes esperan estas tareas en este proceso"""
+        with self._lock:
+            for task_id in task_ids:
+                for event in self._task_events.pop(task_id, ()):
+                    event.set()
+
+    def _stale_claim(self, owner: int, token: str) -> bool:
+        """
+        Un reclamo vence sólo si su proceso ya no existe: un cálculo largo o en espera
+        de la precarga sigue siendo válido mientras su dueño viva. Con /proc se compara
+        además el instante de arranque, así un pid reutilizado tras un reinicio no pasa
+        por el proceso original.
+        """
+        if self._token:
+            return _process_token(owner) != token
+        try:
+            os.kill(owner, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            pass
+        return False
+
+    @contextmanager
+    def _transaction(self):
+        """Transacción de escritura: BEGIN IMMEDIATE serializa los cambios entre procesos"""
+        with self._db_lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._purge()
+
+    def stats(self) -> Dict:
+        with self._db_lock:
+            tasks = self._db.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+        with self._lock:
+            return {
+                'entries': len(self._results),
+                'bytes': self._bytes,
+                'tasks': tasks,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def close(self):
+        with self._db_lock:
+            self._db.close()
+
+
+def _process_token(pid: int) -> str:
+    """
+    Instante de arranque de un proceso (campo starttime de /proc/<pid>/stat). Cadena
+    vacía si el proceso no existe o el sistema no tiene /proc.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            stat = f.read()
+    except OSError:
+        return ""
+    # El nombre del proceso va entre paréntesis y puede contener espacios
+    return stat[stat.rindex(')') + 2:].split()[19]
@@ -0,0 +1,70 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+POLYLINE_PRECISION = 6  # decimales de las coordenadas (~0.1 m)
+
+# Columnas por segmento de una ruta compacta
+SEGMENT_COLUMNS = ('distance', 'time', 'speed', 'safety', 'safety_level')
+
+
+def encode_polyline(lats, lons, precision: int = POLYLINE_PRECISION) -> str:
+    """Codifica coordenadas con el algoritmo de polilíneas de Google"""
+    factor = 10 ** precision
+    points = np.column_stack([np.round(np.asarray(lats) * factor), np.round(np.asarray(lons) * factor)]).astype(np.int64)
+    deltas = np.diff(points, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+
+    chunks = []
+    for value in ((deltas << 1) ^ (deltas >> 63)).tolist():
+        while value >= 0x20:
+            chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
+
+def decode_polyline(encoded: str, precision: int = POLYLINE_PRECISION) -> List[Tuple[float, float]]:
+    """Inverso de encode_polyline: lista de (lat, lon)"""
+    values = []
+    value = shift = 0
+    for char in encoded:
+        byte = ord(char) - 63
+        value |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+
+    points = np.cumsum(np.asarray(values, dtype=np.int64).reshape(-1, 2), axis=0) / 10 ** precision
+    return [tuple(point) for point in points.tolist()]
+
+
+def format_route(result: Dict, segments: bool = False, full: bool = False) -> Dict:
+    """
+    Da forma a una ruta guardada en caché para la respuesta. Por defecto se envía
+    la geometría codificada sin detalle por segmento; `segments` agrega las columnas
+    por segmento y `full` reconstruye el formato expandido (path + lista de segmentos).
+    Los resultados sin geometría codificada (matrices, rutas antiguas) no se tocan.
+    """
+    if 'geometry' not in result:
+        return result
+    if full:
+        return expand_route(result)
+    if segments:
+        return result
+    return {key: value for key, value in result.items() if key != 'segments'}
+
+
+def expand_route(result: Dict) -> Dict:
+    """Formato expandido: coordenadas del camino y un diccionario por segmento"""
+    path = decode_polyline(result['geometry'], result.get('geometry_precision', POLYLINE_PRECISION))
+    columns = result['segments']
+    segments = [
+        dict(start=start, end=end, **{name: columns[name][i] for name in SEGMENT_COLUMNS})
+        for i, (start, end) in enumerate(zip(path, path[1:]))
+    ]
+
+    expanded = {key: value for key, value in result.items() if key not in ('geometry', 'geometry_precision')}
+    expanded['path'] = path
+    expanded['segments'] = segments
+    return expanded
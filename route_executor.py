@@ -0,0 +1,91 @@
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from typing import Dict, List, Optional
+
+from graph_preloader import GraphPreloader
+from graph_registry import GraphRegistry
+from safety_layer import SafetyLayer
+
+logger = logging.getLogger(__name__)
+
+# Registro propio de cada proceso del pool: los grafos se cargan desde disco con mmap,
+# así todos los procesos comparten las mismas páginas físicas.
+_worker_registry = None
+_worker_safety_layer = None
+
+
+def _init_worker(graphs_dir: str, max_bytes: int, landmark_count: int, contraction_hierarchies: bool,
+                 safety_layer_path: str, preload_regions: List[str]):
+    global _worker_registry, _worker_safety_layer
+    _worker_registry = GraphRegistry(graphs_dir, max_bytes=max_bytes, landmark_count=landmark_count,
+                                     contraction_hierarchies=contraction_hierarchies)
+    # Conexión propia a la capa de seguridad: no se comparte entre procesos
+    _worker_safety_layer = SafetyLayer(safety_layer_path) if safety_layer_path else None
+    # Cada proceso precarga sus regiones en segundo plano; una tarea que llega antes
+    # espera al candado de carga de la región en el registro
+    GraphPreloader(_worker_registry, preload_regions).start()
+
+
+def _ping() -> bool:
+    return True
+
+
+def _calculate(region_id: str, request_dict: Dict) -> Dict:
+    processor = _worker_registry.get(region_id)
+    return processor.run_task(request_dict, _worker_safety_layer)
+
+
+class ProcessRouteExecutor:
+    """Ejecuta las tareas de cálculo en un pool de procesos para usar todos los núcleos"""
+
+    def __init__(self, graphs_dir, processes: int, max_bytes: int, landmark_count: int = 8,
+                 contraction_hierarchies: bool = False, safety_layer_path=None,
+                 preload_regions: Optional[List[str]] = None):
+        self.graphs_dir = str(graphs_dir)
+        self.processes = processes
+        self.max_bytes = max_bytes
+        self.landmark_count = landmark_count
+        self.contraction_hierarchies = contraction_hierarchies
+        self.safety_layer_path = str(safety_layer_path) if safety_layer_path else None
+        self.preload_regions = list(preload_regions or [])
+        self._lock = Lock()
+        self._pool = self._create_pool()
+
+    def _create_pool(self) -> ProcessPoolExecutor:
+        # forkserver: los procesos salen de un servidor sin hilos, así el pool puede
+        # recrearse con los hilos de gunicorn y del planificador ya en marcha (fork no
+        # es seguro con hilos). El servidor importa los módulos de cálculo una sola vez.
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        context = multiprocessing.get_context(method)
+        if method == "forkserver":
+            context.set_forkserver_preload([__name__])
+        pool = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(self.graphs_dir, self.max_bytes, self.landmark_count, self.contraction_hierarchies,
+                      self.safety_layer_path, self.preload_regions)
+        )
+        # Arrancar los procesos ya: la primera tarea no espera a que carguen
+        pool.submit(_ping).result()
+        logger.info(f"Pool de {self.processes} procesos de cálculo iniciado ({method})")
+        return pool
+
+    def calculate(self, region_id: str, request_dict: Dict) -> Dict:
+        """Calcula una tarea en un proceso del pool; los errores se propagan al llamador"""
+        pool = self._pool
+        try:
+            return pool.submit(_calculate, region_id, request_dict).result()
+        except BrokenProcessPool:
+            # Un proceso murió (p. ej. por falta de memoria): se recrea el pool
+            with self._lock:
+                if self._pool is pool:
+                    logger.error("Pool de procesos roto, reiniciando")
+                    self._pool = self._create_pool()
+            raise
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
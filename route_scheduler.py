@@ -0,0 +1,84 @@
+import logging
+import traceback
+from collections import deque
+from threading import Condition, Thread
+from typing import Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """La cola de cálculos está llena; el cliente debe reintentar más tarde"""
+
+
+class RouteJob:
+    """Un cálculo de ruta pendiente, encolado por la tarea que reclamó su cache_key"""
+
+    def __init__(self, cache_key: str, request_dict: Dict, task_id: str):
+        self.cache_key = cache_key
+        self.request_dict = request_dict
+        self.task_id = task_id
+
+
+class RouteScheduler:
+    """
+    Pool fijo de hilos con una cola acotada. No deduplica: las peticiones idénticas
+    se adjuntan antes, al reclamar su cache_key en RouteCache (compartida entre
+    procesos), y sólo la que obtiene el reclamo llega a encolarse aquí.
+
+    `run_job(job)` calcula (y guarda en caché) el resultado y devuelve un estado;
+    `finish_job(job, outcome)` se llama después y termina las tareas adjuntas.
+    """
+
+    def __init__(self, run_job: Callable[[RouteJob], Dict],
+                 finish_job: Callable[[RouteJob, Dict], None],
+                 workers: int = 4, max_queue: int = 100):
+        self.run_job = run_job
+        self.finish_job = finish_job
+        self.max_queue = max_queue
+        self._condition = Condition()
+        self._pending = deque()   # trabajos en espera, en orden de llegada
+        self._running = 0
+
+        for i in range(workers):
+            Thread(target=self._worker, name=f"route-worker-{i}", daemon=True).start()
+
+    def submit(self, cache_key: str, request_dict: Dict, task_id: str) -> int:
+        """
+        Encola un cálculo y devuelve su posición en la cola (1 = el siguiente en ejecutarse).
+        Lanza QueueFullError si la cola está llena.
+        """
+        with self._condition:
+            if len(self._pending) >= self.max_queue:
+                raise QueueFullError(f"Cola de cálculos llena ({self.max_queue} pendientes)")
+
+            self._pending.append(RouteJob(cache_key, request_dict, task_id))
+            self._condition.notify()
+            return len(self._pending)
+
+    def stats(self) -> Dict:
+        with self._condition:
+            return {
+                "queued": len(self._pending),
+                "running": self._running,
+                "max_queue": self.max_queue
+            }
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                job = self._pending.popleft()
+                self._running += 1
+
+            try:
+                outcome = self.run_job(job)
+            except Exception as e:
+                logger.error(f"Error no controlado en el cálculo de {job.cache_key}: {str(e)}\n{traceback.format_exc()}")
+                outcome = {"status": "failed", "error": str(e)}
+
+            with self._condition:
+                self._running -= 1
+
+            self.finish_job(job, outcome)
@@ -0,0 +1,252 @@
+import json
+import logging
+import sqlite3
+import time
+import uuid
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ZONE_FIELDS = ('lat', 'lon', 'radius', 'safety_index', 'weight')
+
+
+def validate_zone(data: Dict, base: Optional[Dict] = None) -> Dict:
+    """Zona normalizada a partir de los campos recibidos (sobre `base` en una edición)"""
+    zone = dict(base or {'weight': 1.0})
+    zone.update({field: data[field] for field in ZONE_FIELDS if field in data})
+    missing = [field for field in ZONE_FIELDS if zone.get(field) is None]
+    if missing:
+        raise ValueError(f"Faltan campos de la zona de seguridad: {', '.join(missing)}")
+
+    try:
+        zone = {
+            'lat': float(zone['lat']),
+            'lon': float(zone['lon']),
+            'radius': float(zone['radius']),
+            'safety_index': int(zone['safety_index']),
+            'weight': float(zone['weight'])
+        }
+    except (TypeError, ValueError):
+        raise ValueError("Los campos de la zona de seguridad deben ser numéricos")
+    if not (-90 <= zone['lat'] <= 90 and -180 <= zone['lon'] <= 180):
+        raise ValueError("Coordenadas de la zona de seguridad fuera de rango")
+    if zone['radius'] <= 0:
+        raise ValueError("El radio de la zona de seguridad debe ser positivo")
+    if not 1 <= zone['safety_index'] <= 5:
+        raise ValueError("El índice de seguridad debe estar entre 1 y 5")
+    if zone['weight'] < 0:
+        raise ValueError("El peso de la zona de seguridad no puede ser negativo")
+    return zone
+
+
+class SafetyLayer:
+    """
+    Capa de zonas de seguridad administrada en el servidor y persistida en SQLite.
+    Cada cambio (alta, edición, baja o importación) crea una versión nueva y guarda
+    el estado anterior y posterior de cada zona tocada, así un procesador puede pasar
+    de una versión a otra recalculando sólo las zonas que cambiaron.
+    La versión 0 es la capa vacía.
+    """
+
+    def __init__(self, db_path):
+        self._lock = Lock()
+        # Sin transacciones implícitas: cada cambio abre la suya con BEGIN IMMEDIATE,
+        # así dos procesos no pueden asignar la misma versión
+        self._db = sqlite3.connect(str(db_path), check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS zones ("
+            "zone_id TEXT PRIMARY KEY, lat REAL NOT NULL, lon REAL NOT NULL, radius REAL NOT NULL, "
+            "safety_index INTEGER NOT NULL, weight REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS versions ("
+            "version INTEGER PRIMARY KEY, created REAL NOT NULL, changed INTEGER NOT NULL, description TEXT)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS changes ("
+            "version INTEGER NOT NULL, zone_id TEXT NOT NULL, before TEXT, after TEXT)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS changes_version ON changes (version)")
+
+    # --- Lectura ----------------------------------------------------------------
+
+    @property
+    def version(self) -> int:
+        with self._lock:
+            return self._version()
+
+    def _version(self) -> int:
+        return self._db.execute("SELECT COALESCE(MAX(version), 0) FROM versions").fetchone()[0]
+
+    def zones(self, version: Optional[int] = None) -> Tuple[int, Dict[str, Dict]]:
+        """(versión, zonas por id ordenadas por id) en la versión pedida o la actual"""
+        with self._lock:
+            # Una sola transacción de lectura: zonas, versión e historial consistentes
+            self._db.execute("BEGIN")
+            try:
+                current = self._version()
+                rows = self._db.execute(f"SELECT zone_id, {', '.join(ZONE_FIELDS)} FROM zones").fetchall()
+                history = self._changes(current if version is None else version, current)
+            finally:
+                self._db.execute("COMMIT")
+        if version is None:
+            version = current
+        self._check_version(version, current)
+
+        zones = {row[0]: dict(zip(ZONE_FIELDS, row[1:])) for row in rows}
+        # Deshacer los cambios posteriores a la versión pedida
+        for zone_id, (before, _) in self._collapse(history).items():
+            if before is None:
+                zones.pop(zone_id, None)
+            else:
+                zones[zone_id] = before
+        return version, dict(sorted(zones.items()))
+
+    def diff(self, from_version: int, to_version: int) -> Dict[str, Tuple[Optional[Dict], Optional[Dict]]]:
+        """
+        Zonas que difieren entre dos versiones (en cualquier sentido):
+        {zone_id: (zona en from_version, zona en to_version)}, None si no existía.
+        """
+        with self._lock:
+            current = self._version()
+            self._check_version(from_version, current)
+            self._check_version(to_version, current)
+            history = self._changes(min(from_version, to_version), max(from_version, to_version))
+
+        collapsed = self._collapse(history)
+        if from_version > to_version:
+            collapsed = {zone_id: (after, before) for zone_id, (before, after) in collapsed.items()}
+        return collapsed
+
+    def history(self, limit: int = 50) -> List[Dict]:
+        """Últimas versiones de la capa, de la más reciente a la más antigua"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT version, created, changed, description FROM versions ORDER BY version DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return [dict(zip(('version', 'created', 'changed', 'description'), row)) for row in rows]
+
+    def _changes(self, after_version: int, until_version: int) -> List[Tuple]:
+        return self._db.execute(
+            "SELECT zone_id, before, after FROM changes WHERE version > ? AND version <= ? ORDER BY version, rowid",
+            (after_version, until_version)
+        ).fetchall()
+
+    @staticmethod
+    def _collapse(history: Iterable[Tuple]) -> Dict[str, Tuple[Optional[Dict], Optional[Dict]]]:
+        """Reduce una secuencia de cambios al primer estado y al último de cada zona"""
+        collapsed = {}
+        for zone_id, before, after in history:
+            first = collapsed[zone_id][0] if zone_id in collapsed else _loads(before)
+            collapsed[zone_id] = (first, _loads(after))
+        return {zone_id: states for zone_id, states in collapsed.items() if states[0] != states[1]}
+
+    @staticmethod
+    def _check_version(version: int, current: int):
+        if not 0 <= version <= current:
+            raise ValueError(f"Versión de la capa de seguridad desconocida: {version} (actual: {current})")
+
+    # --- Cambios ----------------------------------------------------------------
+
+    def add(self, data: Dict) -> Tuple[int, str]:
+        """Agrega una zona; devuelve (versión, id). Un "id" existente se reemplaza"""
+        zone_id = str(data.get('id') or uuid.uuid4().hex)
+        zone = validate_zone(data)
+        version = self._commit([zone_id], lambda before: {zone_id: zone}, f"add {zone_id}")
+        return version, zone_id
+
+    def update(self, zone_id: str, data: Dict) -> int:
+        """Modifica los campos dados de una zona existente (KeyError si no existe)"""
+        def plan(before):
+            if before[zone_id] is None:
+                raise KeyError(zone_id)
+            return {zone_id: validate_zone(data, before[zone_id])}
+        return self._commit([zone_id], plan, f"update {zone_id}")
+
+    def remove(self, zone_id: str) -> int:
+        """Elimina una zona (KeyError si no existe)"""
+        def plan(before):
+            if before[zone_id] is None:
+                raise KeyError(zone_id)
+            return {zone_id: None}
+        return self._commit([zone_id], plan, f"remove {zone_id}")
+
+    def import_zones(self, zones: List[Dict], replace: bool = False) -> Tuple[int, List[str]]:
+        """
+        Importa muchas zonas en una sola versión. Las que traen "id" reemplazan a la
+        zona con ese id; con `replace` se eliminan las zonas que no vengan en la lista.
+        """
+        items = [(str(data.get('id') or uuid.uuid4().hex), validate_zone(data)) for data in zones]
+        ids = [zone_id for zone_id, _ in items]
+
+        def plan(before):
+            after = {zone_id: None for zone_id in before} if replace else {}
+            after.update(items)
+            return after
+        version = self._commit(ids, plan, f"import {len(items)}" + (" (replace)" if replace else ""), replace)
+        return version, ids
+
+    def _commit(self, zone_ids: List[str], plan: Callable[[Dict], Dict], description: str,
+                replace: bool = False) -> int:
+        """
+        Aplica un cambio en una transacción: `plan` recibe el estado actual de las zonas
+        involucradas y devuelve el nuevo (None elimina). Si nada cambia no se crea versión.
+        """
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                if replace:
+                    zone_ids = list(zone_ids) + [row[0] for row in self._db.execute("SELECT zone_id FROM zones")]
+                before = {zone_id: self._read(zone_id) for zone_id in zone_ids}
+                after = plan(before)
+                changed = [(zone_id, before[zone_id], zone) for zone_id, zone in after.items()
+                           if before[zone_id] != zone]
+                version = self._version()
+                if changed:
+                    version += 1
+                    for zone_id, _, zone in changed:
+                        if zone is None:
+                            self._db.execute("DELETE FROM zones WHERE zone_id = ?", (zone_id,))
+                        else:
+                            self._db.execute(
+                                f"INSERT OR REPLACE INTO zones (zone_id, {', '.join(ZONE_FIELDS)}) "
+                                "VALUES (?, ?, ?, ?, ?, ?)",
+                                (zone_id, *(zone[field] for field in ZONE_FIELDS))
+                            )
+                    self._db.executemany(
+                        "INSERT INTO changes (version, zone_id, before, after) VALUES (?, ?, ?, ?)",
+                        [(version, zone_id, _dumps(old), _dumps(new)) for zone_id, old, new in changed]
+                    )
+                    self._db.execute(
+                        "INSERT INTO versions (version, created, changed, description) VALUES (?, ?, ?, ?)",
+                        (version, time.time(), len(changed), description)
+                    )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+        if changed:
+            logger.info(f"Capa de seguridad en versión {version}: {len(changed)} zonas cambiadas ({description})")
+        return version
+
+    def _read(self, zone_id: str) -> Optional[Dict]:
+        row = self._db.execute(
+            f"SELECT {', '.join(ZONE_FIELDS)} FROM zones WHERE zone_id = ?", (zone_id,)
+        ).fetchone()
+        return dict(zip(ZONE_FIELDS, row)) if row is not None else None
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _dumps(zone: Optional[Dict]) -> Optional[str]:
+    return json.dumps(zone) if zone is not None else None
+
+
+def _loads(payload: Optional[str]) -> Optional[Dict]:
+    return json.loads(payload) if payload is not None else None
@@ -0,0 +1,71 @@
+import logging
+import os
+import pickle
+import time
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+from sklearn.neighbors import BallTree
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_M = 6371009  # mismo radio que usa osmnx
+
+
+class SpatialIndex:
+    """
+    Índice espacial (BallTree haversine) sobre las coordenadas de los nodos, construido
+    una sola vez y guardado junto al grafo para que los demás procesos sólo lo lean.
+    """
+
+    FILE = "spatial_index.pkl"
+
+    def __init__(self, lat: np.ndarray, lon: np.ndarray, tree: Optional[BallTree] = None):
+        if tree is None:
+            start = time.time()
+            tree = BallTree(np.deg2rad(np.column_stack([lat, lon])), metric="haversine")
+            logger.info(f"Índice espacial construido para {len(lat)} nodos en {time.time() - start:.2f} segundos")
+        self.tree = tree
+
+    def save(self, directory) -> None:
+        """Guarda el árbol junto a los arreglos del grafo (archivo temporal y os.replace)"""
+        path = Path(directory) / self.FILE
+        tmp = path.with_name(f".{self.FILE}.{os.getpid()}")
+        with open(tmp, 'wb') as f:
+            pickle.dump(self.tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, directory) -> Optional["SpatialIndex"]:
+        """Lee el árbol guardado; None si no puede leerse (p. ej. otra versión de scikit-learn)"""
+        try:
+            with open(Path(directory) / cls.FILE, 'rb') as f:
+                tree = pickle.load(f)
+        except Exception as e:
+            logger.warning(f"No se pudo leer el índice espacial guardado, se reconstruye: {str(e)}")
+            return None
+        return cls(None, None, tree)
+
+    @classmethod
+    def exists(cls, directory) -> bool:
+        return (Path(directory) / cls.FILE).exists()
+
+    @property
+    def nbytes(self) -> int:
+        """Memoria ocupada por los arreglos del árbol"""
+        return sum(array.nbytes for array in self.tree.get_arrays())
+
+    def query(self, lats, lons) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Ajusta N coordenadas a sus nodos más cercanos en una sola llamada.
+        Devuelve los índices internos de los nodos y la distancia en metros.
+        """
+        points = np.deg2rad(np.column_stack([np.atleast_1d(lats), np.atleast_1d(lons)]).astype(np.float64))
+        dist, pos = self.tree.query(points, k=1)
+        return pos[:, 0].astype(np.int32), dist[:, 0] * EARTH_RADIUS_M
+
+    def within(self, lat: float, lon: float, radius: float) -> np.ndarray:
+        """Índices internos de los nodos a menos de `radius` metros de una coordenada"""
+        point = np.deg2rad([[lat, lon]])
+        return self.tree.query_radius(point, r=radius / EARTH_RADIUS_M)[0].astype(np.int64)
@@ -5,7 +5,9 @@ document.addEventListener('DOMContentLoaded', function () {
     let startMarker, endMarker;
     let safetyMarkers = [];
     let currentTaskId = null;
+    let currentRegionId = null;
     let checkResultInterval = null;
+    let resultStream = null;
     let selectionMode = null; // 'start', 'end' o 'safety'
     let currentSafetyPointId = null;
 
@@ -139,11 +141,8 @@ document.addEventListener('DOMContentLoaded', function () {
         // Limpiar TODOS los puntos de seguridad en el formulario
         safetyPointsContainer.innerHTML = '';
 
-        // Limpiar intervalo de verificación
-        if (checkResultInterval) {
-            clearInterval(checkResultInterval);
-            checkResultInterval = null;
-        }
+        // Limpiar intervalo de verificación y stream de resultados
+        stopWaitingForResult();
 
         // Añadir un punto de seguridad vacío por defecto
         addSafetyPoint();
@@ -281,6 +280,7 @@ document.addEventListener('DOMContentLoaded', function () {
             .then(response => response.json())
             .then(data => {
                 if (data.status === 'success') {
+                    currentRegionId = data.region_id;
                     document.getElementById('node-count').textContent = data.nodes;
                     document.getElementById('edge-count').textContent = data.edges;
                     document.getElementById('map-stats').classList.remove('hidden');
@@ -359,7 +359,8 @@ document.addEventListener('DOMContentLoaded', function () {
             distance_weight: parseFloat(document.getElementById('distance-weight').value) / 100,
             time_weight: parseFloat(document.getElementById('time-weight').value) / 100,
             safety_weight: parseFloat(document.getElementById('safety-weight').value) / 100,
-            safety_points: safetyPoints
+            safety_points: safetyPoints,
+            region_id: currentRegionId
         };
 
         // Mostrar indicador de carga
@@ -372,10 +373,8 @@ document.addEventListener('DOMContentLoaded', function () {
             map.removeLayer(routeLayer);
         }
 
-        // Limpiar intervalo anterior si existe
-        if (checkResultInterval) {
-            clearInterval(checkResultInterval);
-        }
+        // Dejar de esperar el cálculo anterior si existe
+        stopWaitingForResult();
         console.log("Enviando puntos de seguridad:", safetyPoints);
         // Enviar solicitud
         fetch('/calculate-route', {
@@ -386,6 +385,9 @@ document.addEventListener('DOMContentLoaded', function () {
             body: JSON.stringify(requestData)
         })
             .then(response => {
+                if (response.status === 429) {
+                    throw new Error('El servidor está ocupado, intenta de nuevo en unos segundos');
+                }
                 if (!response.ok) {
                     throw new Error('Error en la respuesta del servidor');
                 }
@@ -394,12 +396,11 @@ document.addEventListener('DOMContentLoaded', function () {
             .then(data => {
                 if (data.status === 'processing') {
                     currentTaskId = data.task_id;
-                    // Verificar cada segundo
-                    checkResultInterval = setInterval(() => checkRouteResult(currentTaskId), 1000);
+                    waitForRouteResult(currentTaskId);
                 } else if (data.status === 'completed') {
-                    // Respuesta directa desde caché
+                    // Resultado ya en caché: se obtiene de inmediato
                     currentTaskId = data.task_id;
-                    displayRouteResult(data);
+                    waitForRouteResult(currentTaskId);
                 } else {
                     showError(data.error || 'Error desconocido al calcular la ruta');
                 }
@@ -411,11 +412,54 @@ document.addEventListener('DOMContentLoaded', function () {
     }
 
 
+    // Recibe el resultado por SSE en cuanto termina; si el stream falla, consulta cada segundo
+    function waitForRouteResult(taskId) {
+        if (!window.EventSource) {
+            startPolling(taskId);
+            return;
+        }
+
+        const stream = new EventSource(`/route-events/${taskId}?segments=1`);
+        resultStream = stream;
+        stream.addEventListener('completed', event => {
+            stopWaitingForResult();
+            displayRouteResult(JSON.parse(event.data));
+        });
+        stream.addEventListener('failed', event => {
+            stopWaitingForResult();
+            showError(JSON.parse(event.data).error);
+        });
+        stream.onerror = () => {
+            // Stream cerrado sin resultado (tiempo agotado, proxy, etc.): volver a consultar
+            stream.close();
+            if (resultStream === stream) {
+                resultStream = null;
+                startPolling(taskId);
+            }
+        };
+    }
+
+    function startPolling(taskId) {
+        checkRouteResult(taskId);
+        checkResultInterval = setInterval(() => checkRouteResult(taskId), 1000);
+    }
+
+    function stopWaitingForResult() {
+        if (resultStream) {
+            resultStream.close();
+            resultStream = null;
+        }
+        if (checkResultInterval) {
+            clearInterval(checkResultInterval);
+            checkResultInterval = null;
+        }
+    }
+
     // Función para verificar el resultado de la ruta (corregida)
     function checkRouteResult(taskId) {
         if (!taskId) return;
 
-        fetch(`/route-result/${taskId}`)
+        fetch(`/route-result/${taskId}?segments=1`)
             .then(response => {
                 if (!response.ok) {
                     // Si es 404, la tarea aún no está lista
@@ -453,6 +497,8 @@ document.addEventListener('DOMContentLoaded', function () {
             return;
         }
 
+        result = expandRouteResult(result);
+
         // Verificar si la respuesta está completa
         if (!result.summary || !result.path || !result.segments) {
             // Si no está completa pero no hay error, puede estar aún procesando
@@ -526,7 +572,7 @@ document.addEventListener('DOMContentLoaded', function () {
     function checkRouteResult(taskId) {
         if (!taskId) return;
 
-        fetch(`/route-result/${taskId}`)
+        fetch(`/route-result/${taskId}?segments=1`)
             .then(response => {
                 if (!response.ok) {
                     // Si es 404, la tarea aún no está lista
@@ -563,6 +609,8 @@ document.addEventListener('DOMContentLoaded', function () {
             return;
         }
 
+        result = expandRouteResult(result);
+
         // Verificar si la respuesta está completa
         if (!result.summary || !result.path || !result.segments) {
             // Si no está completa pero no hay error, puede estar aún procesando
@@ -632,6 +680,49 @@ document.addEventListener('DOMContentLoaded', function () {
         }
     }
 
+    // Decodifica una polilínea (algoritmo de Google) a una lista de [lat, lon]
+    function decodePolyline(encoded, precision = 6) {
+        const factor = Math.pow(10, precision);
+        const points = [];
+        let index = 0, lat = 0, lon = 0;
+
+        while (index < encoded.length) {
+            const deltas = [];
+            for (let i = 0; i < 2; i++) {
+                let result = 0, shift = 0, byte;
+                do {
+                    byte = encoded.charCodeAt(index++) - 63;
+                    result |= (byte & 0x1f) << shift;
+                    shift += 5;
+                } while (byte >= 0x20);
+                deltas.push(result & 1 ? ~(result >> 1) : result >> 1);
+            }
+            lat += deltas[0];
+            lon += deltas[1];
+            points.push([lat / factor, lon / factor]);
+        }
+        return points;
+    }
+
+    // Convierte la respuesta compacta (polilínea + columnas por segmento) al formato de la vista
+    function expandRouteResult(result) {
+        if (!result.geometry) {
+            return result;
+        }
+        const path = decodePolyline(result.geometry, result.geometry_precision || 6);
+        const columns = result.segments || {};
+        const segments = (columns.distance || []).map((distance, i) => ({
+            start: path[i],
+            end: path[i + 1],
+            distance: distance,
+            time: columns.time[i],
+            speed: columns.speed[i],
+            safety: columns.safety[i],
+            safety_level: columns.safety_level[i]
+        }));
+        return { ...result, path: path, segments: segments };
+    }
+
     // Función para dibujar la ruta en el mapa
     function drawRouteOnMap(path) {
         if (routeLayer) {
@@ -0,0 +1,37 @@
+import logging
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+# Los módulos de la aplicación viven en la raíz del repositorio
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import benchmark  # noqa: E402
+from osm_processor import OSMProcessor  # noqa: E402
+
+logging.disable(logging.WARNING)
+
+
+def make_processor(side: int = 12, seed: int = 0, landmark_count: int = 4,
+                   contraction_hierarchies: bool = True) -> OSMProcessor:
+    """Procesador sobre una cuadrícula sintética con maxspeed normalizado (y jerarquías)"""
+    processor = OSMProcessor(landmark_count, contraction_hierarchies=contraction_hierarchies)
+    benchmark.install_graph(processor, benchmark.grid_graph(side, seed))
+    if contraction_hierarchies:
+        processor.build_hierarchies()
+    return processor
+
+
+@pytest.fixture(scope="session")
+def processor() -> OSMProcessor:
+    return make_processor()
+
+
+@pytest.fixture(scope="session")
+def route_pairs(processor):
+    """Pares origen/destino aleatorios y zonas de seguridad, fijos para toda la sesión"""
+    rnd = random.Random(7)
+    pairs = list(zip(benchmark.random_points(processor, 6, rnd), benchmark.random_points(processor, 6, rnd)))
+    return pairs, benchmark.safety_points(processor, rnd)
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+import benchmark
+from compiled_graph import CompiledGraph
+from contraction_hierarchy import ContractionHierarchy
+from landmarks import Landmarks
+from osm_processor import OSMProcessor
+from spatial_index import SpatialIndex
+
+
+@pytest.fixture(scope="module")
+def saved_graph(processor, tmp_path_factory):
+    directory = tmp_path_factory.mktemp("graphs") / "region"
+    processor.save_graph(directory)
+    return directory
+
+
+def test_save_writes_derived_indexes(processor, saved_graph):
+    assert SpatialIndex.exists(saved_graph)
+    assert Landmarks.exists(saved_graph)
+    for metric in OSMProcessor.HIERARCHY_METRICS.values():
+        assert ContractionHierarchy.exists(saved_graph, metric)
+
+
+def test_load_matches_original(processor, saved_graph, route_pairs):
+    loaded = OSMProcessor(4, contraction_hierarchies=True)
+    loaded.load_graph(saved_graph)
+    assert sorted(loaded.hierarchies) == sorted(processor.hierarchies)
+    for name in CompiledGraph.ARRAYS:
+        np.testing.assert_array_equal(getattr(loaded.compiled, name), getattr(processor.compiled, name))
+
+    pairs, points = route_pairs
+    for start, end in pairs:
+        request = benchmark.route_request(start, end, 'balanced', 'landmarks', points)
+        assert (loaded.calculate_route_task(request)['summary']['total_distance'] ==
+                processor.calculate_route_task(request)['summary']['total_distance'])
+        assert (loaded.snap_coordinates([start[0]], [start[1]]) ==
+                processor.snap_coordinates([start[0]], [start[1]]))
+
+
+def test_unreadable_spatial_index_is_rebuilt(processor, tmp_path):
+    directory = tmp_path / "region"
+    processor.save_graph(directory)
+    (directory / SpatialIndex.FILE).write_bytes(b"corrupto")
+    loaded = OSMProcessor(0)
+    loaded.load_graph(directory)
+    lat, lon = float(processor.compiled.lat[5]), float(processor.compiled.lon[5])
+    assert loaded.snap_coordinates([lat], [lon]) == [int(processor.compiled.node_ids[5])]
+    assert SpatialIndex.load(directory) is not None
+
+
+def test_node_index_lookup(processor):
+    compiled = processor.compiled
+    for i in (0, 17, compiled.num_nodes - 1):
+        assert compiled.index(int(compiled.node_ids[i])) == i
+    assert compiled.index_of(compiled.node_ids[:3]).tolist() == [0, 1, 2]
+    with pytest.raises(KeyError):
+        compiled.index(-1)
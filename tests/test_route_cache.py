@@ -0,0 +1,116 @@
+import threading
+import time
+
+import pytest
+
+from route_cache import RouteCache
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return tmp_path / "route_cache.sqlite3"
+
+
+@pytest.fixture
+def cache(db_path):
+    return RouteCache(db_path, max_entries=5, poll_interval=0.05)
+
+
+def test_result_survives_reopen(cache, db_path):
+    cache.put_result("k", {"route": [1, 2]})
+    assert cache.get_result("k") == {"route": [1, 2]}
+    assert RouteCache(db_path).get_result("k") == {"route": [1, 2]}
+    assert cache.get_result("missing") is None
+
+
+def test_memory_lru_falls_back_to_disk(cache):
+    for i in range(10):
+        cache.put_result(f"k{i}", {"i": i})
+    assert len(cache._results) == 5
+    assert cache.get_result("k0") == {"i": 0}
+
+
+def test_expired_results_are_not_returned(db_path):
+    cache = RouteCache(db_path, ttl=0.05)
+    cache.put_result("k", {"x": 1})
+    time.sleep(0.1)
+    assert cache.get_result("k") is None
+
+
+def test_disk_entries_are_capped(db_path):
+    cache = RouteCache(db_path, max_entries=10, max_disk_entries=50)
+    for i in range(300):
+        cache.put_result(f"k{i}", {"i": i})
+    reopened = RouteCache(db_path, max_disk_entries=50)
+    count = reopened._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+    assert count <= 51
+    assert reopened.get_result("k299") == {"i": 299}
+    assert reopened.get_result("k0") is None
+
+
+def test_identical_tasks_attach_to_one_claim(cache):
+    assert cache.start_task("t1", "k") is True
+    assert cache.start_task("t2", "k", connectors={"start": 1}) is False
+    assert cache.get_task("t2")["status"] == "processing"
+
+    cache.put_result("k", {"x": 1})
+    cache.finish_tasks("k", "completed")
+    assert cache.get_task("t1")["status"] == "completed"
+    task = cache.get_task("t2")
+    assert task["status"] == "completed" and task["connectors"] == {"start": 1}
+    # El reclamo se liberó: un cálculo nuevo de la misma clave vuelve a reclamarse
+    assert cache.start_task("t3", "k") is True
+
+
+def test_failed_computation_fails_every_attached_task(cache):
+    cache.start_task("t1", "k")
+    cache.start_task("t2", "k")
+    cache.finish_tasks("k", "failed", "sin ruta")
+    assert [cache.get_task(t)["error"] for t in ("t1", "t2")] == ["sin ruta", "sin ruta"]
+
+
+def test_finished_task_does_not_change(cache):
+    cache.set_task("t", "completed", "k")
+    cache.set_task("t", "failed", "k", error="tarde")
+    assert cache.get_task("t")["status"] == "completed"
+
+
+def test_claim_of_dead_process_is_released(cache):
+    cache.start_task("t1", "k")
+    cache._db.execute("UPDATE claims SET owner = 999999999")
+    assert cache.get_task("t1")["status"] == "failed"
+    assert cache.start_task("t2", "k") is True
+
+
+def test_old_claim_of_live_process_is_kept(cache):
+    cache.start_task("t1", "k")
+    cache._db.execute("UPDATE claims SET claimed = claimed - 100000")
+    assert cache.get_task("t1")["status"] == "processing"
+    assert cache.start_task("t2", "k") is False
+
+
+def test_every_waiter_is_notified(cache):
+    cache.start_task("t", "k")
+    outcomes = {}
+
+    def wait(name, timeout):
+        start = time.time()
+        outcomes[name] = (cache.wait_task("t", timeout)["status"], time.time() - start)
+
+    waiters = [threading.Thread(target=wait, args=("short", 0.1)),
+               threading.Thread(target=wait, args=("long", 10))]
+    for waiter in waiters:
+        waiter.start()
+    time.sleep(0.3)
+    cache.put_result("k", {"x": 1})
+    cache.finish_tasks("k", "completed")
+    for waiter in waiters:
+        waiter.join()
+
+    assert outcomes["short"][0] == "processing"
+    assert outcomes["long"][0] == "completed" and outcomes["long"][1] < 2
+    assert cache._task_events == {}
+
+
+def test_wait_on_unknown_task(cache):
+    assert cache.wait_task("missing", 0.1) is None
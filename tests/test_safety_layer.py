@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from safety_layer import SafetyLayer
+from conftest import make_processor
+
+
+@pytest.fixture
+def processor():
+    # Las versiones materializadas se guardan por número: un procesador por capa
+    return make_processor(contraction_hierarchies=False)
+
+
+@pytest.fixture
+def layer(tmp_path):
+    layer = SafetyLayer(tmp_path / "safety_layer.sqlite3")
+    yield layer
+    layer.close()
+
+
+def zone(lat, lon, radius=300, safety_index=3, weight=1.0):
+    return {'lat': lat, 'lon': lon, 'radius': radius, 'safety_index': safety_index, 'weight': weight}
+
+
+def test_incremental_state_matches_full_build(processor, layer):
+    _, first = layer.add(zone(19.952, -99.535))
+    layer.add(zone(19.956, -99.531, radius=500, safety_index=5))
+    base = processor.safety_layer_state(layer, layer.version)
+
+    layer.update(first, {'radius': 700, 'safety_index': 1})
+    layer.import_zones([zone(19.950, -99.530), zone(20.5, -99.0)])  # la segunda no toca la red
+    _, last = layer.add(zone(19.958, -99.537, weight=2.0))
+    layer.remove(last)
+
+    # Se parte de la versión materializada más cercana y sólo se recalculan los cambios
+    incremental = processor.safety_layer_state(layer, layer.version)
+    full = make_processor(contraction_hierarchies=False).safety_layer_state(layer, layer.version)
+
+    assert incremental.version == full.version == layer.version
+    assert incremental.zones.keys() == full.zones.keys()
+    np.testing.assert_allclose(incremental.node_safety, full.node_safety)
+    np.testing.assert_allclose(incremental.edge_safety, full.edge_safety)
+    assert not np.array_equal(base.edge_safety, incremental.edge_safety)
+
+
+def test_older_version_is_rebuilt_from_history(processor, layer):
+    layer.add(zone(19.952, -99.535))
+    version = layer.version
+    expected = make_processor(contraction_hierarchies=False).safety_layer_state(layer, version)
+    layer.add(zone(19.956, -99.531))
+    processor.safety_layer_state(layer, layer.version)
+
+    state = processor.safety_layer_state(layer, version)
+    np.testing.assert_allclose(state.edge_safety, expected.edge_safety)
+
+
+def test_empty_layer_has_no_influence(processor, layer):
+    state = processor.safety_layer_state(layer, 0)
+    assert not state.zones
+    assert not state.edge_safety.any()
@@ -0,0 +1,75 @@
+import math
+
+import pytest
+
+import benchmark
+from osm_processor import OSMProcessor
+
+
+def same_cost(a: dict, b: dict, optimization: str) -> bool:
+    return math.isclose(benchmark.route_cost(a['summary'], optimization),
+                        benchmark.route_cost(b['summary'], optimization), rel_tol=1e-6, abs_tol=1e-6)
+
+
+@pytest.mark.parametrize("optimization", benchmark.OPTIMIZATIONS)
+def test_compiled_matches_networkx(processor, route_pairs, optimization):
+    pairs, points = route_pairs
+    for start, end in pairs:
+        request = benchmark.route_request(start, end, optimization, 'landmarks', points)
+        compiled = processor.calculate_route_task(request)
+        networkx = processor.calculate_route_task(dict(request, engine='networkx'))
+        assert compiled['status'] == networkx['status'] == 'completed'
+        assert networkx['metadata']['engine'] == 'networkx'
+        assert same_cost(compiled, networkx, optimization)
+
+
+@pytest.mark.parametrize("search", ["bidirectional", "ch"])
+@pytest.mark.parametrize("optimization", benchmark.OPTIMIZATIONS)
+def test_search_matches_astar(processor, route_pairs, optimization, search):
+    pairs, points = route_pairs
+    for start, end in pairs:
+        request = benchmark.route_request(start, end, optimization, 'landmarks', points)
+        reference = processor.calculate_route_task(request)
+        result = processor.calculate_route_task(dict(request, search=search))
+        assert result['status'] == 'completed'
+        assert same_cost(result, reference, optimization)
+
+
+@pytest.mark.parametrize("optimization", ["shortest", "fastest", "balanced"])
+def test_landmarks_match_euclidean(processor, route_pairs, optimization):
+    # La euclidiana es admisible en estas optimizaciones: ALT debe dar el mismo costo
+    pairs, points = route_pairs
+    for start, end in pairs:
+        request = benchmark.route_request(start, end, optimization, 'euclidean', points)
+        euclidean = processor.calculate_route_task(request)
+        landmarks = processor.calculate_route_task(dict(request, heuristic='landmarks'))
+        assert same_cost(euclidean, landmarks, optimization)
+
+
+def test_check_searches_reports_no_mismatches(processor):
+    assert benchmark.check_searches(processor, 5, 0)['mismatches'] == []
+
+
+def test_hierarchy_used_when_available(processor, route_pairs):
+    start, end = route_pairs[0][0]
+    request = benchmark.route_request(start, end, 'fastest', 'euclidean', [], search='auto')
+    assert processor.calculate_route_task(request)['metadata']['search'] == 'ch'
+    request = dict(request, optimization='safest')
+    assert processor.calculate_route_task(request)['metadata']['search'] == 'astar'
+
+
+@pytest.mark.parametrize("search", ["astar", "bidirectional", "ch"])
+def test_same_start_and_end_is_empty_route(processor, route_pairs, search):
+    start = route_pairs[0][0][0]
+    request = benchmark.route_request(start, start, 'balanced', 'landmarks', [], search=search)
+    result = processor.calculate_route_task(request)
+    assert result['status'] == 'completed'
+    assert result['summary']['total_distance'] == 0
+
+
+@pytest.mark.parametrize("engine, search", [
+    ("networkx", "bidirectional"), ("networkx", "ch"), ("compiled", "dijkstra"), ("gpu", "auto")
+])
+def test_invalid_engine_search_rejected(engine, search):
+    with pytest.raises(ValueError):
+        OSMProcessor.validate_search(engine, search)